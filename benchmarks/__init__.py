@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/26 下午2:18
+"""
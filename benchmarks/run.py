@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/26 下午3:02
+
+session和Query热点路径的基准测试
+
+默认使用进程内的mongo替身(benchmarks/standin.py),指定--host时使用真实的mongod,
+结果保存为json,并且和保存的基线比较,耗时超过基线的threshold比例时返回非0的退出码.
+
+eg:
+    python -m benchmarks.run --save-baseline            # 生成基线 benchmarks/baseline.json
+    python -m benchmarks.run                            # 运行并和基线比较
+    python -m benchmarks.run -k find_many --repeat 9    # 只运行名称包含find_many的基准测试
+    python -m benchmarks.run --host 127.0.0.1 --port 27017 --username mongo --passwd xxx --dbname bench
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymongo
+from bson import ObjectId
+
+from fesdql import LRU, Param, Query, SyncMongo, TTLLRU, __version__
+from fesdql._alchemy import SessionMixIn
+from fesdql._err_msg import mongo_msg
+from fesdql.sync_mongo import SyncSession
+
+from .standin import MemoryDatabase
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCS_CNAME = "bench_docs"
+INSERT_CNAME = "bench_insert"
+
+# 注册的基准测试, (名称, 生成被测函数的函数, 每轮结束后的清理函数)
+BENCHMARKS: List[Tuple[str, Callable[['BenchEnv'], Callable[[], Any]], Optional[Callable[['BenchEnv'], Any]]]] = []
+
+
+def benchmark(name: str, teardown: Callable[['BenchEnv'], Any] = None, **params: List[Any]) -> Callable:
+    """
+    注册基准测试,被装饰的函数接收BenchEnv和参数,返回无参数的被测函数
+
+    params中的每个参数值都会生成一个单独的基准测试, eg: page_size=[10, 100]
+    Args:
+        name: 基准测试的名称
+        teardown: 每轮结束后的清理函数
+        params: 参数名称和参数值列表
+    Returns:
+
+    """
+
+    def decorator(func: Callable) -> Callable:
+        if not params:
+            BENCHMARKS.append((name, func, teardown))
+            return func
+        (param_name, values), = params.items()
+        for value in values:
+            BENCHMARKS.append(("{}[{}={}]".format(name, param_name, value),
+                               lambda env, value_=value: func(env, value_), teardown))
+        return func
+
+    return decorator
+
+
+class BenchEnv(object):
+    """
+    基准测试的运行环境,包括session和已经写入测试数据的collection
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args: argparse.Namespace = args
+        self.mongo: SyncMongo = SyncMongo()
+        if args.host:
+            self.backend = "mongod"
+            self.mongo.init_engine(host=args.host, port=args.port, username=args.username, passwd=args.passwd,
+                                   dbname=args.dbname, pool_size=args.pool_size)
+            self.session: SyncSession = self.mongo.session
+            self.db = self.session.db
+        else:
+            self.backend = "standin"
+            self.db = MemoryDatabase()
+            # 和SyncMongo.session使用同样的配置,包括耗时统计、负载统计和钩子
+            self.session = SyncSession(self.db, mongo_msg, "msg_zh", **self.mongo._session_options())
+        self.ids: List[ObjectId] = []
+        self.seed(args.docs)
+
+    @staticmethod
+    def make_document(index: int) -> Dict:
+        """
+        生成测试document
+        Args:
+            index: 序号
+        Returns:
+
+        """
+        return {"name": "user{}".format(index), "age": index % 80, "score": index * 0.5,
+                "tags": ["tag{}".format(index % 7), "tag{}".format(index % 11)],
+                "created": datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=index),
+                "profile": {"city": "city{}".format(index % 50), "level": index % 5}}
+
+    def seed(self, count: int):
+        """
+        重新写入测试数据
+        Args:
+            count: document的数量
+        Returns:
+
+        """
+        self.db.drop_collection(DOCS_CNAME)
+        self.db.drop_collection(INSERT_CNAME)
+        documents = [self.make_document(index) for index in range(count)]
+        for start in range(0, count, 1000):
+            self.db.get_collection(DOCS_CNAME).insert_many(documents[start:start + 1000])
+        self.ids = [document["_id"] for document in documents]
+
+    def close(self, ):
+        self.db.drop_collection(DOCS_CNAME)
+        self.db.drop_collection(INSERT_CNAME)
+        for engine in self.mongo.engine_pool.values():
+            engine.close()
+
+
+@benchmark("query.build")
+def query_build(env: BenchEnv) -> Callable[[], Any]:
+    id_ = str(env.ids[0])
+
+    def run():
+        return (Query().collection(DOCS_CNAME).where(id={"in": [id_]}, age={"gte": 18, "lt": 60}, name="user1")
+                .order_by(("age", -1), ("created", 1)).exclude(profile=0).paginate_query(page=3, per_page=20))
+
+    return run
+
+
+@benchmark("query.normalize")
+def query_normalize(env: BenchEnv) -> Callable[[], Any]:
+    ids = [str(id_) for id_ in env.ids[:10]]
+    query_key = {"id": {"in": ids}, "age": {"gte": 18, "lt": 60}, "tags": {"in": ["tag1", "tag2"]},
+                 "name": "user1", "profile.level": {"ne": 3}}
+
+    def run():
+        return env.session._update_query_key(query_key)
+
+    return run
+
+
+@benchmark("query.prepared_bind")
+def query_prepared_bind(env: BenchEnv) -> Callable[[], Any]:
+    prepared = Query().collection(DOCS_CNAME).where(
+        age={"gte": Param("min_age"), "lt": Param("max_age")}, name=Param("name")).prepare()
+
+    def run():
+        return prepared.bind(min_age=18, max_age=60, name="user1")
+
+    return run
+
+
+@benchmark("find_many.post_process", page_size=[10, 100, 1000])
+def find_many_post_process(env: BenchEnv, page_size: int) -> Callable[[], Any]:
+    def run():
+        return env.session._find_many(DOCS_CNAME, {}, limit=page_size)
+
+    return run
+
+
+def clamp_page(env: BenchEnv, page: int, per_page: int = 20) -> int:
+    """
+    把页码限制在文档数量能覆盖的范围内,--docs较小时深度分页退化为最后一页
+    Args:
+        env: 基准测试环境
+        page: 页码
+        per_page: 每页数量
+    Returns:
+
+    """
+    return max(min(page, len(env.ids) // per_page), 1)
+
+
+@benchmark("paginate.offset", page=[1, 100, 1000])
+def paginate_offset(env: BenchEnv, page: int) -> Callable[[], Any]:
+    page = clamp_page(env, page)
+
+    def run():
+        return env.session.find_many(Query().collection(DOCS_CNAME).paginate_query(page=page, per_page=20))
+
+    return run
+
+
+@benchmark("paginate.keyset", page=[1, 100, 1000])
+def paginate_keyset(env: BenchEnv, page: int) -> Callable[[], Any]:
+    # 直接根据第page页之前的最后一个document生成游标
+    page = clamp_page(env, page)
+    sort = SessionMixIn._keyset_sort(None)
+    cursor = SessionMixIn._encode_keyset_cursor(
+        {"_id": env.ids[(page - 1) * 20 - 1]}, sort) if page > 1 else None
+
+    def run():
+        return env.session.find_many(Query().collection(DOCS_CNAME).keyset_query(after=cursor, per_page=20))
+
+    return run
+
+
+def drop_insert_collection(env: BenchEnv):
+    env.db.drop_collection(INSERT_CNAME)
+
+
+@benchmark("insert_many.batch", teardown=drop_insert_collection, batch_size=[1, 100, 1000])
+def insert_many_batch(env: BenchEnv, batch_size: int) -> Callable[[], Any]:
+    documents = [env.make_document(index) for index in range(batch_size)]
+
+    def run():
+        # insert_many会给document加上_id,每次都需要新的document
+        return env.session.insert_many(Query().collection(INSERT_CNAME).insert_query(
+            [dict(document) for document in documents]))
+
+    return run
+
+
+@benchmark("lru.set", cache=["LRU", "TTLLRU"])
+def lru_set(env: BenchEnv, cache: str) -> Callable[[], Any]:
+    lru = LRU(max_size=1024) if cache == "LRU" else TTLLRU(max_size=1024, default_ttl=60)
+    # 每次调用写入2048次,key的数量是容量的两倍,一半的写入会淘汰最久没有使用的key
+    keys = ["key{}".format(index) for index in range(2048)]
+
+    def run():
+        for key in keys:
+            lru[key] = key
+
+    return run
+
+
+@benchmark("lru.get", cache=["LRU", "TTLLRU"])
+def lru_get(env: BenchEnv, cache: str) -> Callable[[], Any]:
+    lru = LRU(max_size=1024) if cache == "LRU" else TTLLRU(max_size=1024, default_ttl=60)
+    for index in range(1024):
+        lru["key{}".format(index)] = index
+    # 每次调用读取2048次, 90%命中, 10%不命中
+    keys = ["key{}".format(index if index % 10 else index + 4096) for index in range(2048)]
+
+    def run():
+        for key in keys:
+            lru.get(key)
+
+    return run
+
+
+def measure(run: Callable[[], Any], repeat: int, min_time: float, teardown: Callable[[], Any] = None) -> Dict:
+    """
+    测量被测函数的耗时,先估算每轮的循环次数,使每轮的耗时不少于min_time
+    Args:
+        run: 被测函数
+        repeat: 轮数
+        min_time: 每轮的最少耗时,单位秒
+        teardown: 每轮结束后的清理函数
+    Returns:
+        返回每次调用耗时的中位数、最小值和每秒的调用次数
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            run()
+        elapsed = time.perf_counter() - started
+        if teardown is not None:
+            teardown()
+        if elapsed >= min_time / 10 or loops >= 1 << 20:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            run()
+        timings.append((time.perf_counter() - started) / loops)
+        if teardown is not None:
+            teardown()
+    median = statistics.median(timings)
+    return {"median_us": round(median * 1e6, 3), "min_us": round(min(timings) * 1e6, 3),
+            "ops_per_sec": round(1 / median, 1) if median else 0, "loops": loops, "repeat": repeat}
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict:
+    """
+    运行所有匹配的基准测试
+    Args:
+        args: 命令行参数
+    Returns:
+        返回包括运行环境和每个基准测试结果的dict
+    """
+    env = BenchEnv(args)
+    results = {}
+    try:
+        for name, factory, teardown in BENCHMARKS:
+            if args.k and args.k not in name:
+                continue
+            run = factory(env)
+            results[name] = measure(run, args.repeat, args.min_time,
+                                    (lambda: teardown(env)) if teardown is not None else None)
+            print("{:<45} {:>12.3f} us {:>14.1f} ops/s".format(
+                name, results[name]["median_us"], results[name]["ops_per_sec"]))
+    finally:
+        env.close()
+    return {"meta": {"backend": env.backend, "docs": args.docs, "fesdql": __version__, "pymongo": pymongo.version,
+                     "python": platform.python_version(), "platform": platform.platform(),
+                     "time": datetime.datetime.now().isoformat(timespec="seconds")},
+            "results": results}
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    和基线比较,返回耗时超过基线threshold比例的基准测试
+    Args:
+        current: 本次的结果
+        baseline: 基线的结果
+        threshold: 允许的变慢比例, eg: 0.1表示允许慢10%
+    Returns:
+        返回变慢的基准测试名称列表
+    """
+    if baseline["meta"].get("backend") != current["meta"]["backend"]:
+        print("warning: baseline backend {} is different from current backend {}".format(
+            baseline["meta"].get("backend"), current["meta"]["backend"]))
+
+    regressions = []
+    print("\n{:<45} {:>12} {:>12} {:>9}".format("benchmark", "baseline us", "current us", "change"))
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print("{:<45} {:>12} {:>12.3f} {:>9}".format(name, "-", result["median_us"], "new"))
+            continue
+        change = result["median_us"] / base["median_us"] - 1 if base["median_us"] else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print("{:<45} {:>12.3f} {:>12.3f} {:>+8.1%}{}".format(
+            name, base["median_us"], result["median_us"], change, flag))
+    return regressions
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="fesdql benchmarks")
+    parser.add_argument("-k", default="", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds of each benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds of each round")
+    parser.add_argument("--docs", type=int, default=25000, help="documents in the benchmark collection")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results.json"), help="result json file")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"), help="baseline json file")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown ratio against baseline")
+    # 使用真实的mongod
+    parser.add_argument("--host", default=None, help="mongod host, use the in-process stand-in if omitted")
+    parser.add_argument("--port", type=int, default=27017)
+    parser.add_argument("--username", default="mongo")
+    parser.add_argument("--passwd", default=None)
+    parser.add_argument("--dbname", default="fesdql_benchmark")
+    parser.add_argument("--pool-size", type=int, default=10)
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    current = run_benchmarks(args)
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+    print("\nresults saved to {}".format(args.output))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("baseline {} does not exist, run with --save-baseline first".format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(current, baseline, args.threshold)
+    if regressions:
+        print("\n{} benchmark(s) slower than baseline by more than {:.0%}: {}".format(
+            len(regressions), args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
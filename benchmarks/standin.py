@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/26 下午2:18
+
+进程内的mongo替身,只实现session热点路径中用到的collection方法,用于在没有mongod的环境中运行基准测试和单元测试.
+
+document以BSON的形式保存,每次查询都重新解码,这样查询结果的开销和pymongo解码服务端返回的数据一致,
+document按照_id的顺序保存,相当于_id上的唯一索引,_id的范围查询和$in查询通过二分查找定位,
+其他字段没有索引,过滤和排序都是线性扫描.比较操作和mongo一样只在同一种BSON类型之间进行.
+"""
+import bisect
+import copy
+import datetime
+import itertools
+import random
+import re
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from bson import BSON, Decimal128, ObjectId, Timestamp
+from bson.codec_options import DEFAULT_CODEC_OPTIONS, CodecOptions
+from bson.regex import Regex
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+__all__ = ("MemoryCollection", "MemoryDatabase", "AsyncMemoryCollection", "AsyncMemoryDatabase", "match")
+
+_MISSING = object()
+
+# mongo中比较和排序时BSON类型的顺序,数值类型之间可以相互比较
+_TYPE_ORDER: Tuple[Tuple[Any, int], ...] = (
+    (type(None), 1), (bool, 8), ((int, float, Decimal128), 2), (str, 3), (dict, 4), ((list, tuple), 5),
+    (bytes, 6), (ObjectId, 7), (datetime.datetime, 9), (Timestamp, 10), ((Regex, type(re.compile(""))), 11))
+
+# $type操作符的别名和对应的BSON类型顺序
+_TYPE_ALIASES: Dict[str, int] = {
+    "null": 1, "number": 2, "double": 2, "int": 2, "long": 2, "decimal": 2, "string": 3, "object": 4, "array": 5,
+    "binData": 6, "objectId": 7, "bool": 8, "date": 9, "timestamp": 10, "regex": 11}
+
+
+def _type_rank(value: Any) -> int:
+    """
+    获取值的BSON类型在mongo比较顺序中的位置
+    Args:
+        value: 字段的值
+    Returns:
+        返回类型的顺序,未知的类型排在最后
+    """
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 12
+
+
+def _get_field(document: Dict, field: str) -> Any:
+    """
+    获取document中的字段值,字段名称支持a.b的嵌套形式
+    Args:
+        document: document obj
+        field: 字段名称
+    Returns:
+        返回字段的值,不存在时返回_MISSING
+    """
+    value: Any = document
+    for key in field.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _compare(op: Callable[[Any, Any], bool]) -> Callable[[Any, Any], bool]:
+    def compare(value: Any, expected: Any) -> bool:
+        if value is _MISSING or value is None or _type_rank(value) != _type_rank(expected):
+            return False
+        try:
+            return op(value, expected)
+        except TypeError:
+            return False
+
+    return compare
+
+
+def _match_type(value: Any, expected: Any) -> bool:
+    if value is _MISSING:
+        return False
+    aliases = expected if isinstance(expected, list) else [expected]
+    return any(_TYPE_ALIASES.get(alias) == _type_rank(value) for alias in aliases)
+
+
+def _equals(value: Any, expected: Any) -> bool:
+    # 和mongo一样,null可以匹配不存在的字段,数组中包含该值时也匹配
+    if expected is None and value is _MISSING:
+        return True
+    return value == expected or (isinstance(value, list) and expected in value)
+
+
+_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$eq": _equals,
+    "$ne": lambda value, expected: not _equals(value, expected),
+    "$gt": _compare(lambda value, expected: value > expected),
+    "$gte": _compare(lambda value, expected: value >= expected),
+    "$lt": _compare(lambda value, expected: value < expected),
+    "$lte": _compare(lambda value, expected: value <= expected),
+    "$in": lambda value, expected: value in expected or (isinstance(value, list) and any(
+        val in expected for val in value)),
+    "$nin": lambda value, expected: value not in expected,
+    "$exists": lambda value, expected: (value is not _MISSING) is bool(expected),
+    "$type": _match_type,
+    "$not": lambda value, expected: not _match_operators(value, expected),
+}
+
+
+def _match_operators(value: Any, expected: Dict) -> bool:
+    for op, operand in expected.items():
+        if op not in _OPERATORS:
+            raise NotImplementedError("operator {} is not supported by the stand-in.".format(op))
+        if not _OPERATORS[op](value, operand):
+            return False
+    return True
+
+
+def match(document: Dict, query_key: Optional[Dict]) -> bool:
+    """
+    判断document是否匹配过滤条件,支持常用的比较操作符和$and、$or、$nor
+    Args:
+        document: document obj
+        query_key: 过滤条件
+    Returns:
+
+    """
+    for key, expected in (query_key or {}).items():
+        if key == "$and":
+            if not all(match(document, clause) for clause in expected):
+                return False
+        elif key == "$or":
+            if not any(match(document, clause) for clause in expected):
+                return False
+        elif key == "$nor":
+            if any(match(document, clause) for clause in expected):
+                return False
+        else:
+            value = _get_field(document, key)
+            if isinstance(expected, dict) and expected and all(op.startswith("$") for op in expected):
+                if not _match_operators(value, expected):
+                    return False
+            elif not _equals(value, expected):
+                return False
+    return True
+
+
+def _project(document: Dict, projection: Optional[Dict]) -> Dict:
+    """
+    按照find的projection过滤document的字段
+    Args:
+        document: document obj
+        projection: 字段的过滤条件
+    Returns:
+        返回过滤后的document
+    """
+    if not projection:
+        return document
+    include = {key for key, val in projection.items() if val}
+    if include:
+        return {key: val for key, val in document.items() if key in include or (
+            key == "_id" and projection.get("_id", 1))}
+    return {key: val for key, val in document.items() if key not in projection}
+
+
+def _apply_codec(document: Dict, codec_options: CodecOptions) -> Dict:
+    """
+    按照collection的CodecOptions返回document,默认的CodecOptions直接返回dict
+    Args:
+        document: 解码后的document
+        codec_options: collection的CodecOptions
+    Returns:
+        返回document_class类型的document, eg: RawBSONDocument
+    """
+    if codec_options is DEFAULT_CODEC_OPTIONS:
+        return document
+    return BSON.encode(document).decode(codec_options)
+
+
+class _Cursor(object):
+    """
+    查询游标,迭代时才解码document
+    """
+
+    def __init__(self, documents: Iterator[bytes], projection: Optional[Dict] = None,
+                 codec_options: CodecOptions = DEFAULT_CODEC_OPTIONS):
+        self._documents: Iterator[bytes] = documents
+        self._projection: Optional[Dict] = projection
+        self._codec_options: CodecOptions = codec_options
+
+    def __iter__(self, ):
+        return self
+
+    def __next__(self, ) -> Dict:
+        return _apply_codec(_project(BSON(next(self._documents)).decode(), self._projection), self._codec_options)
+
+    def close(self, ):
+        self._documents = iter(())
+
+
+class MemoryCollection(object):
+    """
+    进程内的collection
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        # _id到BSON数据和解码后用于过滤的document
+        self._documents: Dict[Any, Tuple[bytes, Dict]] = {}
+        # 按照BSON比较顺序排序的(类型顺序, _id),相当于_id上的索引
+        self._index: List[Tuple[int, Any]] = []
+        self.codec_options: CodecOptions = DEFAULT_CODEC_OPTIONS
+
+    def with_options(self, codec_options: CodecOptions = None) -> 'MemoryCollection':
+        """
+        返回使用其他CodecOptions的collection,和原collection共享数据
+        Args:
+            codec_options: 查询结果使用的CodecOptions
+        Returns:
+
+        """
+        collection = copy.copy(self)
+        if codec_options is not None:
+            collection.codec_options = codec_options
+        return collection
+
+    def _id_range(self, query_key: Optional[Dict]) -> Tuple[int, int]:
+        """
+        根据过滤条件中_id的范围查询在索引中定位扫描的区间,过滤条件的其他部分扫描时再判断
+        Args:
+            query_key: 过滤条件
+        Returns:
+            返回索引中的(开始位置, 结束位置)
+        """
+        start, end = 0, len(self._index)
+        for op, bound in self._id_bounds(query_key):
+            rank = _type_rank(bound)
+            # 范围查询只匹配同一种类型的_id
+            start = max(start, bisect.bisect_left(self._index, (rank,)))
+            end = min(end, bisect.bisect_left(self._index, (rank + 1,)))
+            if op == "$gt":
+                start = max(start, bisect.bisect_right(self._index, (rank, bound)))
+            elif op == "$gte":
+                start = max(start, bisect.bisect_left(self._index, (rank, bound)))
+            elif op == "$lt":
+                end = min(end, bisect.bisect_left(self._index, (rank, bound)))
+            else:
+                end = min(end, bisect.bisect_right(self._index, (rank, bound)))
+        return start, max(start, end)
+
+    @classmethod
+    def _id_bounds(cls, query_key: Optional[Dict]) -> List[Tuple[str, Any]]:
+        """
+        获取过滤条件中必须同时满足的_id范围条件,包括$and中的条件和只有一个分支的$or
+        Args:
+            query_key: 过滤条件
+        Returns:
+            返回(操作符, 边界值)列表
+        """
+        bounds: List[Tuple[str, Any]] = []
+        for key, expected in (query_key or {}).items():
+            if key == "_id" and isinstance(expected, dict):
+                bounds.extend((op, val) for op, val in expected.items() if op in ("$gt", "$gte", "$lt", "$lte"))
+            elif key == "$and" or (key == "$or" and len(expected) == 1):
+                for clause in expected:
+                    bounds.extend(cls._id_bounds(clause))
+        return bounds
+
+    def _scan(self, query_key: Optional[Dict], sort: List[Tuple[str, int]] = None) -> Iterator[bytes]:
+        sort = list(sort) if sort else []
+        id_in = (query_key or {}).get("_id")
+        if isinstance(id_in, dict) and "$in" in id_in:
+            keys = sorted((_type_rank(val), val) for val in id_in["$in"] if val in self._documents)
+            if sort == [("_id", -1)]:
+                keys.reverse()
+            rows = (self._documents[key[1]] for key in keys)
+        else:
+            start, end = self._id_range(query_key)
+            positions = range(end - 1, start - 1, -1) if sort == [("_id", -1)] else range(start, end)
+            # 按位置惰性读取索引,skip和limit不需要复制整个索引
+            rows = (self._documents[self._index[position][1]] for position in positions)
+        if query_key:
+            rows = (row for row in rows if match(row[1], query_key))
+        if sort and sort not in ([("_id", 1)], [("_id", -1)]):
+            rows = iter(sorted(rows, key=lambda row: self._sort_key(row[1], sort)))  # type: ignore
+        return (row[0] for row in rows)
+
+    @staticmethod
+    def _sort_key(document: Dict, sort: List[Tuple[str, int]]) -> Tuple:
+        keys = []
+        for field, direction in sort:
+            value = _get_field(document, field)
+            value = (0, 0) if value is _MISSING or value is None else (_type_rank(value), value)
+            keys.append(value if int(direction) > 0 else _Reversed(value))
+        return tuple(keys)
+
+    def insert_one(self, document: Dict) -> InsertOneResult:
+        document.setdefault("_id", ObjectId())
+        if document["_id"] in self._documents:
+            raise DuplicateKeyError("E11000 duplicate key error collection: {}".format(self.name), 11000)
+        data = BSON.encode(document)
+        self._documents[document["_id"]] = (data, document)
+        key = (_type_rank(document["_id"]), document["_id"])
+        # 默认生成的ObjectId是递增的,大部分情况下直接追加到末尾
+        if not self._index or self._index[-1] < key:
+            self._index.append(key)
+        else:
+            bisect.insort(self._index, key)
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents: List[Dict], ordered: bool = True) -> InsertManyResult:
+        inserted_ids, write_errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted_ids.append(self.insert_one(document).inserted_id)
+            except DuplicateKeyError as err:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(err), "op": document})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": len(inserted_ids)})
+        return InsertManyResult(inserted_ids, True)
+
+    def update_one(self, filter: Dict, update: Dict, upsert: bool = False) -> UpdateResult:
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter: Dict, update: Dict, upsert: bool = False) -> UpdateResult:
+        return self._update(filter, update, upsert, multi=True)
+
+    def _update(self, filter: Dict, update: Dict, upsert: bool, multi: bool) -> UpdateResult:
+        """
+        更新document,只支持$set、$unset和$inc
+        Args:
+            filter: 过滤条件
+            update: 更新的操作
+            upsert: 没有匹配到document时是否插入
+            multi: 是否更新所有匹配的document
+        Returns:
+            返回和pymongo一致的UpdateResult
+        """
+        matched = [BSON(data).decode() for data in itertools.islice(self._scan(filter), None if multi else 1)]
+        if not matched and upsert:
+            document = {key: val for key, val in filter.items() if not key.startswith("$") and not isinstance(
+                val, dict)}
+            self._apply_update(document, update)
+            _id = self.insert_one(document).inserted_id
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": _id}, True)
+        modified = 0
+        for document in matched:
+            data = BSON.encode(document)
+            self._apply_update(document, update)
+            new_data = BSON.encode(document)
+            if new_data != data:
+                modified += 1
+                self._documents[document["_id"]] = (new_data, document)
+        return UpdateResult({"n": len(matched), "nModified": modified}, True)
+
+    @staticmethod
+    def _apply_update(document: Dict, update: Dict):
+        for op, fields in update.items():
+            for field, val in fields.items():
+                *parents, name = field.split(".")
+                target = document
+                for key in parents:
+                    target = target.setdefault(key, {})
+                if op == "$set":
+                    target[name] = val
+                elif op == "$unset":
+                    target.pop(name, None)
+                elif op == "$inc":
+                    target[name] = target.get(name, 0) + val
+                else:
+                    raise NotImplementedError("update operator {} is not supported by the stand-in.".format(op))
+
+    def delete_one(self, filter: Dict) -> DeleteResult:
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter: Dict) -> DeleteResult:
+        return self._delete(filter, multi=True)
+
+    def _delete(self, filter: Dict, multi: bool) -> DeleteResult:
+        ids = [BSON(data).decode()["_id"] for data in itertools.islice(self._scan(filter), None if multi else 1)]
+        for _id in ids:
+            del self._documents[_id]
+            del self._index[bisect.bisect_left(self._index, (_type_rank(_id), _id))]
+        return DeleteResult({"n": len(ids)}, True)
+
+    def find(self, filter: Dict = None, projection: Dict = None, skip: int = 0, limit: int = 0,
+             sort: List[Tuple[str, int]] = None, batch_size: int = 0) -> _Cursor:
+        documents = self._scan(filter, sort)
+        documents = itertools.islice(documents, skip or 0, (skip or 0) + limit if limit else None)
+        return _Cursor(documents, projection, self.codec_options)
+
+    def find_one(self, filter: Dict = None, projection: Dict = None, sort: List[Tuple[str, int]] = None
+                 ) -> Optional[Dict]:
+        return next(self.find(filter, projection, limit=1, sort=sort), None)
+
+    def count_documents(self, filter: Dict, limit: int = 0) -> int:
+        count = sum(1 for _ in self._scan(filter)) if filter else len(self._documents)
+        return min(count, limit) if limit else count
+
+    def estimated_document_count(self, ) -> int:
+        return len(self._documents)
+
+    def aggregate(self, pipeline: List[Dict]) -> Iterator[Dict]:
+        """
+        聚合查询,只支持$match、$sample、$project、$sort、$skip、$limit、$count和$facet
+        Args:
+            pipeline: 聚合查询的pipeline
+        Returns:
+            返回聚合结果的迭代器
+        """
+        if pipeline and "$match" in pipeline[0]:
+            documents = list(_Cursor(self._scan(pipeline[0]["$match"])))
+            pipeline = pipeline[1:]
+        else:
+            documents = list(_Cursor(self._scan(None)))
+        return iter([_apply_codec(document, self.codec_options)
+                     for document in self._aggregate_stages(documents, pipeline)])
+
+    def _aggregate_stages(self, documents: List[Dict], pipeline: List[Dict]) -> List[Dict]:
+        """
+        在document列表上依次执行聚合的各个阶段
+        Args:
+            documents: 输入的document列表
+            pipeline: 聚合查询的pipeline
+        Returns:
+            返回聚合结果
+        """
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                documents = [document for document in documents if match(document, spec)]
+            elif name == "$sample":
+                documents = random.sample(documents, min(spec["size"], len(documents)))
+            elif name == "$project":
+                documents = [self._aggregate_project(document, spec) for document in documents]
+            elif name == "$sort":
+                documents = sorted(documents, key=lambda document: self._sort_key(document, list(spec.items())))
+            elif name == "$skip":
+                documents = documents[spec:]
+            elif name == "$limit":
+                documents = documents[:spec]
+            elif name == "$count":
+                documents = [{spec: len(documents)}] if documents else []
+            elif name == "$facet":
+                # 每个子pipeline都作用在同一份输入上,结果合并为一个document
+                documents = [{key: self._aggregate_stages(documents, val) for key, val in spec.items()}]
+            else:
+                raise NotImplementedError("stage {} is not supported by the stand-in.".format(name))
+        return documents
+
+    @staticmethod
+    def _aggregate_project(document: Dict, spec: Dict) -> Dict:
+        if not any(isinstance(val, str) for val in spec.values()):
+            return _project(document, spec)
+        result = {"_id": document["_id"]} if spec.get("_id", 1) and "_id" in document else {}
+        for key, val in spec.items():
+            if key == "_id":
+                continue
+            value = _get_field(document, val[1:]) if isinstance(val, str) else _get_field(document, key)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+    def drop(self, ):
+        self._documents.clear()
+        del self._index[:]
+
+
+class _Reversed(object):
+    """
+    降序排序的比较包装
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __lt__(self, other: '_Reversed') -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Reversed) and other.value == self.value
+
+
+class MemoryDatabase(object):
+    """
+    进程内的database,第一次访问collection时自动创建
+    """
+
+    def __init__(self, name: str = "benchmark"):
+        self.name: str = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def get_collection(self, name: str, **kwargs) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+    def drop_collection(self, name: str):
+        self._collections.pop(name, None)
+
+
+class _AsyncCursor(object):
+    """
+    和motor一样的异步游标
+    """
+
+    def __init__(self, cursor: Iterator[Dict]):
+        self._cursor: Iterator[Dict] = cursor
+        self.closed: bool = False
+
+    def __aiter__(self, ) -> AsyncIterator[Dict]:
+        return self
+
+    async def __anext__(self, ) -> Dict:
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self, ):
+        self.closed = True
+        self._cursor = iter(())
+
+
+class AsyncMemoryCollection(object):
+    """
+    进程内的collection的异步包装,和motor的collection接口一致
+    """
+
+    def __init__(self, collection: MemoryCollection):
+        self.collection: MemoryCollection = collection
+        self.name: str = collection.name
+
+    @property
+    def codec_options(self, ) -> CodecOptions:
+        return self.collection.codec_options
+
+    def with_options(self, codec_options: CodecOptions = None) -> 'AsyncMemoryCollection':
+        return AsyncMemoryCollection(self.collection.with_options(codec_options=codec_options))
+
+    async def insert_one(self, document: Dict) -> InsertOneResult:
+        return self.collection.insert_one(document)
+
+    async def insert_many(self, documents: List[Dict], ordered: bool = True) -> InsertManyResult:
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    async def update_one(self, filter: Dict, update: Dict, upsert: bool = False) -> UpdateResult:
+        return self.collection.update_one(filter, update, upsert=upsert)
+
+    async def update_many(self, filter: Dict, update: Dict, upsert: bool = False) -> UpdateResult:
+        return self.collection.update_many(filter, update, upsert=upsert)
+
+    async def delete_one(self, filter: Dict) -> DeleteResult:
+        return self.collection.delete_one(filter)
+
+    async def delete_many(self, filter: Dict) -> DeleteResult:
+        return self.collection.delete_many(filter)
+
+    def find(self, *args, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self.collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs) -> Optional[Dict]:
+        return self.collection.find_one(*args, **kwargs)
+
+    async def count_documents(self, filter: Dict, limit: int = 0) -> int:
+        return self.collection.count_documents(filter, limit=limit)
+
+    async def estimated_document_count(self, ) -> int:
+        return self.collection.estimated_document_count()
+
+    def aggregate(self, pipeline: List[Dict]) -> _AsyncCursor:
+        return _AsyncCursor(self.collection.aggregate(pipeline))
+
+    async def drop(self, ):
+        self.collection.drop()
+
+
+class AsyncMemoryDatabase(MemoryDatabase):
+    """
+    进程内的database的异步包装,和motor的database接口一致
+    """
+
+    def get_collection(self, name: str, **kwargs) -> AsyncMemoryCollection:  # type: ignore
+        return AsyncMemoryCollection(super().get_collection(name, **kwargs))
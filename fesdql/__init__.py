@@ -9,19 +9,22 @@
 
 from ._cachelru import *
 from ._fields import *
+from ._hooks import *
 from .utils import *
 from .query import *
 from .async_mongo import *
 from .sync_mongo import *
 
 __all__ = (
-    "LRI", "LRU",
+    "LRI", "LRU", "TTLLRI", "TTLLRU",
 
     "fields",
 
+    "OperationSpan", "current_span",
+
     "under2camel",
 
-    "Query",
+    "Query", "Param", "PreparedQuery",
 
     "AsyncMongo",
 
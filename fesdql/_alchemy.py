@@ -7,22 +7,40 @@
 @time: 2020/3/1 下午3:51
 """
 import atexit
+import base64
+import binascii
 import copy
+import datetime
+import time
 from math import ceil
-from typing import Dict, List, MutableMapping, MutableSequence, Optional, Sequence, Type, Union
+from typing import Any, Callable, Dict, List, MutableMapping, MutableSequence, Optional, Sequence, Tuple, Type, Union
 
-from bson import ObjectId
+import aelog
+from bson import ObjectId, json_util
 from bson.errors import BSONError
+from bson.raw_bson import RawBSONDocument
 from marshmallow import Schema
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
 from pymongo.database import Database
 
 from ._err_msg import mongo_msg
+from ._hooks import OperationHooks
+from ._monitor import EngineStats, OperationStats, WorkloadStats
 from .err import ConfigError, FuncArgsError
-from .query import Query
+from .query import Query, normalize_query_key
 from .utils import _verify_message, under2camel
 
 __all__ = ("BasePagination", "BaseMongo", "AlchemyMixIn", "SessionMixIn")
 
+# 并行扫描时每个分区的采样数量
+PARTITION_SAMPLE_SIZE = 20
+# 并行扫描时可以按范围分区的字段类型和对应的$type别名,bool是int的子类需要先判断
+PARTITION_TYPES: Tuple[Tuple[Any, str], ...] = (
+    (bool, "bool"), ((int, float), "number"), (str, "string"), (ObjectId, "objectId"), (datetime.datetime, "date"))
+# session.gather中可以并发执行的操作
+GATHER_OPERATIONS = ("find_one", "find_many", "find_all", "find_count", "aggregate", "insert_one", "insert_many",
+                     "update_one", "update_many", "delete_one", "delete_many", "bulk_write")
+
 
 # noinspection PyProtectedMember
 class BasePagination(object):
@@ -34,7 +52,7 @@ class BasePagination(object):
 
     """
 
-    def __init__(self, session, query: Query, total: int, items: List[Dict], query_key: Dict):
+    def __init__(self, session, query: Query, total: Optional[int], items: List[Dict], query_key: Dict):
         #: the unlimited query object that was used to create this
         #: aiomongoclient object.
         self.session = session
@@ -44,20 +62,31 @@ class BasePagination(object):
         self.page: int = query._page
         #: the number of items to be displayed on a page.
         self.per_page: int = query._per_page
-        #: the total number of items matching the query
-        self.total: int = total
+        #: the total number of items matching the query, None表示没有计算总数
+        self.total: Optional[int] = total
+        # 总数是否为近似值,比如估算的总数或者达到上限的计数
+        self.total_approximate: bool = False
         #: the items for the current page
         self.items: List[Dict] = items
         # query key
         self.query_key: Dict = query_key
         # exclude key
         self.exclude_key: Optional[Dict] = query._exclude_key
-        # sort key
-        self.sort: Optional[List] = query._order_by
+        # 是否返回RawBSONDocument, keyset分页和facet分页不支持
+        self.raw: bool = query._raw and not query._is_keyset and not query._use_facet
+        # keyset(seek) paginate
+        self.is_keyset: bool = query._is_keyset
+        # sort key, keyset分页时包含_id字段
+        self.sort: Optional[List] = SessionMixIn._keyset_sort(query._order_by) if self.is_keyset else query._order_by
+        # keyset分页时通过多查询一条数据确定是否有上一页和下一页
+        self._has_prev: Optional[bool] = None
+        self._has_next: Optional[bool] = None
 
     @property
-    def pages(self) -> int:
-        """The total number of pages"""
+    def pages(self) -> Optional[int]:
+        """The total number of pages, None if the total is unknown"""
+        if self.total is None:
+            return None
         if self.per_page == 0:
             pages = 0
         else:
@@ -74,12 +103,103 @@ class BasePagination(object):
     @property
     def has_prev(self) -> bool:
         """True if a previous page exists"""
+        if self._has_prev is not None:
+            return self._has_prev
         return self.page > 1
 
     @property
     def has_next(self) -> bool:
         """True if a next page exists."""
-        return self.page < self.pages
+        # offset分页的总数是精确值时根据当前的页数计算,翻页之后也不会过期
+        if not self.is_keyset and self.total is not None and not self.total_approximate:
+            return self.page < self.pages  # type: ignore
+        # 没有总数或者总数是近似值时由查询当前页时多查询的一条数据确定
+        if self._has_next is not None:
+            return self._has_next
+        if self.total is None:
+            return False
+        return self.page < self.pages  # type: ignore
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """keyset分页中下一页的游标, 用于Query.keyset_query(after=next_cursor)"""
+        if not self.is_keyset or not self.items or not self.has_next:
+            return None
+        return SessionMixIn._encode_keyset_cursor(self.items[-1], self.sort)  # type: ignore
+
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        """keyset分页中上一页的游标, 用于Query.keyset_query(before=prev_cursor)"""
+        if not self.is_keyset or not self.items or not self.has_prev:
+            return None
+        return SessionMixIn._encode_keyset_cursor(self.items[0], self.sort)  # type: ignore
+
+    def _seek_query_key(self, backward: bool = False) -> Optional[Dict]:
+        """
+        keyset分页中生成上一页或者下一页的范围查询条件
+        Args:
+            backward: True为上一页, False为下一页
+        Returns:
+            没有当前页的数据时返回None
+        """
+        if not self.items:
+            return None
+        doc = self.items[0] if backward else self.items[-1]
+        values = SessionMixIn._keyset_values(doc, self.sort)  # type: ignore
+        return SessionMixIn._keyset_query_key(self.query_key, self.sort, values, backward)  # type: ignore
+
+    def _seek_result(self, items: List[Dict], backward: bool = False) -> List[Dict]:
+        """
+        处理keyset分页查询的结果,查询时多查询了一条数据用于判断是否还有上一页或者下一页
+        Args:
+            items: 按照查询方向排序的结果
+            backward: True为上一页, False为下一页
+        Returns:
+            当前页的数据
+        """
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if backward:
+            items.reverse()
+            self._has_prev, self._has_next = has_more, True
+        else:
+            self._has_prev, self._has_next = True, has_more
+        if items:
+            self.items = items
+        return items
+
+    @property
+    def _offset_probe(self) -> bool:
+        """offset分页翻页时是否需要多查询一条数据判断是否还有下一页,没有总数或者总数是近似值时需要"""
+        return (self.total is None or self.total_approximate) and self.per_page > 0
+
+    @property
+    def _offset_limit(self) -> int:
+        """offset分页翻页时查询的数量"""
+        return self.per_page + 1 if self._offset_probe else self.per_page
+
+    def _offset_result(self, items: List[Dict]) -> List[Dict]:
+        """
+        处理offset分页翻页的查询结果,没有总数或者总数是近似值时根据多查询的一条数据更新是否还有下一页
+        Args:
+            items: 查询的结果
+        Returns:
+            当前页的数据
+        """
+        if self._offset_probe:
+            self._has_next = len(items) > self.per_page
+            del items[self.per_page:]
+        return items
+
+    def _seek_sort(self, backward: bool = False) -> List[Tuple[str, int]]:
+        """
+        keyset分页查询的排序方式,向前查询时所有字段反向排序
+        Args:
+            backward: True为向前查询, False为向后查询
+        Returns:
+
+        """
+        return [(field, -int(direction)) for field, direction in self.sort] if backward else self.sort  # type: ignore
 
     @property
     def next_num(self) -> Optional[int]:
@@ -112,10 +232,20 @@ class BaseMongo(object):
                                         "fesdql_mongo_passwd":"",
                                         "fesdql_mongo_dbname":"dbname",
                                         "fesdql_mongo_pool_size":10}}
+            count_cache_ttl: 分页总数缓存的过期时间,单位秒,默认0不缓存
+            count_cache_size: 每个session中分页总数缓存的最大数量
+            result_cache_size: 每个session中查询结果缓存的最大数量, 通过Query.cache开启缓存
+            convert_id: 是否把查询结果中的_id转换为字符串类型的id,默认True,False时document保持mongo返回的_id
+            buffer_max_size: 异步session缓冲插入时每个collection缓冲的最大document数量,达到后立即写入
+            buffer_flush_interval: 异步session缓冲插入时的最长等待时间,单位秒
+            single_flight: 异步session中相同的并发查询是否合并为一次查询,默认False
+            slow_query_ms: 慢查询的阈值,单位毫秒,耗时超过阈值的操作记录日志,默认0不记录
+            workload_size: 负载统计中最多保存的查询结构数量,默认0不统计,每个操作都要生成查询结构的指纹,需要时再开启
 
         """
         self.app = app
         self.engine_pool: Dict = {}  # engine pool
+        self.engine_stats: Dict[str, EngineStats] = {}  # engine monitoring stats
         self.bind_pool: Dict = {}  # bind engine pool
         self.session_pool: Dict = {}  # session pool
         # default bind connection
@@ -130,6 +260,19 @@ class BaseMongo(object):
         self.message: Dict = kwargs.get("message", {})
         self.use_zh: bool = kwargs.get("use_zh", True)
         self.max_per_page: Optional[int] = kwargs.get("max_per_page", None)
+        self.count_cache_ttl: float = kwargs.get("count_cache_ttl", 0)
+        self.count_cache_size: int = kwargs.get("count_cache_size", 1024)
+        self.result_cache_size: int = kwargs.get("result_cache_size", 1024)
+        self.convert_id: bool = kwargs.get("convert_id", True)
+        self.buffer_max_size: int = kwargs.get("buffer_max_size", 500)
+        self.buffer_flush_interval: float = kwargs.get("buffer_flush_interval", 0.05)
+        self.single_flight: bool = kwargs.get("single_flight", False)
+        self.slow_query_ms: float = kwargs.get("slow_query_ms", 0)
+        self.operation_stats: OperationStats = OperationStats()  # session operation latency
+        self.workload_size: int = kwargs.get("workload_size", 0)
+        self.workload_stats: Optional[WorkloadStats] = WorkloadStats(
+            self.workload_size) if self.workload_size > 0 else None  # query shape workload
+        self.hooks: OperationHooks = OperationHooks()  # session operation hooks
         self.msg_zh: str = ""
 
         if app is not None:
@@ -149,6 +292,8 @@ class BaseMongo(object):
             username: mongo user
             passwd: mongo password
             pool_size: mongo pool size
+            kwargs: 其他配置,没有传入时读取app的config中FESDQL_MONGO_加上大写参数名的配置项,
+                    eg: count_cache_ttl对应FESDQL_MONGO_COUNT_CACHE_TTL
         Returns:
 
         """
@@ -174,6 +319,24 @@ class BaseMongo(object):
         self.message = _verify_message(mongo_msg, message)
         self.msg_zh = "msg_zh" if use_zh else "msg_en"
         self.max_per_page = kwargs.get("max_per_page", None) or self.max_per_page
+        self.count_cache_ttl = kwargs.get("count_cache_ttl", None) or config.get(
+            "FESDQL_MONGO_COUNT_CACHE_TTL") or self.count_cache_ttl
+        self.count_cache_size = kwargs.get("count_cache_size", None) or config.get(
+            "FESDQL_MONGO_COUNT_CACHE_SIZE") or self.count_cache_size
+        self.result_cache_size = kwargs.get("result_cache_size", None) or config.get(
+            "FESDQL_MONGO_RESULT_CACHE_SIZE") or self.result_cache_size
+        self.convert_id = kwargs.get("convert_id", config.get("FESDQL_MONGO_CONVERT_ID", self.convert_id))
+        self.buffer_max_size = kwargs.get("buffer_max_size", None) or config.get(
+            "FESDQL_MONGO_BUFFER_MAX_SIZE") or self.buffer_max_size
+        self.buffer_flush_interval = kwargs.get("buffer_flush_interval", None) or config.get(
+            "FESDQL_MONGO_BUFFER_FLUSH_INTERVAL") or self.buffer_flush_interval
+        # 配置为False或者0时也要生效,不能使用or取值
+        self.single_flight = kwargs.get("single_flight", config.get("FESDQL_MONGO_SINGLE_FLIGHT", self.single_flight))
+        self.slow_query_ms = kwargs.get("slow_query_ms", config.get("FESDQL_MONGO_SLOW_QUERY_MS", self.slow_query_ms))
+        workload_size = kwargs.get("workload_size", config.get("FESDQL_MONGO_WORKLOAD_SIZE", self.workload_size))
+        if workload_size != self.workload_size:
+            self.workload_size = workload_size
+            self.workload_stats = WorkloadStats(self.workload_size) if self.workload_size > 0 else None
 
     # noinspection DuplicatedCode
     def init_engine(self, *, username: str = None, passwd: str = None, host: str = None, port: int = None,
@@ -207,6 +370,17 @@ class BaseMongo(object):
         self.message = _verify_message(mongo_msg, message)
         self.msg_zh = "msg_zh" if use_zh else "msg_en"
         self.max_per_page = kwargs.get("max_per_page", None) or self.max_per_page
+        self.count_cache_ttl = kwargs.get("count_cache_ttl", None) or self.count_cache_ttl
+        self.count_cache_size = kwargs.get("count_cache_size", None) or self.count_cache_size
+        self.result_cache_size = kwargs.get("result_cache_size", None) or self.result_cache_size
+        self.convert_id = kwargs.get("convert_id", self.convert_id)
+        self.buffer_max_size = kwargs.get("buffer_max_size", None) or self.buffer_max_size
+        self.buffer_flush_interval = kwargs.get("buffer_flush_interval", None) or self.buffer_flush_interval
+        self.single_flight = kwargs.get("single_flight", self.single_flight)
+        self.slow_query_ms = kwargs.get("slow_query_ms", self.slow_query_ms)
+        if kwargs.get("workload_size", self.workload_size) != self.workload_size:
+            self.workload_size = kwargs["workload_size"]
+            self.workload_stats = WorkloadStats(self.workload_size) if self.workload_size > 0 else None
 
         # 创建默认的连接
         self.bind_pool[None] = self._create_engine(
@@ -230,6 +404,98 @@ class BaseMongo(object):
                        dbname: str) -> Database:
         raise NotImplementedError
 
+    def _session_options(self, bind: str = None) -> Dict:
+        """
+        生成session时使用的配置
+        Args:
+            bind: engine pool one of connection
+        Returns:
+
+        """
+        pool_size = self.pool_size if bind is None else (
+            self.fesdql_binds[bind].get("fesdql_mongo_pool_size") or self.pool_size)
+        return {"pool_size": pool_size, "count_cache_ttl": self.count_cache_ttl,
+                "count_cache_size": self.count_cache_size, "result_cache_size": self.result_cache_size,
+                "convert_id": self.convert_id, "bind": bind, "operation_stats": self.operation_stats,
+                "slow_query_ms": self.slow_query_ms,
+                "workload_stats": self.workload_stats, "hooks": self.hooks}
+
+    def _engine_listeners(self, engine_name: str) -> List:
+        """
+        生成engine的监控监听器,每个engine一份监控数据
+        Args:
+            engine_name: engine的名称
+        Returns:
+
+        """
+        if engine_name not in self.engine_stats:
+            self.engine_stats[engine_name] = EngineStats()
+        return self.engine_stats[engine_name].listeners()
+
+    def stats(self, reset: bool = False) -> Dict[str, Dict]:
+        """
+        每个engine的监控数据快照,包括命令的次数和耗时,连接池的获取等待和使用情况以及心跳
+        Args:
+            reset: 获取快照后是否清空监控数据
+        Returns:
+            返回engine名称和监控数据快照的dict
+        """
+        snapshot = {}
+        for engine_name, engine_stats in self.engine_stats.items():
+            snapshot[engine_name] = engine_stats.snapshot()
+            if reset:
+                engine_stats.reset()
+        return snapshot
+
+    def latency_stats(self, reset: bool = False) -> List[Dict]:
+        """
+        所有session中每个bind、collection和操作的耗时直方图快照,包括p50、p90和p99
+        Args:
+            reset: 获取快照后是否清空耗时数据
+        Returns:
+            返回每个(bind, collection, 操作)的耗时统计列表
+        """
+        return self.operation_stats.snapshot(reset)
+
+    def workload_report(self, top: int = 10, order_by: str = "total_ms", reset: bool = False) -> List[Dict]:
+        """
+        按照查询结构汇总的负载报告,查询条件中的值替换为占位符,相同结构的查询累计次数、耗时和返回的document数量,
+        负载统计默认关闭,通过workload_size开启
+        Args:
+            top: 返回的查询结构数量, 0表示返回所有的查询结构
+            order_by: 排序的字段, total_ms, count, docs, avg_ms或者max_ms
+            reset: 获取报告后是否清空统计数据
+        Returns:
+            返回按照开销从大到小排列的查询结构和累计数据的列表
+        """
+        return self.workload_stats.report(top, order_by, reset) if self.workload_stats is not None else []
+
+    def add_hook(self, before: Callable = None, after: Callable = None) -> int:
+        """
+        注册session操作的钩子,所有session的每个操作(find_one, find_many, aggregate, insert_one, update_many等)都会调用
+
+        钩子只接收一个OperationSpan参数,包括operation、cname、bind、处理后的query_key、sort和exclude_key,
+        after钩子中还可以获取duration(毫秒)、docs(返回的document数量)和error(操作抛出的异常),
+        span.data用于在before和after之间传递数据, span.parent和span.trace_id用于关联嵌套的操作,
+        AsyncMongo中的钩子可以是协程函数,钩子中的异常只记录日志,没有注册钩子时不会有额外的开销
+        Args:
+            before: 操作开始前调用的钩子, eg: def before(span: OperationSpan)
+            after: 操作结束后调用的钩子, eg: def after(span: OperationSpan)
+        Returns:
+            返回钩子的id,用于删除钩子
+        """
+        return self.hooks.add(before, after)
+
+    def remove_hook(self, hook_id: int) -> bool:
+        """
+        删除session操作的钩子
+        Args:
+            hook_id: add_hook返回的id
+        Returns:
+            返回是否删除成功
+        """
+        return self.hooks.remove(hook_id)
+
     def _get_engine(self, bind: str):
         """
         session bind
@@ -405,6 +671,192 @@ class SessionMixIn(object):
     session minin
     """
 
+    def _record_operation(self, operation: str, cname: str, started: float, query_key: Any = None,
+                          sort: Any = None, exclude_key: Dict = None, docs: int = 0):
+        """
+        记录一次操作的耗时和查询结构的负载,耗时超过慢查询阈值时记录查询条件
+        Args:
+            operation: 操作名称, eg: find_one, update_many
+            cname: collection name
+            started: 操作开始时time.perf_counter()的值
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+            docs: 返回的document数量
+        Returns:
+
+        """
+        duration = (time.perf_counter() - started) * 1000
+        if self.operation_stats is not None:  # type: ignore
+            self.operation_stats.record(self.bind, cname, operation, duration)  # type: ignore
+        if self.workload_stats is not None:  # type: ignore
+            self.workload_stats.record(cname, operation, duration, docs, query_key, sort, exclude_key)  # type: ignore
+        if self.slow_query_ms and duration >= self.slow_query_ms:  # type: ignore
+            aelog.warning("Slow query {:.3f}ms, bind={} cname={} operation={} filter={} sort={} projection={}".format(
+                duration, self.bind, cname, operation, query_key, sort, exclude_key))  # type: ignore
+
+    def _get_collection(self, cname: str, raw: bool = False):
+        """
+        获取collection
+        Args:
+            cname: collection name
+            raw: 是否使用RawBSONDocument作为document_class,其他的CodecOptions保持collection原有的配置
+        Returns:
+            返回collection
+        """
+        collection = self.db.get_collection(cname)  # type: ignore
+        if raw:
+            collection = collection.with_options(
+                codec_options=collection.codec_options.with_options(document_class=RawBSONDocument))
+        return collection
+
+    def _convert_id(self, document: Dict, to_str: bool = True) -> Dict:
+        """
+        把查询结果中的_id转换为id
+        Args:
+            document: 查询返回的document
+            to_str: 是否把_id转换为字符串
+        Returns:
+            返回处理后的document
+        """
+        if self.convert_id and document.get("_id") is not None:  # type: ignore
+            _id = document.pop("_id")
+            document["id"] = str(_id) if to_str else _id
+        return document
+
+    def _convert_ids(self, documents: List[Dict], to_str: bool = True, exclude_key: Dict = None) -> List[Dict]:
+        """
+        批量把查询结果中的_id转换为id,session的convert_id为False或者投影中排除了_id时document不做任何处理
+        Args:
+            documents: 查询返回的document列表
+            to_str: 是否把_id转换为字符串
+            exclude_key: 查询时使用的投影,投影中排除了_id时返回的document中没有_id,不需要逐条处理
+        Returns:
+            返回处理后的document列表
+        """
+        if not self.convert_id or (exclude_key and not exclude_key.get("_id", True)):  # type: ignore
+            return documents
+        for document in documents:
+            _id = document.get("_id")
+            if _id is not None:
+                del document["_id"]
+                document["id"] = str(_id) if to_str else _id
+        return documents
+
+    def _cache_key(self, cname: str, *parts) -> str:
+        """
+        生成缓存的key,key中包含collection的写入版本号,写入数据后该collection旧的缓存就不会再被命中
+        Args:
+            cname: collection name
+            parts: 处理后的查询条件等组成key的部分
+        Returns:
+            返回缓存的key
+        """
+        return json_util.dumps([cname, self._cname_version.get(cname, 0), *parts], sort_keys=True)
+
+    def _invalidate_cache(self, cname: str):
+        """
+        session写入collection后使该collection的缓存失效
+        Args:
+            cname: collection name
+        Returns:
+
+        """
+        self._cname_version[cname] = self._cname_version.get(cname, 0) + 1
+
+    def _get_result_cache(self, cache_key: str) -> Optional[Tuple[Any]]:
+        """
+        获取缓存的查询结果
+        Args:
+            cache_key: 缓存的key
+        Returns:
+            返回(查询结果,),没有缓存或者已过期时返回None,查询结果本身可能为None
+        """
+        cached = self._result_cache.get(cache_key)
+        return None if cached is None else (self._copy_result(cached[0]),)
+
+    def _set_result_cache(self, cache_key: str, result: Any, ttl: float):
+        """
+        缓存查询结果
+        Args:
+            cache_key: 缓存的key
+            result: 查询结果
+            ttl: 过期时间,单位秒
+        Returns:
+
+        """
+        self._result_cache.set(cache_key, (self._copy_result(result),), ttl=ttl)
+
+    @staticmethod
+    def _copy_result(result: Any) -> Any:
+        """
+        复制查询结果,缓存中的document和返回给调用方的document互不影响,这里只复制到document这一层
+        Args:
+            result: document, document列表或者包含它们的元组
+        Returns:
+            返回复制后的查询结果
+        """
+        if isinstance(result, dict):
+            return dict(result)
+        if isinstance(result, list):
+            return [dict(doc) if isinstance(doc, dict) else doc for doc in result]
+        if isinstance(result, tuple):
+            return tuple(SessionMixIn._copy_result(val) for val in result)
+        return result
+
+    def _gen_bulk_requests(self, bulk_ops: List[Tuple[str, Dict]], chunk_size: int = 1000) -> List[List]:
+        """
+        把Query中的bulk操作转换为pymongo的bulk write请求,并且按照操作数量分块
+
+        每块的消息大小不需要在这里计算,pymongo会按照服务端的maxMessageSizeBytes和maxWriteBatchSize拆分
+        Args:
+            bulk_ops: Query中的bulk操作列表
+            chunk_size: 每块最多的操作数量
+        Returns:
+            返回分块后的请求列表
+        """
+        requests: List = []
+        for op_name, op in bulk_ops:
+            if op_name == "insert_one":
+                document = self._update_doc_id(op["document"])
+                requests.append(InsertOne(document))
+            elif op_name in ("update_one", "update_many"):
+                query_key = self._update_query_key(op["query_key"])
+                update_data = self._update_update_data(dict(op["update_data"]))
+                request_cls = UpdateOne if op_name == "update_one" else UpdateMany
+                requests.append(request_cls(query_key, update_data, upsert=op["upsert"]))
+            elif op_name == "replace_one":
+                query_key, document = self._update_query_key(op["query_key"]), self._update_doc_id(op["document"])
+                requests.append(ReplaceOne(query_key, document, upsert=op["upsert"]))
+            elif op_name in ("delete_one", "delete_many"):
+                query_key = self._update_query_key(op["query_key"])
+                requests.append((DeleteOne if op_name == "delete_one" else DeleteMany)(query_key))
+            else:
+                raise FuncArgsError(f"bulk operation {op_name} is not supported.")
+        return [requests[i:i + chunk_size] for i in range(0, len(requests), chunk_size)]
+
+    @staticmethod
+    def _merge_bulk_result(summary: Dict, bulk_api_result: Dict, offset: int):
+        """
+        把一个分块的bulk write结果合并到汇总结果中
+        Args:
+            summary: 汇总结果
+            bulk_api_result: 分块的结果, BulkWriteResult.bulk_api_result或者BulkWriteError.details
+            offset: 分块中第一个操作在所有操作中的位置
+        Returns:
+
+        """
+        summary["inserted_count"] += bulk_api_result.get("nInserted", 0)
+        summary["matched_count"] += bulk_api_result.get("nMatched", 0)
+        summary["modified_count"] += bulk_api_result.get("nModified", 0)
+        summary["deleted_count"] += bulk_api_result.get("nRemoved", 0)
+        summary["upserted_count"] += bulk_api_result.get("nUpserted", 0)
+        for upserted in bulk_api_result.get("upserted", []):
+            summary["upserted_id"][upserted["index"] + offset] = str(upserted["_id"])
+        for write_error in bulk_api_result.get("writeErrors", []):
+            summary["write_errors"].append({"index": write_error["index"] + offset, "code": write_error.get("code"),
+                                            "errmsg": write_error.get("errmsg")})
+
     @staticmethod
     def _update_update_data(update_data: Dict) -> Dict:
         """
@@ -419,7 +871,8 @@ class SessionMixIn(object):
         if len(update_data) > 1:
             update_data = {"$set": update_data}
         else:
-            operator, doc = update_data.popitem()
+            # 不能使用popitem,调用方的update data可能会被多次使用
+            operator, doc = next(iter(update_data.items()))
             pre_flag = operator.startswith("$")
             update_data = {"$set" if not pre_flag else operator: {operator: doc} if not pre_flag else doc}
         return update_data
@@ -433,23 +886,233 @@ class SessionMixIn(object):
         Returns:
             返回处理后的query key
         """
-        query_key = dict(query_key) if query_key else {}
-        try:
-            for key, val in query_key.items():
-                if isinstance(val, MutableMapping):
-                    if key != "id":
-                        query_key[key] = {key if key.startswith("$") else f"${key}": val for key, val in val.items()}
-                    else:
-                        query_key["_id"] = {
-                            key if key.startswith("$") else f"${key}": [ObjectId(val) for val in val]
-                            if "in" in key else val for key, val in query_key.pop(key).items()}
-                else:
-                    if key == "id":
-                        query_key["_id"] = ObjectId(query_key.pop("id"))
-        except BSONError as e:
-            raise FuncArgsError(str(e))
+        return normalize_query_key(query_key)
+
+    def _gen_query_key(self, query: Query) -> Dict:
+        """
+        生成查询的query key,预编译查询绑定参数后的query key已经处理过,不再重复处理
+        Args:
+            query: Query class
+        Returns:
+            返回处理后的query key
+        """
+        return query._query_key if query._normalized else self._update_query_key(query._query_key)  # type: ignore
+
+    def _gather_operations(self, queries: Sequence[Tuple[str, Query]]) -> List[Tuple[Any, Query]]:
+        """
+        校验gather中的操作并获取对应的session方法
+        Args:
+            queries: (操作名称, Query)的列表, eg: [("find_count", query1), ("find_many", query2)]
+        Returns:
+            返回(session方法, Query)的列表
+        """
+        operations = []
+        for operation, query in queries:
+            if operation not in GATHER_OPERATIONS:
+                raise FuncArgsError("operation must be one of {}.".format(", ".join(GATHER_OPERATIONS)))
+            operations.append((getattr(self, operation), query))
+        return operations
+
+    @staticmethod
+    def _partition_pipline(query_key: Dict, field: str, partitions: int) -> List[Dict]:
+        """
+        生成对分区字段采样的聚合pipeline
+
+        只有$sample是pipeline的第一个stage时mongo才使用随机游标,不需要扫描全部的document;有查询条件时$match在$sample之前,
+        mongo会扫描并随机排序所有匹配的document,所以有查询条件时优先使用_partition_range_samples插值,无法插值时才使用
+        Args:
+            query_key: 处理后的查询document的过滤条件
+            field: 分区的字段,最好是有索引的字段
+            partitions: 分区的数量
+        Returns:
+            返回采样的pipeline
+        """
+        pipline: List[Dict] = [{"$match": query_key}] if query_key else []
+        pipline.append({"$sample": {"size": partitions * PARTITION_SAMPLE_SIZE}})
+        pipline.append({"$project": {"_id": 0, "value": f"${field}"}})
+        return pipline
+
+    @staticmethod
+    def _partition_type(value: Any) -> Optional[str]:
+        """
+        获取可以按范围分区的字段值的$type别名
+        Args:
+            value: 字段的值
+        Returns:
+            返回$type别名,不能按范围分区时返回None
+        """
+        for types, alias in PARTITION_TYPES:
+            if isinstance(value, types):
+                return alias
+        return None
+
+    @staticmethod
+    def _interpolate_partition_samples(low: Any, high: Any, partitions: int) -> Optional[List[Dict]]:
+        """
+        在分区字段的最小值和最大值之间均匀插值,生成和采样结果格式相同的数据,只支持数值、日期和ObjectId
+        Args:
+            low: 分区字段的最小值
+            high: 分区字段的最大值
+            partitions: 分区的数量
+        Returns:
+            返回插值的结果,不支持的类型返回None
+        """
+        alias = SessionMixIn._partition_type(low)
+        if alias is None or alias != SessionMixIn._partition_type(high):
+            return None
+        if alias == "objectId":
+            start, end = low.generation_time, high.generation_time
+            values = [ObjectId.from_datetime(start + (end - start) * index / partitions) for index in range(partitions)]
+        elif alias == "date":
+            values = [low + (high - low) * index / partitions for index in range(partitions)]
+        elif alias == "number" and isinstance(low, int) and isinstance(high, int):
+            values = [low + (high - low) * index // partitions for index in range(partitions)]
+        elif alias == "number":
+            values = [low + (high - low) * index / partitions for index in range(partitions)]
         else:
-            return query_key
+            return None
+        return [{"value": value} for value in values]
+
+    @staticmethod
+    def _partition_query_keys(query_key: Dict, field: str, samples: List[Dict], partitions: int) -> List[Dict]:
+        """
+        根据采样的值把查询按照字段的范围拆分为多个分区的查询条件
+
+        mongo的范围查询只匹配同一种BSON类型的值,因此只对采样中最多的一种类型按范围分区,分区为左闭右开的范围,
+        字段为其他类型、null或者不存在的document通过$type排除条件全部分配到第一个分区,这样每个document都只属于一个分区
+        Args:
+            query_key: 处理后的查询document的过滤条件
+            field: 分区的字段
+            samples: 采样的结果
+            partitions: 分区的数量
+        Returns:
+            返回每个分区的查询条件
+        """
+        typed_values: Dict[str, List[Any]] = {}
+        for sample in samples:
+            value = sample.get("value")
+            value_alias = SessionMixIn._partition_type(value)
+            if value_alias is not None:
+                typed_values.setdefault(value_alias, []).append(value)
+        if not typed_values:
+            return [query_key]
+        alias, values = max(typed_values.items(), key=lambda item: len(item[1]))
+        values.sort()
+
+        bounds: List[Any] = []
+        for index in range(1, partitions):
+            bound = values[len(values) * index // partitions]
+            if not bounds or bound > bounds[-1]:
+                bounds.append(bound)
+        if not bounds:
+            return [query_key]
+
+        range_keys: List[Dict] = [{"$or": [{field: {"$lt": bounds[0]}}, {field: {"$not": {"$type": alias}}}]}]
+        for low, high in zip(bounds, bounds[1:]):
+            range_keys.append({field: {"$gte": low, "$lt": high}})
+        range_keys.append({field: {"$gte": bounds[-1]}})
+        return [{"$and": [query_key, range_key]} if query_key else range_key for range_key in range_keys]
+
+    @staticmethod
+    def _keyset_sort(order_by: Optional[List[Tuple[str, int]]]) -> List[Tuple[str, int]]:
+        """
+        keyset分页的排序方式,排序字段最后需要加上唯一的_id来保证顺序稳定
+        Args:
+            order_by: 排序方式, eg:[('field1', pymongo.ASCENDING)]
+        Returns:
+            返回包含_id的排序方式
+        """
+        sort = list(order_by) if order_by else []
+        if all(field != "_id" for field, _ in sort):
+            sort.append(("_id", 1))
+        return sort
+
+    @staticmethod
+    def _keyset_values(document: Dict, sort: List[Tuple[str, int]]) -> List[Any]:
+        """
+        从document中获取keyset分页排序字段的值
+        Args:
+            document: 查询返回的document, _id可能已经转换为id
+            sort: keyset分页的排序方式
+        Returns:
+            返回排序字段的值列表
+        """
+        values = []
+        for field, _ in sort:
+            if field == "_id":
+                val = document["id"] if "id" in document else document.get("_id")
+                # 查询结果中的_id可能已经转换为字符串,这里需要还原
+                values.append(ObjectId(val) if isinstance(val, str) and ObjectId.is_valid(val) else val)
+                continue
+            val = document
+            for key in field.split("."):
+                val = val.get(key) if isinstance(val, MutableMapping) else None
+            values.append(val)
+        return values
+
+    @staticmethod
+    def _keyset_query_key(query_key: Dict, sort: List[Tuple[str, int]], values: List[Any],
+                          backward: bool = False) -> Dict:
+        """
+        生成keyset分页的范围查询条件
+
+        eg: sort为[(a, 1), (_id, 1)]时生成 {"$or": [{a: {"$gt": va}}, {a: va, _id: {"$gt": vid}}]}
+
+        mongo排序时null和不存在的字段排在最前面,但是范围查询只匹配同一种类型的值,所以游标中的值为null时,
+        大于null使用{"$ne": None},没有比null小的值;游标中的值不为null时,小于该值还要包含值为null的document
+        Args:
+            query_key: 查询document的过滤条件
+            sort: keyset分页的排序方式
+            values: 游标中排序字段的值
+            backward: True为向前查询, False为向后查询
+        Returns:
+            返回合并后的查询条件
+        """
+        if len(values) != len(sort):
+            raise FuncArgsError("keyset cursor does not match the order_by of query.")
+        or_clauses = []
+        for index, (field, direction) in enumerate(sort):
+            clause = {sort[i][0]: values[i] for i in range(index)}
+            value = values[index]
+            if (int(direction) > 0) is not backward:
+                clause[field] = {"$ne": None} if value is None else {"$gt": value}
+            elif value is None:
+                continue
+            else:
+                clause["$or"] = [{field: {"$lt": value}}, {field: None}]
+            or_clauses.append(clause)
+        seek_key = {"$or": or_clauses}
+        return {"$and": [query_key, seek_key]} if query_key else seek_key
+
+    @staticmethod
+    def _encode_keyset_cursor(document: Dict, sort: List[Tuple[str, int]]) -> str:
+        """
+        根据document生成keyset分页的游标
+        Args:
+            document: 查询返回的document
+            sort: keyset分页的排序方式
+        Returns:
+            返回base64编码的游标字符串
+        """
+        values = SessionMixIn._keyset_values(document, sort)
+        return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+    @staticmethod
+    def _decode_keyset_cursor(cursor: str) -> List[Any]:
+        """
+        解析keyset分页的游标
+        Args:
+            cursor: base64编码的游标字符串
+        Returns:
+            返回排序字段的值列表
+        """
+        try:
+            values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+            raise FuncArgsError(f"invalid keyset cursor {cursor}, {e}")
+        if not isinstance(values, list):
+            raise FuncArgsError(f"invalid keyset cursor {cursor}")
+        return values
 
     @staticmethod
     def _update_doc_id(document: Dict) -> Dict:
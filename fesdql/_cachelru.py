@@ -8,6 +8,8 @@
 
   * :class:`LRI` - Least-recently inserted
   * :class:`LRU` - Least-recently used
+  * :class:`TTLLRI` - Least-recently inserted with time-to-live expiry
+  * :class:`TTLLRU` - Least-recently used with time-to-live expiry
 
   * ``hit_count`` - the number of times the queried key has been in
     the cache
@@ -18,10 +20,17 @@
     :meth:`dict.get` and :meth:`dict.setdefault`. Soft misses are a
     subset of misses, so this number is always less than or equal to
     ``miss_count``.
+  * ``expired_count`` - the number of keys which have been removed
+    because their time-to-live has passed (TTL caches only). Expired
+    keys which are looked up also count as misses.
 
 由boltons库的cacheutils改造
 """
 
+import heapq
+import itertools
+import time
+
 try:
     from threading import RLock
 except ImportError:
@@ -44,10 +53,11 @@ except ImportError:
     _MISSING = object()
     _KWARG_MARK = object()
 
-__all__ = ("LRI", "LRU")
+__all__ = ("LRI", "LRU", "TTLLRI", "TTLLRU")
 
 PREV, NEXT, KEY, VALUE = range(4)  # names for the link fields
 DEFAULT_MAX_SIZE = 128
+DEFAULT_SWEEP_SIZE = 8
 
 
 class LRI(dict):
@@ -326,3 +336,171 @@ class LRU(LRI):
 
             self.hit_count += 1
             return link[VALUE]
+
+
+class _TTLMixIn(object):
+    """Mixin which adds time-to-live expiry to :class:`LRI` and :class:`LRU`.
+
+    Every key may carry an expiry time, taken from *default_ttl* or from
+    the *ttl* passed to :meth:`set`. Expired keys are removed lazily when
+    they are accessed, and every write also sweeps at most *sweep_size*
+    expired keys in expiry order, so no background thread is needed.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, values=None, on_miss=None,
+                 default_ttl=None, sweep_size=DEFAULT_SWEEP_SIZE):
+        if default_ttl is not None and default_ttl <= 0:
+            raise ValueError('expected default_ttl > 0 or None, not %r' % default_ttl)
+        self.default_ttl = default_ttl
+        self.sweep_size = sweep_size
+        self.expired_count = 0
+        # key -> monotonic expiry time, keys without ttl are absent
+        self._expire_at = {}
+        # heap of (expiry time, sequence, key), may hold stale entries
+        self._expire_heap = []
+        self._sequence = itertools.count()
+        super().__init__(max_size=max_size, values=values, on_miss=on_miss)
+
+    def _set_key_and_evict_last_in_ll(self, key, value):
+        evicted = super()._set_key_and_evict_last_in_ll(key, value)
+        self._expire_at.pop(evicted, None)
+        return evicted
+
+    def _is_expired(self, key, now=None):
+        expire_at = self._expire_at.get(key)
+        return expire_at is not None and expire_at <= (time.monotonic() if now is None else now)
+
+    def _expire(self, key):
+        self.expired_count += 1
+        self.__delitem__(key)
+
+    def sweep(self, max_count=None):
+        """Remove up to *max_count* expired keys (all of them if ``None``)
+        and return the number of keys removed."""
+        with self._lock:
+            now = time.monotonic()
+            heap, removed = self._expire_heap, 0
+            while heap and heap[0][0] <= now and (max_count is None or removed < max_count):
+                expire_at, _, key = heapq.heappop(heap)
+                # entries of keys that were reset or deleted are stale
+                if self._expire_at.get(key) == expire_at:
+                    self._expire(key)
+                    removed += 1
+            # keep the heap from growing with stale entries of updated keys
+            if len(heap) > 2 * self.max_size + self.sweep_size:
+                self._expire_heap = heap = [(expire_at, next(self._sequence), key)
+                                            for key, expire_at in self._expire_at.items()]
+                heapq.heapify(heap)
+            return removed
+
+    def set(self, key, value, ttl=_MISSING):
+        """Set *key* to *value*, expiring after *ttl* seconds. *ttl*
+        defaults to ``default_ttl``; ``None`` means the key never expires."""
+        if ttl is _MISSING:
+            ttl = self.default_ttl
+        with self._lock:
+            self.sweep(self.sweep_size)
+            super().__setitem__(key, value)
+            if ttl is None:
+                self._expire_at.pop(key, None)
+            else:
+                expire_at = self._expire_at[key] = time.monotonic() + ttl
+                heapq.heappush(self._expire_heap, (expire_at, next(self._sequence), key))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if self._is_expired(key):
+                self._expire(key)
+            return super().__getitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            if not super().__contains__(key):
+                return False
+            if self._is_expired(key):
+                self._expire(key)
+                return False
+            return True
+
+    def ttl(self, key):
+        """Return the remaining seconds before *key* expires, ``None`` if
+        it never expires. Raises :exc:`KeyError` for absent keys."""
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            expire_at = self._expire_at.get(key)
+            return None if expire_at is None else max(expire_at - time.monotonic(), 0)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._expire_at.pop(key, None)
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            if self._is_expired(key):
+                self._expire(key)
+            ret = super().pop(key, default)
+            self._expire_at.pop(key, None)
+            return ret
+
+    def popitem(self):
+        with self._lock:
+            item = super().popitem()
+            self._expire_at.pop(item[0], None)
+            return item
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._expire_at.clear()
+            self._expire_heap = []
+
+    def copy(self):
+        return self.__class__(max_size=self.max_size, values=self, on_miss=self.on_miss,
+                              default_ttl=self.default_ttl, sweep_size=self.sweep_size)
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        val_map = dict.__repr__(self)
+        return ('%s(max_size=%r, default_ttl=%r, on_miss=%r, values=%s)'
+                % (cn, self.max_size, self.default_ttl, self.on_miss, val_map))
+
+
+class TTLLRI(_TTLMixIn, LRI):
+    """The ``TTLLRI`` is a :class:`LRI` whose keys also expire after a
+    time-to-live, with the same ``hit_count``, ``miss_count`` and
+    ``soft_miss_count`` statistics plus ``expired_count``.
+
+    Args:
+        max_size (int): Max number of items to cache. Defaults to ``128``.
+        values (iterable): Initial values for the cache. Defaults to ``None``.
+        on_miss (callable): a callable which accepts a single argument, the
+            key not present in the cache, and returns the value to be cached.
+        default_ttl (float): Seconds before a key expires. Defaults to
+            ``None``, keys never expire unless a ttl is passed to :meth:`set`.
+        sweep_size (int): Max number of expired keys removed on every write.
+
+    >>> cap_cache = TTLLRI(max_size=2, default_ttl=60)
+    >>> cap_cache['a'] = 'A'
+    >>> cap_cache.set('b', 'B', ttl=0)
+    >>> print(cap_cache.get('b'))
+    None
+    >>> cap_cache['a'], cap_cache.expired_count
+    ('A', 1)
+    """
+
+
+class TTLLRU(_TTLMixIn, LRU):
+    """The ``TTLLRU`` is a :class:`LRU` whose keys also expire after a
+    time-to-live, see :class:`TTLLRI` for the arguments.
+
+    >>> cap_cache = TTLLRU(max_size=2, default_ttl=60)
+    >>> cap_cache['a'], cap_cache['b'] = 'A', 'B'
+    >>> cap_cache.set('c', 'C', ttl=None)
+    >>> sorted(cap_cache), cap_cache.ttl('c')
+    (['b', 'c'], None)
+    """
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/20 上午10:12
+"""
+import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .err import FuncArgsError
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+__all__ = ("ColumnarBuilder",)
+
+_MISSING = object()
+
+# array.array不支持的类型使用list保存
+_ARRAY_TYPECODES = {
+    "int8": "b", "int16": "h", "int32": "i", "int64": "q", "int": "q",
+    "uint8": "B", "uint16": "H", "uint32": "I", "uint64": "Q",
+    "float32": "f", "float64": "d", "float": "d", "bool": "b",
+}
+
+
+class _Column(object):
+    """
+    可增长的类型化列,安装了numpy时使用numpy数组,否则使用array.array
+    """
+
+    def __init__(self, name: str, dtype: Any = None, capacity: int = 1024):
+        """
+            可增长的类型化列
+        Args:
+            name: 字段名称
+            dtype: 列的类型, eg: "int64", "float64", "bool", "datetime64[ms]", 默认为object
+            capacity: numpy数组的初始容量
+        """
+        self.name: str = name
+        self.size: int = 0
+        # session的convert_id为False时document中只有_id,id列也从_id中获取
+        self._paths: List[List[str]] = [["id"], ["_id"]] if name == "id" else [name.split(".")]
+        if dtype in (None, "object", "str", object, str):
+            dtype = "object"
+
+        if np is not None:
+            self.dtype = np.dtype(dtype)
+            self.values = np.empty(capacity, dtype=self.dtype)
+            self.mask = np.zeros(capacity, dtype=bool)
+            kind = self.dtype.kind
+            self.fill_value: Any = (None if kind == "O" else np.datetime64("NaT") if kind in "mM" else
+                                    "" if kind in "US" else 0)
+        else:
+            self.dtype = dtype
+            typecode = _ARRAY_TYPECODES.get(str(dtype))
+            self.values = array.array(typecode) if typecode else []  # type: ignore
+            self.mask = array.array("B")  # type: ignore
+            self.fill_value = 0 if typecode else None
+
+    def get(self, document: Dict) -> Any:
+        """
+        获取document中的字段值,字段名称支持a.b的嵌套形式
+        Args:
+            document: document obj
+        Returns:
+            返回字段的值,不存在时返回_MISSING
+        """
+        for path in self._paths:
+            value: Any = document
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    value = _MISSING
+                    break
+                value = value[key]
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    def extend(self, documents: Sequence[Dict]):
+        """
+        把一批document中的字段值追加到列中,缺失的值和null使用填充值并在mask中标记
+        Args:
+            documents: document列表
+        Returns:
+
+        """
+        values, mask = [], []
+        fill_value = self.fill_value
+        for document in documents:
+            value = self.get(document)
+            if value is _MISSING or value is None:
+                values.append(fill_value)
+                mask.append(1)
+            else:
+                values.append(value)
+                mask.append(0)
+
+        try:
+            if np is None:
+                self.values.extend(values)
+                self.mask.extend(mask)
+            else:
+                count = len(values)
+                if self.size + count > len(self.values):
+                    capacity = max(len(self.values) * 2, self.size + count)
+                    self.values.resize(capacity, refcheck=False)
+                    self.mask.resize(capacity, refcheck=False)
+                if self.dtype.kind == "O":
+                    # 切片赋值时numpy会把长度相同的list值当作多维数组广播,object列逐个赋值
+                    for index, value in enumerate(values, self.size):
+                        self.values[index] = value
+                else:
+                    self.values[self.size:self.size + count] = values
+                self.mask[self.size:self.size + count] = mask
+        except (TypeError, ValueError, OverflowError) as e:
+            raise FuncArgsError("Field {} value can not convert to {}, {}".format(self.name, self.dtype, e))
+        self.size += len(values)
+
+    def result(self, ) -> Tuple[Any, Any]:
+        """
+        返回列的值和mask, mask中为True(1)的位置表示值缺失或者为null
+        Args:
+
+        Returns:
+
+        """
+        if np is not None:
+            self.values.resize(self.size, refcheck=False)
+            self.mask.resize(self.size, refcheck=False)
+        return self.values, self.mask
+
+
+class ColumnarBuilder(object):
+    """
+    按列保存查询结果,document逐批追加到各个列中,不保留每行的document
+    """
+
+    def __init__(self, fields: Sequence[str], dtypes: Optional[Dict[str, Any]] = None):
+        """
+            按列保存查询结果
+        Args:
+            fields: 要导出的字段名称,支持a.b的嵌套形式
+            dtypes: 字段的类型, eg: {"age": "int64", "score": "float64"},没有指定的字段为object
+        """
+        if not fields:
+            raise FuncArgsError("fields can not be empty.")
+        dtypes = dtypes or {}
+        self.columns: List[_Column] = [_Column(field, dtypes.get(field)) for field in fields]
+
+    @property
+    def projection(self, ) -> Dict[str, int]:
+        """
+        只查询需要导出的字段
+        Args:
+
+        Returns:
+
+        """
+        return {"_id" if column.name == "id" else column.name: 1 for column in self.columns}
+
+    def extend(self, documents: Iterable[Dict]):
+        """
+        追加一批document
+        Args:
+            documents: document列表
+        Returns:
+
+        """
+        documents = documents if isinstance(documents, list) else list(documents)
+        for column in self.columns:
+            column.extend(documents)
+
+    def result(self, ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        返回所有的列和mask
+        Args:
+
+        Returns:
+            返回(列名称和值的dict, 列名称和mask的dict)
+        """
+        columns, masks = {}, {}
+        for column in self.columns:
+            columns[column.name], masks[column.name] = column.result()
+        return columns, masks
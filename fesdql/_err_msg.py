@@ -24,4 +24,6 @@ mongo_msg = {
           "description": "MongoDB查找多条数据时最终失败的提示"},
     105: {"msg_code": 105, "msg_zh": "MongoDB聚合查询数据失败.", "msg_en": "MongoDB aggregate query data failed.",
           "description": "MongoDB聚合查询数据时最终失败的提示"},
+    106: {"msg_code": 106, "msg_zh": "MongoDB批量写入数据失败.", "msg_en": "MongoDB bulk write data failed.",
+          "description": "MongoDB批量写入数据时最终失败的提示"},
 }
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/25 上午10:36
+"""
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: no cover
+    ContextVar = None  # python3.6中没有contextvars,span不会关联父span
+
+from .err import FuncArgsError
+
+__all__ = ("OperationSpan", "OperationHooks", "current_span")
+
+_current_span = ContextVar("fesdql_current_span", default=None) if ContextVar is not None else None
+
+
+def current_span() -> Optional['OperationSpan']:
+    """
+    获取当前上下文中正在执行的操作的span
+    Args:
+
+    Returns:
+        返回正在执行的span,没有时返回None
+    """
+    return _current_span.get() if _current_span is not None else None
+
+
+class OperationSpan(object):
+    """
+    一次session操作的上下文,before和after钩子接收的都是同一个span
+
+    在同一个上下文中嵌套执行的操作会通过parent关联到外层的span,并且继承外层的trace_id,
+    钩子之间可以通过data传递数据, eg: before中开始一个tracing的span, after中结束它
+    """
+
+    __slots__ = ("operation", "cname", "bind", "query_key", "sort", "exclude_key", "span_id", "trace_id",
+                 "parent", "start_time", "started", "duration", "docs", "error", "data", "_outer_exc", "_token")
+
+    def __init__(self, operation: str, cname: str, bind: Optional[str], query_key: Any = None, sort: Any = None,
+                 exclude_key: Dict = None):
+        """
+            一次session操作的上下文
+        Args:
+            operation: 操作名称, eg: find_one, update_many
+            cname: collection name
+            bind: session的bind, 默认连接为None
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+        """
+        self.operation: str = operation
+        self.cname: str = cname
+        self.bind: Optional[str] = bind
+        self.query_key: Any = query_key
+        self.sort: Any = sort
+        self.exclude_key: Optional[Dict] = exclude_key
+        self.parent: Optional[OperationSpan] = current_span()
+        self.span_id: str = uuid.uuid4().hex[:16]
+        self.trace_id: str = self.parent.trace_id if self.parent is not None else uuid.uuid4().hex
+        self.start_time: float = time.time()
+        self.started: float = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.docs: int = 0
+        self.error: Optional[BaseException] = None
+        self.data: Dict[str, Any] = {}
+        # 操作开始前调用方正在处理的异常,结束时据此区分操作本身抛出的异常
+        self._outer_exc: Optional[BaseException] = sys.exc_info()[1]
+        self._token = None
+
+    def enter(self, ):
+        """
+        把span设置为当前上下文中正在执行的span
+        Args:
+
+        Returns:
+
+        """
+        if _current_span is not None:
+            self._token = _current_span.set(self)
+
+    def exit(self, docs: int = 0):
+        """
+        操作结束,记录耗时、返回的document数量和异常,并恢复外层的span
+        Args:
+            docs: 返回的document数量
+        Returns:
+
+        """
+        self.duration = (time.perf_counter() - self.started) * 1000
+        self.docs = docs
+        exc = sys.exc_info()[1]
+        # 调用方提前退出流式查询时生成器收到GeneratorExit,不是操作本身的错误
+        self.error = exc if exc is not self._outer_exc and not isinstance(exc, GeneratorExit) else None
+        if self._token is not None:
+            _current_span.reset(self._token)  # type: ignore
+            self._token = None
+
+    def __repr__(self, ):
+        return "<OperationSpan {} {}.{} {}>".format(self.operation, self.bind, self.cname, self.span_id)
+
+
+class OperationHooks(object):
+    """
+    session操作的钩子注册表,同一个mongo实例中的所有session共享
+
+    before钩子在操作开始前调用, after钩子在操作结束后调用(包括操作抛出异常时),钩子都只接收一个OperationSpan参数,
+    异步session中钩子可以是协程函数,同步session中只能使用普通函数,钩子中的异常只记录日志不会影响操作本身,
+    没有注册任何钩子时session不会创建span
+    """
+
+    def __init__(self, ):
+        self._lock = threading.Lock()
+        self._hooks: Dict[int, Tuple[Optional[Callable], Optional[Callable]]] = {}
+        self._next_id: int = 0
+        # 注册和删除时重新生成,调用钩子时不需要加锁
+        self.before: Tuple[Callable, ...] = ()
+        self.after: Tuple[Callable, ...] = ()
+
+    def __bool__(self, ):
+        return bool(self._hooks)
+
+    def add(self, before: Callable = None, after: Callable = None) -> int:
+        """
+        注册钩子
+        Args:
+            before: 操作开始前调用的钩子, eg: def before(span: OperationSpan)
+            after: 操作结束后调用的钩子, span中包括耗时、返回的document数量和异常
+        Returns:
+            返回钩子的id,用于删除钩子
+        """
+        if before is None and after is None:
+            raise FuncArgsError("before and after can not both be None.")
+        for hook in (before, after):
+            if hook is not None and not callable(hook):
+                raise FuncArgsError("hook {} is not callable.".format(hook))
+        with self._lock:
+            self._next_id += 1
+            self._hooks[self._next_id] = (before, after)
+            self._rebuild()
+            return self._next_id
+
+    def remove(self, hook_id: int) -> bool:
+        """
+        删除钩子
+        Args:
+            hook_id: 注册钩子时返回的id
+        Returns:
+            返回是否删除成功
+        """
+        with self._lock:
+            if self._hooks.pop(hook_id, None) is None:
+                return False
+            self._rebuild()
+            return True
+
+    def clear(self, ):
+        """
+        删除所有的钩子
+        Args:
+
+        Returns:
+
+        """
+        with self._lock:
+            self._hooks = {}
+            self._rebuild()
+
+    def _rebuild(self, ):
+        hooks: List[Tuple[Optional[Callable], Optional[Callable]]] = list(self._hooks.values())
+        self.before = tuple(before for before, _ in hooks if before is not None)
+        self.after = tuple(after for _, after in hooks if after is not None)
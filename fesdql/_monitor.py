@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/22 下午4:05
+"""
+import hashlib
+import json
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+from ._cachelru import LRU
+from .err import FuncArgsError
+
+__all__ = ("EngineStats", "Histogram", "OperationStats", "WorkloadStats", "query_shape")
+
+# 低版本的pymongo中没有连接池的监控
+ConnectionPoolListener = getattr(monitoring, "ConnectionPoolListener", None)
+
+# 直方图的桶上界,单位毫秒,最后一个桶保存超过最大上界的耗时
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class _Summary(object):
+    """
+    耗时的汇总, 单位毫秒
+    """
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self, ):
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+    def add(self, duration: float):
+        """
+        增加一次耗时
+        Args:
+            duration: 耗时,单位毫秒
+        Returns:
+
+        """
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def snapshot(self, ) -> Dict:
+        """
+        汇总的快照
+        Args:
+
+        Returns:
+
+        """
+        return {"count": self.count, "total_ms": round(self.total, 3), "max_ms": round(self.max, 3),
+                "avg_ms": round(self.total / self.count, 3) if self.count else 0}
+
+
+class EngineStats(object):
+    """
+    一个mongo client的监控数据,包括命令的耗时,连接池的使用情况和心跳
+
+    pymongo在不同的线程中调用监听器,所有的修改都在锁中进行
+    """
+
+    def __init__(self, ):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self, ):
+        """
+        清空监控数据
+        Args:
+
+        Returns:
+
+        """
+        with self._lock:
+            # 命令
+            self.commands: _Summary = _Summary()
+            self.commands_failed: int = 0
+            self.command_names: Dict[str, _Summary] = {}
+            # 连接池
+            self.checkouts: int = 0
+            self.checkins: int = 0
+            self.checkout_failed: int = 0
+            self.checkout_timeouts: int = 0
+            self.checkout_wait: _Summary = _Summary()
+            self.connections_created: int = 0
+            self.connections_closed: int = 0
+            self.pools_cleared: int = 0
+            # 心跳
+            self.heartbeats: int = 0
+            self.heartbeats_failed: int = 0
+            self.heartbeat_rtt_ms: Optional[float] = None
+
+    def listeners(self, ) -> List:
+        """
+        生成注册到mongo client中的监听器
+        Args:
+
+        Returns:
+
+        """
+        listeners = [_CommandListener(self), _HeartbeatListener(self)]
+        if ConnectionPoolListener is not None:
+            listeners.append(_PoolListener(self))
+        return listeners
+
+    def snapshot(self, ) -> Dict:
+        """
+        监控数据的快照
+        Args:
+
+        Returns:
+
+        """
+        with self._lock:
+            return {
+                "commands": {**self.commands.snapshot(), "failed": self.commands_failed,
+                             "by_name": {name: summary.snapshot() for name, summary in self.command_names.items()}},
+                "pool": {"checkouts": self.checkouts, "in_use": self.checkouts - self.checkins,
+                         "checkout_failed": self.checkout_failed, "checkout_timeouts": self.checkout_timeouts,
+                         "checkout_wait": self.checkout_wait.snapshot(),
+                         "connections_created": self.connections_created,
+                         "connections_closed": self.connections_closed, "pools_cleared": self.pools_cleared},
+                "heartbeats": {"succeeded": self.heartbeats, "failed": self.heartbeats_failed,
+                               "rtt_ms": self.heartbeat_rtt_ms},
+            }
+
+    def _command_finished(self, command_name: str, duration_micros: int, failed: bool):
+        duration = duration_micros / 1000
+        with self._lock:
+            self.commands.add(duration)
+            if failed:
+                self.commands_failed += 1
+            summary = self.command_names.get(command_name)
+            if summary is None:
+                summary = self.command_names[command_name] = _Summary()
+            summary.add(duration)
+
+    def _checkout_started(self, ):
+        # 同一个线程中开始获取连接和获取到连接的事件是连续的
+        self._local.checkout_started = time.perf_counter()
+
+    def _checkout_finished(self, event, failed: bool):
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            duration *= 1000
+        else:
+            started = getattr(self._local, "checkout_started", None)
+            duration = (time.perf_counter() - started) * 1000 if started is not None else None
+        self._local.checkout_started = None
+        with self._lock:
+            if failed:
+                self.checkout_failed += 1
+                if getattr(event, "reason", None) == "timeout":
+                    self.checkout_timeouts += 1
+            else:
+                self.checkouts += 1
+            if duration is not None:
+                self.checkout_wait.add(duration)
+
+
+class _CommandListener(monitoring.CommandListener):
+    """
+    命令的监听器
+    """
+
+    def __init__(self, stats: EngineStats):
+        self.stats: EngineStats = stats
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.stats._command_finished(event.command_name, event.duration_micros, False)
+
+    def failed(self, event):
+        self.stats._command_finished(event.command_name, event.duration_micros, True)
+
+
+class _HeartbeatListener(monitoring.ServerHeartbeatListener):
+    """
+    心跳的监听器
+    """
+
+    def __init__(self, stats: EngineStats):
+        self.stats: EngineStats = stats
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self.stats._lock:
+            self.stats.heartbeats += 1
+            self.stats.heartbeat_rtt_ms = round(event.duration * 1000, 3)
+
+    def failed(self, event):
+        with self.stats._lock:
+            self.stats.heartbeats_failed += 1
+
+
+if ConnectionPoolListener is not None:
+    class _PoolListener(ConnectionPoolListener):  # type: ignore
+        """
+        连接池的监听器
+        """
+
+        def __init__(self, stats: EngineStats):
+            self.stats: EngineStats = stats
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            with self.stats._lock:
+                self.stats.pools_cleared += 1
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            with self.stats._lock:
+                self.stats.connections_created += 1
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            with self.stats._lock:
+                self.stats.connections_closed += 1
+
+        def connection_check_out_started(self, event):
+            self.stats._checkout_started()
+
+        def connection_check_out_failed(self, event):
+            self.stats._checkout_finished(event, True)
+
+        def connection_checked_out(self, event):
+            self.stats._checkout_finished(event, False)
+
+        def connection_checked_in(self, event):
+            with self.stats._lock:
+                self.stats.checkins += 1
+
+
+class Histogram(object):
+    """
+    固定桶的耗时直方图,单位毫秒
+
+    记录时只需要一次二分查找和计数,分位数按照所在桶的上界估算
+    """
+
+    __slots__ = ("buckets", "counts", "count", "total", "max")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+            固定桶的耗时直方图
+        Args:
+            buckets: 升序的桶上界,单位毫秒
+        """
+        self.buckets: Sequence[float] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+    def add(self, duration: float):
+        """
+        记录一次耗时
+        Args:
+            duration: 耗时,单位毫秒
+        Returns:
+
+        """
+        self.counts[bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percent: float) -> float:
+        """
+        估算分位数
+        Args:
+            percent: 百分位, eg: 50, 99
+        Returns:
+            返回分位数所在桶的上界,超过最大上界时返回最大耗时
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        accumulated = 0
+        for index, count in enumerate(self.counts):
+            accumulated += count
+            if count and accumulated >= rank:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self, ) -> Dict:
+        """
+        直方图的快照
+        Args:
+
+        Returns:
+
+        """
+        buckets = {str(bucket): count for bucket, count in zip(self.buckets, self.counts)}
+        buckets["+inf"] = self.counts[-1]
+        return {"count": self.count, "total_ms": round(self.total, 3), "max_ms": round(self.max, 3),
+                "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+                "p50_ms": round(self.percentile(50), 3), "p90_ms": round(self.percentile(90), 3),
+                "p99_ms": round(self.percentile(99), 3), "buckets": buckets}
+
+
+class OperationStats(object):
+    """
+    按照(bind, collection, 操作)分组的耗时直方图,同一个mongo实例中的所有session共享
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+            按照(bind, collection, 操作)分组的耗时直方图
+        Args:
+            buckets: 升序的桶上界,单位毫秒
+        """
+        self.buckets: Sequence[float] = buckets
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[Optional[str], str, str], Histogram] = {}
+
+    def record(self, bind: Optional[str], cname: str, operation: str, duration: float):
+        """
+        记录一次操作的耗时
+        Args:
+            bind: session的bind, 默认连接为None
+            cname: collection name
+            operation: 操作名称, eg: find_one, update_many
+            duration: 耗时,单位毫秒
+        Returns:
+
+        """
+        key = (bind, cname, operation)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.add(duration)
+
+    def snapshot(self, reset: bool = False) -> List[Dict]:
+        """
+        所有操作的耗时快照
+        Args:
+            reset: 获取快照后是否清空数据
+        Returns:
+            返回每个(bind, collection, 操作)的耗时统计列表
+        """
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+            return [{"bind": bind, "cname": cname, "operation": operation, **histogram.snapshot()}
+                    for (bind, cname, operation), histogram in histograms.items()]
+
+    def reset(self, ):
+        """
+        清空所有操作的耗时数据
+        Args:
+
+        Returns:
+
+        """
+        with self._lock:
+            self._histograms = {}
+
+
+def query_shape(node: Any, pipeline: bool = False) -> Any:
+    """
+    把查询条件中的值替换为占位符,保留字段名称和操作符的结构
+
+    $and、$or等document列表中的每个document分别处理,其他的列表作为一个值,
+    以$开头的字符串只有在聚合的表达式中才是字段引用,保持不变,查询条件中的"$100"等字符串仍然是值,
+    聚合中$match的查询条件按照查询条件处理, $expr中的表达式按照聚合表达式处理
+    Args:
+        node: 查询条件或者聚合的pipline
+        pipeline: node是否为聚合的pipline或者聚合表达式
+    Returns:
+        返回替换后的查询结构
+    """
+    if isinstance(node, dict):
+        return {key: query_shape(value, (pipeline and key != "$match") or key == "$expr")
+                for key, value in node.items()}
+    if isinstance(node, (list, tuple)) and node and all(isinstance(val, dict) for val in node):
+        return [query_shape(val, pipeline) for val in node]
+    if pipeline and isinstance(node, str) and node.startswith("$"):
+        return node
+    return "?"
+
+
+class WorkloadStats(object):
+    """
+    按照查询结构汇总的负载统计,相同结构的查询累计次数、耗时和返回的document数量
+
+    使用LRU限制查询结构的数量,长时间没有出现的查询结构会被淘汰
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """
+            按照查询结构汇总的负载统计
+        Args:
+            max_size: 最多保存的查询结构的数量
+        """
+        self.max_size: int = max_size
+        self._lock = threading.Lock()
+        self._shapes: LRU = LRU(max_size=max_size)
+
+    @staticmethod
+    def fingerprint(cname: str, operation: str, query_key: Any = None, sort: Any = None,
+                    exclude_key: Dict = None) -> Tuple[str, Dict]:
+        """
+        生成查询结构的指纹
+        Args:
+            cname: collection name
+            operation: 操作名称, eg: find_one, update_many
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+        Returns:
+            返回指纹和查询结构
+        """
+        shape = {"cname": cname, "operation": operation,
+                 "filter": query_shape(query_key, isinstance(query_key, list)) if query_key is not None else None,
+                 "sort": [list(val) if isinstance(val, (list, tuple)) else val for val in sort] if sort else None,
+                 "projection": sorted(exclude_key) if exclude_key else None}
+        digest = hashlib.md5(json.dumps(shape, sort_keys=True).encode()).hexdigest()
+        return digest, shape
+
+    def record(self, cname: str, operation: str, duration: float, docs: int = 0, query_key: Any = None,
+               sort: Any = None, exclude_key: Dict = None):
+        """
+        累计一次查询的耗时和返回的document数量
+        Args:
+            cname: collection name
+            operation: 操作名称, eg: find_one, update_many
+            duration: 耗时,单位毫秒
+            docs: 返回的document数量
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+        Returns:
+
+        """
+        digest, shape = self.fingerprint(cname, operation, query_key, sort, exclude_key)
+        with self._lock:
+            entry = self._shapes.get(digest)
+            if entry is None:
+                entry = self._shapes[digest] = {"fingerprint": digest, **shape, "count": 0, "total_ms": 0,
+                                                "max_ms": 0, "docs": 0}
+            entry["count"] += 1
+            entry["total_ms"] += duration
+            entry["docs"] += docs
+            if duration > entry["max_ms"]:
+                entry["max_ms"] = duration
+
+    def report(self, top: int = 10, order_by: str = "total_ms", reset: bool = False) -> List[Dict]:
+        """
+        按照累计的开销返回排名靠前的查询结构
+        Args:
+            top: 返回的查询结构数量, 0表示返回所有的查询结构
+            order_by: 排序的字段, total_ms, count, docs或者avg_ms
+            reset: 获取报告后是否清空统计数据
+        Returns:
+            返回查询结构和累计数据的列表
+        """
+        if order_by not in ("total_ms", "count", "docs", "avg_ms", "max_ms"):
+            raise FuncArgsError("order_by must be one of total_ms, count, docs, avg_ms, max_ms.")
+        with self._lock:
+            entries = []
+            for entry in self._shapes.values():
+                entry = dict(entry)
+                entry["avg_ms"] = round(entry["total_ms"] / entry["count"], 3)
+                entry["avg_docs"] = round(entry["docs"] / entry["count"], 3)
+                entry["total_ms"] = round(entry["total_ms"], 3)
+                entry["max_ms"] = round(entry["max_ms"], 3)
+                entries.append(entry)
+            if reset:
+                self._shapes.clear()
+        entries.sort(key=lambda val: val[order_by], reverse=True)
+        return entries[:top] if top else entries
@@ -7,17 +7,25 @@
 @time: 18-12-25 下午3:41
 """
 
+import asyncio
+import inspect
+import time
 from collections.abc import MutableMapping, MutableSequence
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
 
 import aelog
+from bson.son import SON
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.database import Database
-from pymongo.errors import (ConnectionFailure, DuplicateKeyError, InvalidName, PyMongoError)
+from pymongo.errors import (BulkWriteError, ConnectionFailure, DuplicateKeyError, InvalidName, PyMongoError)
 
 from ._alchemy import AlchemyMixIn, BaseMongo, BasePagination, SessionMixIn
-from .err import HttpError, MongoDuplicateKeyError, MongoError, MongoInvalidNameError
-from .query import Query
+from ._cachelru import TTLLRU
+from ._columnar import ColumnarBuilder
+from ._hooks import OperationHooks, OperationSpan
+from ._monitor import OperationStats, WorkloadStats
+from .err import FuncArgsError, HttpError, MongoDuplicateKeyError, MongoError, MongoInvalidNameError
+from .query import COUNT_CAPPED, COUNT_ESTIMATED, COUNT_NONE, Query
 
 __all__ = ("AsyncMongo",)
 
@@ -37,18 +45,42 @@ class AsyncPagination(BasePagination):
     # noinspection PyProtectedMember
     async def prev(self, ) -> List[Dict]:
         """Returns a :class:`Pagination` object for the previous page."""
+        if self.is_keyset:
+            query_key = self._seek_query_key(backward=True)
+            if query_key is None:
+                return []
+            items = await self.session._find_many(self.cname, query_key, self.exclude_key, limit=self.per_page + 1,
+                                                  sort=self._seek_sort(backward=True))
+            items = self._seek_result(items, backward=True)
+            if items:
+                self.page -= 1
+            return items
+
         self.page -= 1
         _offset_clause = (self.page - 1) * self.per_page
-        return await self.session._find_many(self.cname, self.query_key, self.exclude_key, self.per_page,
-                                             _offset_clause, self.sort)
+        items = await self.session._find_many(self.cname, self.query_key, self.exclude_key, skip=_offset_clause,
+                                              limit=self._offset_limit, sort=self.sort, raw=self.raw)
+        return self._offset_result(items)
 
     # noinspection PyProtectedMember
     async def next(self, ) -> List[Dict]:
         """Returns a :class:`Pagination` object for the next page."""
+        if self.is_keyset:
+            query_key = self._seek_query_key(backward=False)
+            if query_key is None:
+                return []
+            items = await self.session._find_many(self.cname, query_key, self.exclude_key, limit=self.per_page + 1,
+                                                  sort=self._seek_sort(backward=False))
+            items = self._seek_result(items, backward=False)
+            if items:
+                self.page += 1
+            return items
+
         self.page += 1
         _offset_clause = (self.page - 1) * self.per_page
-        return await self.session._find_many(self.cname, self.query_key, self.exclude_key, self.per_page,
-                                             _offset_clause, self.sort)
+        items = await self.session._find_many(self.cname, self.query_key, self.exclude_key, skip=_offset_clause,
+                                              limit=self._offset_limit, sort=self.sort, raw=self.raw)
+        return self._offset_result(items)
 
 
 # noinspection PyProtectedMember
@@ -57,7 +89,12 @@ class AsyncSession(SessionMixIn, object):
     query session
     """
 
-    def __init__(self, db: Database, message: Dict, msg_zh: str, max_per_page: int = None):
+    def __init__(self, db: Database, message: Dict, msg_zh: str, max_per_page: int = None, *, pool_size: int = 50,
+                 count_cache_ttl: float = 0, count_cache_size: int = 1024, result_cache_size: int = 1024,
+                 convert_id: bool = True, buffer_max_size: int = 500, buffer_flush_interval: float = 0.05,
+                 single_flight: bool = False, bind: str = None, operation_stats: OperationStats = None,
+                 slow_query_ms: float = 0, workload_stats: WorkloadStats = None,
+                 hooks: OperationHooks = None):
         """
             query session
         Args:
@@ -65,28 +102,122 @@ class AsyncSession(SessionMixIn, object):
             message: 消息提示
             msg_zh: 中文提示或者而英文提示
             max_per_page: 每页最大的数量
+            pool_size: 连接池的大小
+            count_cache_ttl: 分页总数缓存的过期时间,单位秒,0表示不缓存
+            count_cache_size: 分页总数缓存的最大数量
+            result_cache_size: 查询结果缓存的最大数量
+            convert_id: 是否把查询结果中的_id转换为字符串类型的id,False时document保持mongo返回的_id
+            buffer_max_size: 缓冲插入时每个collection缓冲的最大document数量,达到后立即写入
+            buffer_flush_interval: 缓冲插入时的最长等待时间,单位秒
+            single_flight: 相同的并发查询是否合并为一次查询
+            bind: session对应的bind,默认连接为None
+            operation_stats: 记录每个操作耗时的直方图
+            slow_query_ms: 慢查询的阈值,单位毫秒,0表示不记录慢查询
+            workload_stats: 按照查询结构汇总的负载统计
+            hooks: 操作前后调用的钩子
         """
         self.db: Database = db
         self.message: Dict = message
         self.msg_zh: str = msg_zh
         self.max_per_page: Optional[int] = max_per_page
+        self.pool_size: int = pool_size
+        # collection的写入版本号,用于写入后使缓存失效
+        self._cname_version: Dict[str, int] = {}
+        # 分页总数缓存
+        self.count_cache_ttl: float = count_cache_ttl
+        self._count_cache: Optional[TTLLRU] = TTLLRU(
+            max_size=count_cache_size, default_ttl=count_cache_ttl) if count_cache_ttl > 0 else None
+        # 查询结果缓存,每个key的过期时间由Query.cache指定
+        self._result_cache: TTLLRU = TTLLRU(max_size=result_cache_size)
+        self.convert_id: bool = convert_id
+        # 缓冲插入,每个collection的document和对应的future
+        self.buffer_max_size: int = buffer_max_size
+        self.buffer_flush_interval: float = buffer_flush_interval
+        self._insert_buffer: Dict[str, List[Tuple[Dict, asyncio.Future]]] = {}
+        self._flush_handles: Dict[str, asyncio.TimerHandle] = {}
+        self._flush_tasks: Set[asyncio.Future] = set()
+        # 正在执行的查询,相同的并发查询共享同一个查询结果
+        self.single_flight: bool = single_flight
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 同一个事件循环周期内按id查询的document,每个collection合并为一次查询
+        self._load_batches: Dict[str, Dict[str, List[asyncio.Future]]] = {}
+        # 操作耗时和慢查询
+        self.bind: Optional[str] = bind
+        self.operation_stats: Optional[OperationStats] = operation_stats
+        self.slow_query_ms: float = slow_query_ms
+        self.workload_stats: Optional[WorkloadStats] = workload_stats
+        self.hooks: Optional[OperationHooks] = hooks
+
+    async def _call_hook(self, hook: Callable, span: OperationSpan) -> None:
+        """
+        调用钩子,钩子可以是普通函数或者协程函数,钩子中的异常只记录日志
+        Args:
+            hook: 钩子
+            span: 操作的上下文
+        Returns:
 
-    async def _insert_one(self, cname: str, document: Union[Dict, List[Dict]], insert_one: bool = True
-                          ) -> Union[str, Tuple[str]]:
+        """
+        try:
+            result = hook(span)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            aelog.exception("Call hook {} failed, {}".format(hook, e))
+
+    async def _before_operation(self, operation: str, cname: str, query_key: Any = None, sort: Any = None,
+                                exclude_key: Dict = None, enter: bool = True) -> OperationSpan:
+        """
+        操作开始前创建span并调用before钩子
+        Args:
+            operation: 操作名称, eg: find_one, update_many
+            cname: collection name
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+            enter: 是否设置为当前上下文中正在执行的span,流式查询的span跨越多次yield,不能设置
+        Returns:
+            返回操作的span
+        """
+        span = OperationSpan(operation, cname, self.bind, query_key, sort, exclude_key)
+        for hook in self.hooks.before:  # type: ignore
+            await self._call_hook(hook, span)
+        if enter:
+            span.enter()
+        return span
+
+    async def _after_operation(self, span: OperationSpan, docs: int = 0) -> None:
+        """
+        操作结束后记录span的结果并调用after钩子,需要在操作的finally中调用
+        Args:
+            span: 操作的span
+            docs: 返回的document数量
+        Returns:
+
+        """
+        span.exit(docs)
+        for hook in self.hooks.after:  # type: ignore
+            await self._call_hook(hook, span)
+
+    async def _insert_one(self, cname: str, document: Union[Dict, List[Dict]], insert_one: bool = True,
+                          ordered: bool = True) -> Union[str, List[str]]:
         """
         插入一个单独的文档
         Args:
             cname:collection name
             document: document obj
             insert_one: insert_one insert_many的过滤条件，默认True
+            ordered: insert_many时是否按顺序插入,顺序插入时遇到错误后停止插入后面的document
         Returns:
             返回插入的Objectid
         """
+        started = time.perf_counter()
+        span = await self._before_operation(
+            "insert_one" if insert_one else "insert_many", cname) if self.hooks else None
         try:
             if insert_one:
                 result = await self.db.get_collection(cname).insert_one(document)
             else:
-                result = await self.db.get_collection(cname).insert_many(document)
+                result = await self.db.get_collection(cname).insert_many(document, ordered=ordered)
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except DuplicateKeyError as e:
@@ -95,21 +226,177 @@ class AsyncSession(SessionMixIn, object):
             aelog.exception("Insert one document failed, {}".format(err))
             raise HttpError(400, message=self.message[100][self.msg_zh], error=err)
         else:
-            return str(result.inserted_id) if insert_one else (str(val) for val in result.inserted_ids)  # type: ignore
+            return str(result.inserted_id) if insert_one else [str(val) for val in result.inserted_ids]  # type: ignore
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("insert_one" if insert_one else "insert_many", cname, started)
+            if span is not None:
+                await self._after_operation(span)
 
-    async def _insert_many(self, cname: str, document: List[Dict]) -> Tuple[str]:
+    async def _insert_many(self, cname: str, document: List[Dict], ordered: bool = True) -> List[str]:
         """
         批量插入文档
         Args:
             cname:collection name
             document: document obj
+            ordered: 是否按顺序插入,顺序插入时遇到错误后停止插入后面的document
         Returns:
             返回插入的Objectid列表
         """
-        return await self._insert_one(cname, document, insert_one=False)  # type: ignore
+        return await self._insert_one(cname, document, insert_one=False, ordered=ordered)  # type: ignore
+
+    def _flush_buffer(self, cname: str) -> None:
+        """
+        把collection的缓冲数据提交到后台写入
+        Args:
+            cname:collection name
+        Returns:
+
+        """
+        handle = self._flush_handles.pop(cname, None)
+        if handle is not None:
+            handle.cancel()
+        buffer = self._insert_buffer.pop(cname, None)
+        if not buffer:
+            return
+        task = asyncio.ensure_future(self._write_buffer(cname, buffer))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _write_buffer(self, cname: str, buffer: List[Tuple[Dict, asyncio.Future]]) -> None:
+        """
+        把缓冲的document无序批量插入,并把每个document的结果设置到对应的future中
+        Args:
+            cname:collection name
+            buffer: document和对应的future
+        Returns:
+
+        """
+        documents = [document for document, _ in buffer]
+        try:
+            inserted_ids = await self._insert_many(cname, documents, ordered=False)
+        except HttpError as e:
+            if not isinstance(e.error, BulkWriteError):
+                self._set_buffer_exception(buffer, e)
+                return
+            # 无序插入时只有writeErrors中的document插入失败,其他的document已经插入成功
+            write_errors = {err["index"]: err for err in e.error.details.get("writeErrors", [])}
+            for index, (document, future) in enumerate(buffer):
+                if future.done():
+                    continue
+                if index not in write_errors:
+                    future.set_result(str(document["_id"]))
+                elif write_errors[index].get("code") == 11000:
+                    future.set_exception(MongoDuplicateKeyError(
+                        "Duplicate key error, {}".format(write_errors[index].get("errmsg"))))
+                else:
+                    future.set_exception(HttpError(
+                        400, message=self.message[100][self.msg_zh], error=write_errors[index].get("errmsg")))
+        except Exception as e:
+            # MongoError以及bson的InvalidDocument等编码错误,整个批次都设置为同样的异常
+            self._set_buffer_exception(buffer, e)
+        else:
+            for inserted_id, (_, future) in zip(inserted_ids, buffer):
+                if not future.done():
+                    future.set_result(inserted_id)
+        finally:
+            # 写入任务被取消或者处理结果时出错,没有结果的future也要结束,不能让调用者一直等待
+            for _, future in buffer:
+                if not future.done():
+                    future.cancel()
+
+    @staticmethod
+    def _set_buffer_exception(buffer: List[Tuple[Dict, asyncio.Future]], exc: Exception) -> None:
+        """
+        整个批次写入失败时,所有的future都设置为同样的异常
+        Args:
+            buffer: document和对应的future
+            exc: 异常
+        Returns:
+
+        """
+        for _, future in buffer:
+            if not future.done():
+                future.set_exception(exc)
+
+    def _dispatch_load(self, cname: str) -> None:
+        """
+        把collection中等待按id查询的document提交到后台查询
+        Args:
+            cname:collection name
+        Returns:
+
+        """
+        batch = self._load_batches.pop(cname, None)
+        if batch:
+            asyncio.ensure_future(self._load_batch(cname, batch))
+
+    async def _load_batch(self, cname: str, batch: Dict[str, List[asyncio.Future]]) -> None:
+        """
+        使用一次$in查询获取所有id对应的document,并把结果设置到每个调用者的future中
+        Args:
+            cname:collection name
+            batch: id和等待该id的future列表
+        Returns:
+
+        """
+        try:
+            query_key = self._update_query_key({"id": {"in": list(batch)}})
+            docs = await self._find_many(cname, query_key)
+        except Exception as e:
+            # 包括bson的编码和解码错误,所有的调用者都设置为同样的异常
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+        else:
+            docs_map = {str(doc["id"] if "id" in doc else doc["_id"]): doc for doc in docs}
+            for doc_id, futures in batch.items():
+                doc = docs_map.get(doc_id)
+                for index, future in enumerate(futures):
+                    if not future.done():
+                        # 相同id的多个调用者各自获取一份document
+                        future.set_result(doc if index == 0 else self._copy_result(doc))
+        finally:
+            # 查询任务被取消时没有结果的future也要结束,不能让调用者一直等待
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.cancel()
+
+    async def _single_flight(self, cache_key: str, coro: Awaitable) -> Any:
+        """
+        合并相同的并发查询
+
+        相同cache_key的查询正在执行时不再发起新的查询,而是等待正在执行的查询并获取结果的副本,
+        cache_key中包含collection的写入版本号,因此写入后发起的查询不会和写入前的查询合并
+        Args:
+            cache_key: 查询的key
+            coro: 执行查询的协程
+        Returns:
+            返回查询结果
+        """
+        if not self.single_flight:
+            return await coro
+
+        task = self._inflight.get(cache_key)
+        if task is not None:
+            coro.close()  # type: ignore
+            return self._copy_result(await asyncio.shield(task))
+
+        task = asyncio.ensure_future(coro)
+        self._inflight[cache_key] = task
+
+        def done_callback(_):
+            if self._inflight.get(cache_key) is task:
+                del self._inflight[cache_key]
+
+        task.add_done_callback(done_callback)
+        # 第一个调用者被取消时不影响其他等待的调用者
+        return await asyncio.shield(task)
 
     async def _find_one(self, cname: str, query_key: Dict, exclude_key: Dict = None,
-                        sort: List[Tuple] = None) -> Optional[Dict]:
+                        sort: List[Tuple] = None, raw: bool = False) -> Optional[Dict]:
         """
         查询一个单独的document文档
         Args:
@@ -119,20 +406,28 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document或者None
         """
+        find_data = None
+        started = time.perf_counter()
+        span = await self._before_operation("find_one", cname, query_key, sort, exclude_key) if self.hooks else None
         try:
-            find_data = await self.db.get_collection(cname).find_one(query_key, projection=exclude_key, sort=sort)
+            find_data = await self._get_collection(cname, raw).find_one(query_key, projection=exclude_key, sort=sort)
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find one document failed, {}".format(err))
             raise HttpError(400, message=self.message[103][self.msg_zh], error=err)
         else:
-            if find_data and find_data.get("_id", None) is not None:
-                find_data["id"] = str(find_data.pop("_id"))
+            if not raw and find_data:
+                self._convert_id(find_data)
             return find_data
+        finally:
+            self._record_operation("find_one", cname, started, query_key, sort, exclude_key,
+                                   1 if find_data else 0)
+            if span is not None:
+                await self._after_operation(span, 1 if find_data else 0)
 
     async def _find_many(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
-                         limit: int = 0, sort: List[Tuple] = None) -> List[Dict]:
+                         limit: int = 0, sort: List[Tuple] = None, raw: bool = False) -> List[Dict]:
         """
         批量查询document文档
         Args:
@@ -145,39 +440,200 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document列表
         """
+        find_data: List[Dict] = []
+        started = time.perf_counter()
+        span = await self._before_operation("find_many", cname, query_key, sort, exclude_key) if self.hooks else None
         try:
-            find_data = []
-            cursor = self.db.get_collection(cname).find(
+            cursor = self._get_collection(cname, raw).find(
                 query_key, projection=exclude_key, skip=skip, limit=limit, sort=sort)
-            # find_data = await cursor.to_list(None)
+            find_data = [doc async for doc in cursor]
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=self.message[104][self.msg_zh], error=err)
+        else:
+            return find_data if raw else self._convert_ids(find_data, exclude_key=exclude_key)
+        finally:
+            self._record_operation("find_many", cname, started, query_key, sort, exclude_key, len(find_data))
+            if span is not None:
+                await self._after_operation(span, len(find_data))
+
+    async def _iter_many(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
+                         limit: int = 0, sort: List[Tuple] = None, batch_size: int = 100,
+                         yield_batch: bool = False, raw: bool = False,
+                         operation: str = "iter_many") -> AsyncIterator[Union[Dict, List[Dict]]]:
+        """
+        流式查询document文档,游标按批次从服务端拉取数据,不会把所有的document都加载到内存中
+        Args:
+            cname: collection name
+            query_key: 查询document的过滤条件
+            exclude_key: 过滤返回值中字段的过滤条件
+            skip: 从查询结果中调过指定数量的document
+            limit: 限制返回的document条数
+            sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            batch_size: 游标每次从服务端拉取的document数量
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+            operation: 操作名称,用于钩子、耗时统计和负载统计, eg: iter_many, find_columns
+        Returns:
+            逐条或者按批次返回匹配的document的异步生成器
+        """
+        cursor = None
+        batch: List[Dict] = []
+        docs = 0
+        # 从打开游标到迭代结束或者调用方退出迭代记录为一次操作
+        started = time.perf_counter()
+        span = await self._before_operation(
+            operation, cname, query_key, sort, exclude_key, enter=False) if self.hooks else None
+        try:
+            cursor = self._get_collection(cname, raw).find(
+                query_key, projection=exclude_key, skip=skip, limit=limit, sort=sort, batch_size=batch_size)
             async for doc in cursor:
-                if doc.get("_id", None) is not None:
-                    doc["id"] = str(doc.pop("_id"))
-                find_data.append(doc)
+                docs += 1
+                if not yield_batch:
+                    yield doc if raw else self._convert_id(doc)
+                    continue
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    yield batch if raw else self._convert_ids(batch, exclude_key=exclude_key)
+                    batch = []
+            if batch:
+                yield batch if raw else self._convert_ids(batch, exclude_key=exclude_key)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=self.message[104][self.msg_zh], error=err)
+        finally:
+            # 调用方提前退出迭代时也要释放服务端的游标
+            if cursor is not None:
+                await cursor.close()
+            self._record_operation(operation, cname, started, query_key, sort, exclude_key, docs)
+            if span is not None:
+                await self._after_operation(span, docs)
+
+    async def _find_facet(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
+                          limit: int = 0, sort: List[Tuple] = None) -> Tuple[List[Dict], int]:
+        """
+        使用$facet聚合在一次查询中返回当前页的document和匹配的总数
+        Args:
+            cname: collection name
+            query_key: 查询document的过滤条件
+            exclude_key: 过滤返回值中字段的过滤条件
+            skip: 从查询结果中调过指定数量的document
+            limit: 限制返回的document条数
+            sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+        Returns:
+            返回匹配的document列表和总数
+        """
+        items_pipline: List[Dict] = [{"$skip": skip}]
+        if limit:
+            items_pipline.append({"$limit": limit})
+        if exclude_key:
+            items_pipline.append({"$project": exclude_key})
+        pipline: List[Dict] = [{"$match": query_key}]
+        if sort:
+            pipline.append({"$sort": SON(sort)})
+        pipline.append({"$facet": {"items": items_pipline, "total": [{"$count": "total"}]}})
+
+        find_data: List[Dict] = []
+        total = 0
+        started = time.perf_counter()
+        span = await self._before_operation("find_facet", cname, query_key, sort, exclude_key) if self.hooks else None
+        try:
+            async for result in self.db.get_collection(cname).aggregate(pipline):
+                find_data = result["items"]
+                total = result["total"][0]["total"] if result["total"] else 0
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find many document failed, {}".format(err))
             raise HttpError(400, message=self.message[104][self.msg_zh], error=err)
         else:
-            return find_data
+            return self._convert_ids(find_data, exclude_key=exclude_key), total
+        finally:
+            self._record_operation("find_facet", cname, started, query_key, sort, exclude_key, len(find_data))
+            if span is not None:
+                await self._after_operation(span, len(find_data))
 
-    async def _find_count(self, cname: str, query_key: Dict) -> int:
+    async def _find_count(self, cname: str, query_key: Dict, limit: int = 0) -> int:
         """
         查询document的数量
         Args:
             cname: collection name
             query_key: 查询document的过滤条件
+            limit: 最多计数的数量,0表示不限制
         Returns:
             返回匹配的document数量
         """
+        started = time.perf_counter()
+        span = await self._before_operation("find_count", cname, query_key) if self.hooks else None
+        try:
+            if limit:
+                return await self.db.get_collection(cname).count_documents(query_key, limit=limit)
+            return await self.db.get_collection(cname).count_documents(query_key)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=self.message[104][self.msg_zh], error=err)
+        finally:
+            self._record_operation("find_count", cname, started, query_key)
+            if span is not None:
+                await self._after_operation(span)
+
+    async def _estimated_count(self, cname: str) -> int:
+        """
+        根据collection的元数据估算document的数量,不需要扫描数据
+        Args:
+            cname: collection name
+        Returns:
+            返回估算的document数量
+        """
+        started = time.perf_counter()
+        span = await self._before_operation("estimated_count", cname) if self.hooks else None
         try:
-            return await self.db.get_collection(cname).count(query_key)
+            return await self.db.get_collection(cname).estimated_document_count()
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find many document failed, {}".format(err))
             raise HttpError(400, message=self.message[104][self.msg_zh], error=err)
+        finally:
+            self._record_operation("estimated_count", cname, started)
+            if span is not None:
+                await self._after_operation(span)
+
+    async def _count_total(self, query: Query, query_key: Dict) -> Tuple[Optional[int], bool]:
+        """
+        按照query中的计数方式计算分页的总数
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            返回总数和总数是否为近似值,不计算总数时总数为None
+        """
+        if query._count_strategy == COUNT_NONE:
+            return None, False
+
+        cache_key = None
+        if self._count_cache is not None:
+            cache_key = self._cache_key(query._cname, "count", query._count_strategy, query._count_cap, query_key)
+            cached = self._count_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if query._count_strategy == COUNT_ESTIMATED and not query_key:
+            result = await self._estimated_count(query._cname), True
+        elif query._count_strategy == COUNT_CAPPED:
+            total = await self._find_count(query._cname, query_key, limit=query._count_cap)  # type: ignore
+            result = total, total >= query._count_cap  # type: ignore
+        else:
+            result = await self._find_count(query._cname, query_key), False
+
+        if cache_key is not None:
+            self._count_cache[cache_key] = result  # type: ignore
+        return result
 
     async def _update_one(self, cname: str, query_key: Dict, update_data: Dict, upsert: bool = False,
                           update_one: bool = True) -> Dict:
@@ -192,6 +648,9 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 1, "modified_count": 1, "upserted_id":"f"}
         """
+        started = time.perf_counter()
+        span = await self._before_operation(
+            "update_one" if update_one else "update_many", cname, query_key) if self.hooks else None
         try:
             if update_one:
                 result = await self.db.get_collection(cname).update_one(query_key, update_data, upsert=upsert)
@@ -207,6 +666,11 @@ class AsyncSession(SessionMixIn, object):
         else:
             return {"matched_count": result.matched_count, "modified_count": result.modified_count,
                     "upserted_id": str(result.upserted_id) if result.upserted_id else None}
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("update_one" if update_one else "update_many", cname, started, query_key)
+            if span is not None:
+                await self._after_operation(span)
 
     async def _update_many(self, cname: str, query_key: Dict, update_data: Dict, upsert: bool = False) -> Dict:
         """
@@ -231,6 +695,9 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回删除的数量
         """
+        started = time.perf_counter()
+        span = await self._before_operation(
+            "delete_one" if delete_one else "delete_many", cname, query_key) if self.hooks else None
         try:
             if delete_one:
                 result = await self.db.get_collection(cname).delete_one(query_key)
@@ -243,6 +710,11 @@ class AsyncSession(SessionMixIn, object):
             raise HttpError(400, message=self.message[102][self.msg_zh], error=err)
         else:
             return result.deleted_count
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("delete_one" if delete_one else "delete_many", cname, started, query_key)
+            if span is not None:
+                await self._after_operation(span)
 
     async def _delete_many(self, cname: str, query_key: Dict) -> int:
         """
@@ -255,7 +727,50 @@ class AsyncSession(SessionMixIn, object):
         """
         return await self._delete_one(cname, query_key, delete_one=False)
 
-    async def _aggregate(self, cname: str, pipline: List[Dict]) -> List[Dict]:
+    async def _bulk_write(self, cname: str, chunks: List[List], ordered: bool = True) -> Dict:
+        """
+        分块执行bulk write,并汇总所有分块的结果
+        Args:
+            cname: collection name
+            chunks: 分块后的bulk write请求
+            ordered: 是否按顺序执行,顺序执行时遇到错误后不再执行后面的分块
+        Returns:
+            返回汇总的结果
+        """
+        summary: Dict = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                         "upserted_count": 0, "upserted_id": {}, "write_errors": []}
+        offset = 0
+        started = time.perf_counter()
+        span = await self._before_operation("bulk_write", cname) if self.hooks else None
+        try:
+            collection = self.db.get_collection(cname)
+            for chunk in chunks:
+                try:
+                    result = await collection.bulk_write(chunk, ordered=ordered)
+                except BulkWriteError as err:
+                    self._merge_bulk_result(summary, err.details, offset)
+                    if ordered:
+                        break
+                else:
+                    self._merge_bulk_result(summary, result.bulk_api_result, offset)
+                offset += len(chunk)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Bulk write document failed, {}".format(err))
+            raise HttpError(400, message=self.message[106][self.msg_zh], error=err)
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("bulk_write", cname, started)
+            if span is not None:
+                await self._after_operation(span)
+
+        if summary["write_errors"]:
+            aelog.error("Bulk write document failed, {}".format(summary["write_errors"][:10]))
+            raise HttpError(400, message=self.message[106][self.msg_zh], error=summary)
+        return summary
+
+    async def _aggregate(self, cname: str, pipline: List[Dict], raw: bool = False) -> List[Dict]:
         """
         根据pipline进行聚合查询
         Args:
@@ -264,27 +779,37 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回聚合后的document
         """
-        result = []
+        result: List[Dict] = []
+        started = time.perf_counter()
+        span = await self._before_operation("aggregate", cname, pipline) if self.hooks else None
         try:
-            async for doc in self.db.get_collection(cname).aggregate(pipline):
-                if doc.get("_id", None) is not None:
-                    doc["id"] = str(doc.pop("_id"))
-                result.append(doc)
+            result = [doc async for doc in self._get_collection(cname, raw).aggregate(pipline)]
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Aggregate document failed, {}".format(err))
             raise HttpError(400, message=self.message[105][self.msg_zh], error=err)
         else:
-            return result
+            return result if raw else self._convert_ids(result)
+        finally:
+            self._record_operation("aggregate", cname, started, pipline, docs=len(result))
+            if span is not None:
+                await self._after_operation(span, len(result))
 
-    async def insert_many(self, query: Query) -> Tuple[str]:
+    async def insert_many(self, query: Query, *, chunk_size: int = 0, ordered: bool = True,
+                          concurrency: int = 0) -> List[str]:
         """
         批量插入文档
+
+        数据量很大时可以指定chunk_size分块插入,ordered为False时各个分块并发插入,
+        并发的数量默认和连接池的大小一致,插入失败时抛出第一个错误,错误的inserted_ids属性为已经插入成功的id列表
         Args:
             query: Query class
                 cname:collection name
                 document: document obj
+            chunk_size: 每块插入的document数量,默认0不分块
+            ordered: 是否按顺序插入,顺序插入时分块依次插入,遇到错误后停止插入后面的document
+            concurrency: 并发插入的最大分块数量,默认为连接池的大小
         Returns:
             返回插入的转换后的_id列表
         """
@@ -295,7 +820,60 @@ class AsyncSession(SessionMixIn, object):
             if not isinstance(document_, MutableMapping):
                 raise MongoError("insert one document failed, document is not a mapping type.")
             self._update_doc_id(document_)
-        return await self._insert_many(query._cname, document)
+
+        if chunk_size <= 0 or len(document) <= chunk_size:
+            chunks = [document]
+        else:
+            chunks = [document[i:i + chunk_size] for i in range(0, len(document), chunk_size)]
+        inserted_ids: List[str] = []
+        if ordered or len(chunks) == 1:
+            for chunk in chunks:
+                try:
+                    inserted_ids.extend(await self._insert_many(query._cname, chunk, ordered=ordered))
+                except Exception as e:
+                    inserted_ids.extend(self._chunk_inserted_ids(chunk, e, ordered))
+                    e.inserted_ids = inserted_ids  # type: ignore
+                    raise
+            return inserted_ids
+
+        semaphore = asyncio.Semaphore(concurrency if concurrency > 0 else self.pool_size)
+
+        async def insert_chunk(chunk_: List[Dict]) -> List[str]:
+            async with semaphore:
+                return await self._insert_many(query._cname, chunk_, ordered=False)
+
+        # 等待所有的分块都执行完成后再抛出第一个错误,其他分块中插入成功的id通过错误返回
+        results = await asyncio.gather(*[insert_chunk(chunk) for chunk in chunks], return_exceptions=True)
+        error: Optional[BaseException] = None
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                inserted_ids.extend(self._chunk_inserted_ids(chunk, result, False))
+                error = error or result
+            else:
+                inserted_ids.extend(result)
+        if error is not None:
+            error.inserted_ids = inserted_ids  # type: ignore
+            raise error
+        return inserted_ids
+
+    @staticmethod
+    def _chunk_inserted_ids(chunk: List[Dict], error: BaseException, ordered: bool) -> List[str]:
+        """
+        获取插入失败的分块中已经插入成功的document的id
+        Args:
+            chunk: 分块的document
+            error: 插入分块时的错误
+            ordered: 分块是否按顺序插入
+        Returns:
+            返回插入成功的转换后的_id列表
+        """
+        if not isinstance(error, HttpError) or not isinstance(error.error, BulkWriteError):
+            return []
+        failed = {err["index"] for err in error.error.details.get("writeErrors", [])}
+        if ordered:
+            # 顺序插入时第一个错误之后的document都没有插入
+            return [str(document["_id"]) for document in chunk[:min(failed, default=len(chunk))]]
+        return [str(document["_id"]) for index, document in enumerate(chunk) if index not in failed]
 
     async def insert_one(self, query: Query) -> str:
         """
@@ -312,6 +890,69 @@ class AsyncSession(SessionMixIn, object):
             raise MongoError("insert one document failed, document is not a mapping type.")
         return await self._insert_one(query._cname, self._update_doc_id(document))  # type: ignore
 
+    def buffered_insert_one(self, query: Query) -> asyncio.Future:
+        """
+        缓冲插入一个单独的文档
+
+        document先放入collection的缓冲区中,缓冲数量达到buffer_max_size或者等待时间达到
+        buffer_flush_interval时合并为一次无序的insert_many写入,每个调用者通过返回的future获取
+        自己的插入结果或者异常,缓冲区中的数据在服务停止时会全部写入
+        Args:
+            query: Query class
+                cname:collection name
+                document: document obj
+        Returns:
+            返回future,结果为插入的转换后的_id
+        """
+        document: Dict = query._insert_data  # type: ignore
+        if not isinstance(document, MutableMapping):
+            raise MongoError("insert one document failed, document is not a mapping type.")
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        cname = query._cname
+        buffer = self._insert_buffer.setdefault(cname, [])
+        buffer.append((self._update_doc_id(document), future))
+        if len(buffer) >= self.buffer_max_size:
+            self._flush_buffer(cname)
+        elif cname not in self._flush_handles:
+            self._flush_handles[cname] = loop.call_later(self.buffer_flush_interval, self._flush_buffer, cname)
+        return future
+
+    async def load_by_id(self, cname: str, doc_id: str) -> Optional[Dict]:
+        """
+        按id查询一个单独的document文档
+
+        同一个事件循环周期内对同一个collection的所有调用合并为一次$in查询,用于避免逐个对象
+        查询时的N+1问题
+        Args:
+            cname: collection name
+            doc_id: document的id
+        Returns:
+            返回匹配的document或者None
+        """
+        # 非法的id只影响当前的调用者
+        doc_id = str(self._update_query_key({"id": doc_id})["_id"])
+        future = asyncio.get_event_loop().create_future()
+        batch = self._load_batches.get(cname)
+        if batch is None:
+            batch = self._load_batches[cname] = {}
+            asyncio.get_event_loop().call_soon(self._dispatch_load, cname)
+        batch.setdefault(doc_id, []).append(future)
+        return await future
+
+    async def flush(self, ) -> None:
+        """
+        立即写入所有缓冲的document,并等待所有的写入完成
+        Args:
+
+        Returns:
+
+        """
+        for cname in list(self._insert_buffer):
+            self._flush_buffer(cname)
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
     async def find_one(self, query: Query) -> Optional[Dict]:
         """
         查询一个单独的document文档
@@ -323,8 +964,21 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document或者None
         """
-        return await self._find_one(query._cname, self._update_query_key(query._query_key),
-                                    exclude_key=query._exclude_key, sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None and not self.single_flight:
+            return await self._find_one(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                        raw=query._raw)
+
+        cache_key = self._cache_key(query._cname, "find_one", query_key, query._exclude_key, query._order_by,
+                                    query._raw)
+        cached = self._get_result_cache(cache_key) if query._cache_ttl is not None else None
+        if cached is not None:
+            return cached[0]
+        find_data = await self._single_flight(cache_key, self._find_one(
+            query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by, raw=query._raw))
+        if query._cache_ttl is not None:
+            self._set_result_cache(cache_key, find_data, query._cache_ttl)
+        return find_data
 
     # noinspection DuplicatedCode
     async def find_many(self, query: Query) -> AsyncPagination:
@@ -342,18 +996,114 @@ class AsyncSession(SessionMixIn, object):
             Returns a :class:`AsyncPagination` object.
         """
 
-        query_key = self._update_query_key(query._query_key)
-        items = await self._find_many(query._cname, query_key, exclude_key=query._exclude_key,
-                                      limit=query._limit_clause, skip=query._offset_clause, sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None and not self.single_flight:
+            return await self._paginate(query, query_key)
+
+        cache_key = self._cache_key(
+            query._cname, "find_many", query_key, query._exclude_key, query._order_by, query._offset_clause,
+            query._limit_clause, query._is_keyset, query._after, query._before, query._keyset_total,
+            query._use_facet, query._count_strategy, query._count_cap, query._raw)
+        cached = self._get_result_cache(cache_key) if query._cache_ttl is not None else None
+        if cached is not None:
+            state = cached[0]
+        else:
+            state = await self._single_flight(cache_key, self._paginate_state(query, query_key))
+            if query._cache_ttl is not None:
+                self._set_result_cache(cache_key, state, query._cache_ttl)
 
+        pagination = AsyncPagination(self, query, 0, [], query_key)
+        (pagination.total, pagination.total_approximate, pagination._has_prev, pagination._has_next,
+         pagination.items) = state
+        return pagination
+
+    async def _paginate_state(self, query: Query, query_key: Dict) -> Tuple:
+        """
+        分页查询document文档,返回可以缓存和共享的分页状态
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            返回(total, total_approximate, has_prev, has_next, items)
+        """
+        pagination = await self._paginate(query, query_key)
+        return (pagination.total, pagination.total_approximate, pagination._has_prev, pagination._has_next,
+                pagination.items)
+
+    # noinspection DuplicatedCode
+    async def _paginate(self, query: Query, query_key: Dict) -> AsyncPagination:
+        """
+        分页查询document文档
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            Returns a :class:`AsyncPagination` object.
+        """
+        if query._is_keyset:
+            return await self._find_keyset(query, query_key)
+
+        if query._use_facet:
+            items, total = await self._find_facet(query._cname, query_key, exclude_key=query._exclude_key,
+                                                  limit=query._limit_clause, skip=query._offset_clause,
+                                                  sort=query._order_by)
+            return AsyncPagination(self, query, total, items, query_key)
+
+        # 总数不是精确值时多查询一条数据用来判断是否有下一页
+        no_total = query._count_strategy == COUNT_NONE and query._per_page > 0
+        probe = query._count_strategy in (COUNT_NONE, COUNT_ESTIMATED, COUNT_CAPPED) and query._per_page > 0
+        limit = query._limit_clause + 1 if probe else query._limit_clause
+        items = await self._find_many(query._cname, query_key, exclude_key=query._exclude_key, limit=limit,
+                                      skip=query._offset_clause, sort=query._order_by, raw=query._raw)
+
+        has_next, total_approximate = None, False
+        if probe:
+            has_next = len(items) > query._per_page
+            del items[query._per_page:]
+        if no_total:
+            total = len(items) if query._page == 1 and not has_next else None
         # No need to count if we're on the first page and there are fewer
         # items than we expected.
-        if query._page == 1 and len(items) < query._per_page:
+        elif query._page == 1 and (len(items) < query._per_page or has_next is False):
             total = len(items)
         else:
-            total = await self.find_count(query)
+            total, total_approximate = await self._count_total(query, query_key)
+
+        pagination = AsyncPagination(self, query, total, items, query_key)
+        pagination.total_approximate, pagination._has_next = total_approximate, has_next
+        return pagination
+
+    async def _find_keyset(self, query: Query, query_key: Dict) -> AsyncPagination:
+        """
+        keyset(seek)分页查询,根据游标生成范围查询条件代替skip,多查询一条数据用来判断是否还有下一页
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            Returns a :class:`AsyncPagination` object.
+        """
+        pagination = AsyncPagination(self, query, 0, [], query_key)
+        cursor = query._after if query._before is None else query._before
+        backward = query._before is not None
+        if cursor is None:
+            find_key = query_key
+        else:
+            values = self._decode_keyset_cursor(cursor)
+            find_key = self._keyset_query_key(query_key, pagination.sort, values, backward)  # type: ignore
+        items = await self._find_many(query._cname, find_key, exclude_key=query._exclude_key, limit=query._per_page + 1,
+                                      sort=pagination._seek_sort(backward))
+        items = pagination._seek_result(items, backward)
+        if cursor is None:
+            pagination._has_prev = False
 
-        return AsyncPagination(self, query, total, items, query_key)
+        # 第一页并且没有下一页的时候不需要再查询总数,其他情况只有指定了with_total才计数,否则每一页都要全量计数
+        if cursor is None and not pagination._has_next:
+            pagination.total = len(items)
+        elif query._keyset_total:
+            pagination.total, pagination.total_approximate = await self._count_total(query, query_key)
+        else:
+            pagination.total = None
+        return pagination
 
     async def find_all(self, query: Query) -> List[Dict]:
         """
@@ -367,8 +1117,226 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document列表
         """
-        return await self._find_many(query._cname, self._update_query_key(query._query_key),
-                                     exclude_key=query._exclude_key, sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None and not self.single_flight:
+            return await self._find_many(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                         raw=query._raw)
+
+        cache_key = self._cache_key(query._cname, "find_all", query_key, query._exclude_key, query._order_by,
+                                    query._raw)
+        cached = self._get_result_cache(cache_key) if query._cache_ttl is not None else None
+        if cached is not None:
+            return cached[0]
+        find_data = await self._single_flight(cache_key, self._find_many(
+            query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by, raw=query._raw))
+        if query._cache_ttl is not None:
+            self._set_result_cache(cache_key, find_data, query._cache_ttl)
+        return find_data
+
+    def iter_many(self, query: Query, batch_size: int = 100, yield_batch: bool = False
+                  ) -> AsyncIterator[Union[Dict, List[Dict]]]:
+        """
+        流式查询document文档,适用于导出等需要遍历大量数据的场景,内存占用只和batch_size有关
+
+        eg: async for doc in session.iter_many(query): ...
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+                sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            batch_size: 游标每次从服务端拉取的document数量,默认100
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            逐条或者按批次返回匹配的document的异步生成器
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        return self._iter_many(query._cname, self._gen_query_key(query), exclude_key=query._exclude_key,
+                               sort=query._order_by, batch_size=batch_size, yield_batch=yield_batch, raw=query._raw)
+
+    async def _gen_partitions(self, query: Query, partitions: int, field: str) -> List[Dict]:
+        """
+        对分区字段采样,生成每个分区的查询条件
+        Args:
+            query: Query class
+            partitions: 分区的数量
+            field: 分区的字段
+        Returns:
+            返回每个分区的查询条件
+        """
+        if partitions <= 0:
+            raise FuncArgsError("partitions must be greater than 0.")
+        query_key = self._gen_query_key(query)
+        partitions = min(partitions, self.pool_size)
+        if partitions == 1:
+            return [query_key]
+        field = "_id" if field == "id" else field
+        samples = await self._partition_range_samples(query._cname, query_key, field, partitions) if query_key else None
+        if samples is None:
+            samples = await self._aggregate(query._cname, self._partition_pipline(query_key, field, partitions))
+        return self._partition_query_keys(query_key, field, samples, partitions)
+
+    async def _partition_range_samples(self, cname: str, query_key: Dict, field: str,
+                                        partitions: int) -> Optional[List[Dict]]:
+        """
+        有查询条件时根据分区字段的最大值和最小值插值生成分区边界,按照字段排序只读取两条document,
+        分区字段有索引时不需要像$match之后的$sample那样扫描所有匹配的document
+        Args:
+            cname: collection name
+            query_key: 处理后的查询document的过滤条件
+            field: 分区的字段
+            partitions: 分区的数量
+        Returns:
+            返回插值的结果,没有匹配的document或者字段类型不能插值时返回None
+        """
+        high_docs = await self._find_many(cname, query_key, {field: 1}, limit=1, sort=[(field, -1)])
+        if not high_docs:
+            return None
+        high = self._keyset_values(high_docs[0], [(field, 1)])[0]
+        alias = self._partition_type(high)
+        if alias is None:
+            return None
+        # null和其他类型的值排在前面,最小值只在和最大值相同类型的值中查找
+        low_docs = await self._find_many(cname, {"$and": [query_key, {field: {"$type": alias}}]}, {field: 1},
+                                         limit=1, sort=[(field, 1)])
+        low = self._keyset_values(low_docs[0], [(field, 1)])[0]
+        return self._interpolate_partition_samples(low, high, partitions)
+
+    async def scan_partitions(self, query: Query, partitions: int = 4, *, field: str = "_id", batch_size: int = 1000,
+                              yield_batch: bool = False) -> List[AsyncIterator[Union[Dict, List[Dict]]]]:
+        """
+        按照字段的范围把查询拆分为多个分区,返回每个分区的异步迭代器,由调用方自行分发处理
+
+        没有查询条件时分区的边界通过$sample采样确定,有查询条件时根据分区字段的最大值和最小值插值,
+        分区之间没有重叠,不保证document的顺序
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+            partitions: 分区的数量,不超过连接池的大小
+            field: 分区的字段,默认为_id,使用其他字段时最好是有索引的单一类型的字段
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            返回每个分区的异步迭代器列表
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        query_keys = await self._gen_partitions(query, partitions, field)
+        return [self._iter_many(query._cname, query_key, exclude_key=query._exclude_key, batch_size=batch_size,
+                                yield_batch=yield_batch, raw=query._raw, operation="scan_partition")
+                for query_key in query_keys]
+
+    async def parallel_scan(self, query: Query, partitions: int = 4, *, field: str = "_id", batch_size: int = 1000,
+                            yield_batch: bool = False) -> AsyncIterator[Union[Dict, List[Dict]]]:
+        """
+        并行扫描collection,适用于导出等需要遍历整个collection的场景
+
+        按照字段的范围把查询拆分为多个分区,每个分区使用单独的游标并发读取,读取的结果合并为一个异步迭代器返回,
+        不保证document的顺序,提前退出迭代时会取消所有分区的读取
+
+        eg: async for doc in session.parallel_scan(query, partitions=8): ...
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+            partitions: 分区的数量,不超过连接池的大小
+            field: 分区的字段,默认为_id,使用其他字段时最好是有索引的单一类型的字段
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            逐条或者按批次返回匹配的document的异步生成器
+        """
+        iterators = await self.scan_partitions(query, partitions, field=field, batch_size=batch_size, yield_batch=True)
+        batches: asyncio.Queue = asyncio.Queue(maxsize=len(iterators) * 2)
+        done = object()
+
+        async def scan(iterator: AsyncIterator) -> None:
+            try:
+                async for batch_ in iterator:
+                    await batches.put(batch_)
+                await batches.put(done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 分区的读取错误交给调用方处理
+                await batches.put(e)
+
+        tasks = [asyncio.ensure_future(scan(iterator)) for iterator in iterators]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                batch = await batches.get()
+                if batch is done:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                elif yield_batch:
+                    yield batch
+                else:
+                    for doc in batch:
+                        yield doc
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 被取消的分区可能停在yield处,生成器不会自动结束,显式关闭生成器释放服务端的游标
+            await asyncio.gather(*[iterator.aclose() for iterator in iterators], return_exceptions=True)
+
+    async def gather(self, *queries: Tuple[str, Query], limit: int = 0) -> List[Any]:
+        """
+        并发执行多个相互独立的查询,总耗时取决于最慢的查询而不是所有查询的耗时之和
+
+        eg: total, page = await session.gather(("find_count", query1), ("find_many", query2))
+        Args:
+            queries: (操作名称, Query), 操作名称为find_one, find_many, find_all, find_count, aggregate等session方法
+            limit: 最大并发数量,默认为连接池的大小
+        Returns:
+            按照queries的顺序返回每个查询的结果,查询失败时对应的位置为异常
+        """
+        operations = self._gather_operations(queries)
+        semaphore = asyncio.Semaphore(limit if limit > 0 else self.pool_size)
+
+        async def run(operation: Any, query: Query) -> Any:
+            async with semaphore:
+                return await operation(query)
+
+        return await asyncio.gather(*[run(operation, query) for operation, query in operations],
+                                    return_exceptions=True)
+
+    async def find_columns(self, query: Query, fields: Sequence[str], dtypes: Dict[str, Any] = None,
+                           batch_size: int = 1000) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        按列查询document文档,适用于分析计算等需要把大量数据转换为数组的场景
+
+        游标按批次拉取数据并逐列写入可增长的类型化数组,不保留每行的document,安装了numpy时返回numpy数组,
+        否则返回array.array,没有指定类型或者array.array不支持的类型返回list
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            fields: 要查询的字段名称,支持a.b的嵌套形式,只会从mongo中查询这些字段
+            dtypes: 字段的类型, eg: {"age": "int64", "score": "float64"},没有指定的字段为object
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+        Returns:
+            返回(字段名称和数组的dict, 字段名称和mask的dict), mask中为True(1)的位置表示值缺失或者为null
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        builder = ColumnarBuilder(fields, dtypes)
+        batches = self._iter_many(query._cname, self._gen_query_key(query), exclude_key=builder.projection,
+                                  sort=query._order_by, batch_size=batch_size, yield_batch=True,
+                                  operation="find_columns")
+        try:
+            async for batch in batches:
+                builder.extend(batch)
+        finally:
+            await batches.aclose()  # type: ignore
+        return builder.result()
 
     async def find_count(self, query: Query) -> int:
         """
@@ -380,7 +1348,7 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document数量
         """
-        return await self._find_count(query._cname, self._update_query_key(query._query_key))
+        return await self._find_count(query._cname, self._gen_query_key(query))
 
     async def update_many(self, query: Query) -> Dict:
         """
@@ -394,7 +1362,7 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 2, "modified_count": 2, "upserted_id":"f"}
         """
-        return await self._update_many(query._cname, self._update_query_key(query._query_key),
+        return await self._update_many(query._cname, self._gen_query_key(query),
                                        self._update_update_data(query._update_data), upsert=query._upsert)
 
     async def update_one(self, query: Query) -> Dict:
@@ -409,7 +1377,7 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 1, "modified_count": 1, "upserted_id":"f"}
         """
-        return await self._update_one(query._cname, self._update_query_key(query._query_key),
+        return await self._update_one(query._cname, self._gen_query_key(query),
                                       self._update_update_data(query._update_data), upsert=query._upsert)
 
     async def delete_many(self, query: Query) -> int:
@@ -423,7 +1391,7 @@ class AsyncSession(SessionMixIn, object):
             返回删除的数量
         """
         return await self._delete_many(query._cname,
-                                       self._update_query_key(query._query_key))
+                                       self._gen_query_key(query))
 
     async def delete_one(self, query: Query) -> int:
         """
@@ -435,7 +1403,25 @@ class AsyncSession(SessionMixIn, object):
         Returns:
             返回删除的数量
         """
-        return await self._delete_one(query._cname, self._update_query_key(query._query_key))
+        return await self._delete_one(query._cname, self._gen_query_key(query))
+
+    async def bulk_write(self, query: Query, *, chunk_size: int = 1000) -> Dict:
+        """
+        批量执行混合的插入,更新,替换和删除操作,操作会按照数量分块发送
+        Args:
+            query: Query class
+                cname: collection name
+                bulk_ops: 通过bulk_insert,bulk_update,bulk_replace,bulk_delete添加的操作
+                bulk_ordered: 是否按顺序执行
+            chunk_size: 每块最多的操作数量,每块的消息大小超过服务端的限制时由pymongo继续拆分
+        Returns:
+            返回汇总的结果, eg:{"inserted_count": 1, "matched_count": 1, "modified_count": 1, "deleted_count": 1,
+                              "upserted_count": 1, "upserted_id": {2: "f"}, "write_errors": []}
+        """
+        if chunk_size <= 0:
+            raise FuncArgsError("chunk_size must be greater than 0.")
+        chunks = self._gen_bulk_requests(query._bulk_ops, chunk_size=chunk_size)
+        return await self._bulk_write(query._cname, chunks, ordered=query._bulk_ordered)
 
     # noinspection DuplicatedCode
     async def aggregate(self, query: Query) -> List[Dict]:
@@ -455,7 +1441,7 @@ class AsyncSession(SessionMixIn, object):
             raise MongoError("Aggregate query failed, pipline arg is not a iterable type.")
         if query._limit_clause and query._per_page:
             pipline.extend([{'$skip': query._limit_clause}, {'$limit': query._per_page}])
-        return await self._aggregate(query._cname, pipline)
+        return await self._aggregate(query._cname, pipline, raw=query._raw)
 
 
 class AsyncMongo(AlchemyMixIn, BaseMongo):
@@ -504,6 +1490,9 @@ class AsyncMongo(AlchemyMixIn, BaseMongo):
             Returns:
 
             """
+            # 关闭连接前写入所有缓冲的document
+            for _, session in self.session_pool.items():
+                await session.flush()
             for _, engine in self.engine_pool.items():
                 if engine:
                     engine.close()
@@ -515,7 +1504,8 @@ class AsyncMongo(AlchemyMixIn, BaseMongo):
         try:
             if engine_name not in self.engine_pool:
                 self.engine_pool[engine_name] = AsyncIOMotorClient(
-                    host, port, username=username, password=passwd, maxPoolSize=pool_size)
+                    host, port, username=username, password=passwd, maxPoolSize=pool_size,
+                    event_listeners=self._engine_listeners(engine_name))
             db = self.engine_pool[engine_name].get_database(name=dbname)
         except ConnectionFailure as e:
             aelog.exception("Mongo connection failed host={} port={} error:{}".format(host, port, e))
@@ -529,6 +1519,19 @@ class AsyncMongo(AlchemyMixIn, BaseMongo):
         else:
             return db
 
+    def _session_options(self, bind: str = None) -> Dict:
+        """
+        生成session时使用的配置
+        Args:
+            bind: engine pool one of connection
+        Returns:
+
+        """
+        options = super()._session_options(bind)
+        options.update({"buffer_max_size": self.buffer_max_size, "buffer_flush_interval": self.buffer_flush_interval,
+                        "single_flight": self.single_flight})
+        return options
+
     @property
     def query(self, ) -> Query:
         """
@@ -552,7 +1555,8 @@ class AsyncMongo(AlchemyMixIn, BaseMongo):
         if None not in self.bind_pool:
             raise ValueError("Default bind is not exist.")
         if None not in self.session_pool:
-            self.session_pool[None] = AsyncSession(self.bind_pool[None], self.message, self.msg_zh)
+            self.session_pool[None] = AsyncSession(self.bind_pool[None], self.message, self.msg_zh,
+                                                   **self._session_options())
         return self.session_pool[None]
 
     def gen_session(self, bind: str) -> AsyncSession:
@@ -565,5 +1569,6 @@ class AsyncMongo(AlchemyMixIn, BaseMongo):
         """
         self._get_engine(bind)
         if bind not in self.session_pool:
-            self.session_pool[bind] = AsyncSession(self.bind_pool[bind], self.message, self.msg_zh)
+            self.session_pool[bind] = AsyncSession(self.bind_pool[bind], self.message, self.msg_zh,
+                                                   **self._session_options(bind))
         return self.session_pool[bind]
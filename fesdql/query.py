@@ -6,14 +6,152 @@
 @software: PyCharm
 @time: 2020/3/1 上午12:00
 """
+import copy
+import hashlib
 import inspect
-from typing import (Any, Dict, List, Optional, Tuple, Type, Union)
+from typing import (Any, Callable, Dict, List, MutableMapping, Optional, Tuple, Type, Union)
 
+from bson import ObjectId, json_util
+from bson.errors import BSONError
 from marshmallow import Schema
 
 from .err import FuncArgsError
 
-__all__ = ("Query",)
+__all__ = ("Query", "Param", "PreparedQuery")
+
+# 分页查询时总数的计算方式
+COUNT_EXACT, COUNT_ESTIMATED, COUNT_CAPPED, COUNT_NONE = "exact", "estimated", "capped", "none"
+
+
+def normalize_query_key(query_key: Optional[Dict], to_object_id: Callable = ObjectId,
+                        to_object_ids: Callable = None) -> Dict:
+    """
+    处理查询的query key,操作符前加上$,id转换为ObjectId类型的_id
+    Args:
+        query_key: 查询document的过滤条件
+        to_object_id: 把单个id转换为ObjectId的函数
+        to_object_ids: 把id列表转换为ObjectId列表的函数,用于in和nin操作
+    Returns:
+        返回处理后的query key
+    """
+    if to_object_ids is None:
+        def to_object_ids(vals):
+            return [to_object_id(val) for val in vals]
+
+    query_key = dict(query_key) if query_key else {}
+    try:
+        for key, val in list(query_key.items()):
+            if isinstance(val, MutableMapping):
+                if key != "id":
+                    query_key[key] = {key if key.startswith("$") else f"${key}": val for key, val in val.items()}
+                else:
+                    query_key["_id"] = {
+                        key if key.startswith("$") else f"${key}": to_object_ids(val)
+                        if "in" in key else val for key, val in query_key.pop(key).items()}
+            else:
+                if key == "id":
+                    query_key["_id"] = to_object_id(query_key.pop("id"))
+    except BSONError as e:
+        raise FuncArgsError(str(e))
+    else:
+        return query_key
+
+
+class Param(object):
+    """
+    预编译查询中命名参数的占位符
+
+    eg: Query().collection("user").where(age={"gt": Param("age")}).prepare().bind(age=18)
+    """
+
+    __slots__ = ("name", "convert")
+
+    def __init__(self, name: str, convert: Callable = None):
+        """
+            命名参数
+        Args:
+            name: 参数名称
+            convert: 绑定参数时对参数值的转换,例如id转换为ObjectId
+        """
+        self.name: str = name
+        self.convert: Optional[Callable] = convert
+
+    def __repr__(self):
+        return "Param({!r})".format(self.name)
+
+    def value(self, params: Dict) -> Any:
+        """
+        获取绑定的参数值
+        Args:
+            params: 绑定的参数
+        Returns:
+            返回转换后的参数值
+        """
+        if self.name not in params:
+            raise FuncArgsError("Missing param {}".format(self.name))
+        val = params[self.name]
+        return self.convert(val) if self.convert is not None else val
+
+
+def _compile_template(node: Any) -> Tuple[bool, Any]:
+    """
+    编译包含参数占位符的模板,不包含参数的部分原样共享
+    Args:
+        node: query key中的值
+    Returns:
+        返回(是否包含参数, 常量或者根据参数生成值的函数)
+    """
+    if isinstance(node, Param):
+        return True, node.value
+    if isinstance(node, dict):
+        items = [(key,) + _compile_template(val) for key, val in node.items()]
+        if not any(has_param for _, has_param, _ in items):
+            return False, node
+        return True, lambda params: {key: val(params) if has_param else val for key, has_param, val in items}
+    if isinstance(node, (list, tuple)):
+        items_ = [_compile_template(val) for val in node]
+        if not any(has_param for has_param, _ in items_):
+            return False, node
+        node_type = type(node)
+        return True, lambda params: node_type(val(params) if has_param else val for has_param, val in items_)
+    return False, node
+
+
+def _template_shape(node: Any) -> Any:
+    """
+    生成模板的结构,参数占位符替换为?
+    Args:
+        node: query key中的值
+    Returns:
+        返回模板的结构
+    """
+    if isinstance(node, Param):
+        return "?"
+    if isinstance(node, dict):
+        return {key: _template_shape(val) for key, val in node.items()}
+    if isinstance(node, (list, tuple)):
+        return [_template_shape(val) for val in node]
+    return node
+
+
+def schema_projection(schema_cls: Type[Schema]) -> Dict[str, int]:
+    """
+    根据schema中声明的字段生成projection,字段有attribute映射时使用attribute,结果缓存在schema类上
+    Args:
+        schema_cls: Schema或者gen_schema生成的Schema
+    Returns:
+        返回projection, eg: {"name": 1, "age": 1}
+    """
+    projection = schema_cls.__dict__.get("_auto_projection")
+    if projection is None:
+        projection = {}
+        for attr_name, attr_field in getattr(schema_cls, "_declared_fields", {}).items():
+            field_name = getattr(attr_field, "attribute", None) or attr_name
+            # 嵌套字段只需要顶层的字段
+            field_name = field_name.split(".")[0]
+            projection["_id" if field_name == "id" else field_name] = 1
+        setattr(schema_cls, "_auto_projection", projection)
+    return projection
 
 
 class BaseQuery(object):
@@ -47,6 +185,18 @@ class BaseQuery(object):
         self._offset_clause: int = 0
         # aggregate 聚合查询的pipeline,包含一个后者多个聚合命令
         self._pipline: List[Dict] = []
+        # 查询结果缓存的过期时间,单位秒,None表示不缓存
+        self._cache_ttl: Optional[float] = None
+        # 是否返回RawBSONDocument,字段在访问时才解码
+        self._raw: bool = False
+        # bulk write的操作列表, eg: [("insert_one", {"document": {...}})]
+        self._bulk_ops: List[Tuple[str, Dict]] = []
+        # bulk write是否按顺序执行,顺序执行时遇到错误后停止
+        self._bulk_ordered: bool = True
+        # query key是否已经处理过,预编译查询绑定参数后为True
+        self._normalized: bool = False
+        # 是否根据schema的字段自动生成projection
+        self._auto_project: bool = False
 
     def where(self, **query_key) -> 'BaseQuery':
         """
@@ -59,22 +209,31 @@ class BaseQuery(object):
         """
         if self._query_key is None:
             self._query_key = {}
-        self._query_key.update(query_key)
+        self._query_key.update(normalize_query_key(query_key) if self._normalized else query_key)
         return self
 
-    def collection(self, cclause: Union[Type[Schema], str]) -> 'BaseQuery':
+    def collection(self, cclause: Union[Type[Schema], str], *, auto_project: bool = False) -> 'BaseQuery':
         """
         return basequery construct with the given expression added to
         its model clause.
 
         Arg:
             modelclause: Schema或者collection的名称
+            auto_project: cclause为Schema时,是否根据Schema中声明的字段自动生成projection,
+                查询时只返回Schema中使用的字段
         """
         if inspect.isclass(cclause) and issubclass(cclause, Schema):  # type: ignore
             cclause_ = getattr(cclause, "__tablename__", None)
             if cclause_ is None:
                 raise FuncArgsError("cclause(Schema)中没有__tablename__属性")
             self._cname = cclause_
+            if auto_project:
+                # 之前设置的exclude按照自动生成的projection重新处理,排除的字段从projection中删除
+                exclude_key, self._exclude_key = self._exclude_key or {}, dict(schema_projection(cclause))
+                self._auto_project = True
+                self.exclude(**exclude_key)
+                for one_order in self._order_by or []:
+                    self._exclude_key.setdefault(one_order[0].split(".")[0], 1)  # type: ignore
         elif isinstance(cclause, str):
             self._cname = cclause
         else:
@@ -98,6 +257,9 @@ class BaseQuery(object):
             self._order_by = []
         for one_order in clauses:
             self._order_by.append(one_order)
+            # 自动生成的projection中需要包含排序字段,keyset分页时需要排序字段的值生成游标
+            if self._auto_project and self._exclude_key is not None:
+                self._exclude_key.setdefault(one_order[0].split(".")[0], 1)
         return self
 
     def upsert(self, upsert: bool = False) -> 'BaseQuery':
@@ -125,7 +287,100 @@ class BaseQuery(object):
         """
         if self._exclude_key is None:
             self._exclude_key = {}
-        self._exclude_key.update(exclude)
+        if not self._auto_project:
+            self._exclude_key.update(exclude)
+            return self
+        # 自动生成的projection为包含字段的方式,排除字段时从projection中删除
+        for key, val in exclude.items():
+            if val or key == "_id":
+                self._exclude_key[key] = val
+            else:
+                self._exclude_key.pop(key, None)
+        return self
+
+    def cache(self, ttl: float = 60) -> 'BaseQuery':
+        """
+        缓存find_one,find_many,find_all的查询结果,相同的查询在过期之前不再访问mongo,
+        通过同一个session写入该collection后缓存自动失效
+
+        Args:
+            ttl: 缓存的过期时间,单位秒
+        Returns:
+
+        """
+        if ttl <= 0:
+            raise FuncArgsError("cache ttl must be greater than 0.")
+        self._cache_ttl = ttl
+        return self
+
+    def raw(self, raw: bool = True) -> 'BaseQuery':
+        """
+        查询结果返回RawBSONDocument,字段在访问时才解码,原始的BSON字节可以通过raw属性获取,
+        适用于只访问少量字段或者直接转发BSON数据的场景,返回的document不会把_id转换为id
+
+        keyset分页和use_facet分页不支持raw模式
+        Args:
+            raw: 是否返回RawBSONDocument
+        Returns:
+
+        """
+        self._raw = raw
+        return self
+
+    def bulk_insert(self, document: Dict) -> 'BaseQuery':
+        """
+        bulk write中增加一个插入操作
+
+        Args:
+            document: 要插入的document
+        Returns:
+
+        """
+        self._bulk_ops.append(("insert_one", {"document": document}))
+        return self
+
+    def bulk_update(self, query_key: Dict, update_data: Dict, *, upsert: bool = False,
+                    multi: bool = False) -> 'BaseQuery':
+        """
+        bulk write中增加一个更新操作
+
+        Args:
+            query_key: 查询document的过滤条件
+            update_data: 对匹配的document进行更新的document
+            upsert: 没有匹配到document的话执行插入操作，默认False
+            multi: 是否更新匹配到的所有document,默认False只更新一个
+        Returns:
+
+        """
+        self._bulk_ops.append(("update_many" if multi else "update_one",
+                               {"query_key": query_key, "update_data": update_data, "upsert": upsert}))
+        return self
+
+    def bulk_replace(self, query_key: Dict, document: Dict, *, upsert: bool = False) -> 'BaseQuery':
+        """
+        bulk write中增加一个替换操作
+
+        Args:
+            query_key: 查询document的过滤条件
+            document: 替换匹配的document的新document
+            upsert: 没有匹配到document的话执行插入操作，默认False
+        Returns:
+
+        """
+        self._bulk_ops.append(("replace_one", {"query_key": query_key, "document": document, "upsert": upsert}))
+        return self
+
+    def bulk_delete(self, query_key: Dict, *, multi: bool = False) -> 'BaseQuery':
+        """
+        bulk write中增加一个删除操作
+
+        Args:
+            query_key: 查询document的过滤条件
+            multi: 是否删除匹配到的所有document,默认False只删除一个
+        Returns:
+
+        """
+        self._bulk_ops.append(("delete_many" if multi else "delete_one", {"query_key": query_key}))
         return self
 
     def aggregation(self, pipline: List[Dict[str, Any]]) -> 'BaseQuery':
@@ -163,6 +418,20 @@ class Query(BaseQuery):
         self._per_page: int = 20
         # aggregation
         self._is_aggregation: Optional[bool] = None
+        # keyset(seek)分页,为True时使用范围查询代替skip
+        self._is_keyset: bool = False
+        # keyset分页的游标,查询该游标之后的数据
+        self._after: Optional[str] = None
+        # keyset分页的游标,查询该游标之前的数据
+        self._before: Optional[str] = None
+        # keyset分页时是否计算总数
+        self._keyset_total: bool = False
+        # 分页查询时使用$facet一次查询出当前页的数据和总数
+        self._use_facet: bool = False
+        # 分页查询时总数的计算方式
+        self._count_strategy: str = COUNT_EXACT
+        # capped计数方式下最大的计数值
+        self._count_cap: Optional[int] = None
 
         super().__init__()
 
@@ -194,6 +463,21 @@ class Query(BaseQuery):
         cls_instance._page = kwargs.get("page", 1)
         #: the number of items to be displayed on a page.
         cls_instance._per_page = kwargs.get("per_page", 20)
+        # keyset paginate
+        cls_instance._is_keyset = kwargs.get("is_keyset", False)
+        cls_instance._after = kwargs.get("after")
+        cls_instance._before = kwargs.get("before")
+        cls_instance._keyset_total = kwargs.get("keyset_total", False)
+        cls_instance._use_facet = kwargs.get("use_facet", False)
+        cls_instance._count_strategy = kwargs.get("count_strategy", COUNT_EXACT)
+        cls_instance._count_cap = kwargs.get("count_cap")
+        cls_instance._cache_ttl = kwargs.get("cache_ttl")
+        cls_instance._raw = kwargs.get("raw", False)
+        cls_instance._normalized = kwargs.get("normalized", False)
+        cls_instance._auto_project = kwargs.get("auto_project", False)
+        # bulk write
+        cls_instance._bulk_ops = kwargs.get("bulk_ops", [])
+        cls_instance._bulk_ordered = kwargs.get("bulk_ordered", True)
         return cls_instance
 
     def _verify_collection(self, ):
@@ -232,6 +516,21 @@ class Query(BaseQuery):
         self._update_data = update_data
         return self
 
+    def bulk_query(self, *, ordered: bool = True) -> 'Query':
+        """
+        bulk write query, 操作通过bulk_insert,bulk_update,bulk_replace,bulk_delete添加
+        Args:
+            ordered: 是否按顺序执行,顺序执行时遇到错误后停止执行后面的操作,
+                否则继续执行其他操作,并且服务端可以并行执行
+        Returns:
+            返回bulk write的汇总结果
+        """
+        self._verify_collection()
+        if not self._bulk_ops:
+            raise FuncArgsError("bulk query need at least one operation.")
+        self._bulk_ordered = ordered
+        return self
+
     def delete_query(self, ) -> 'Query':
         """
         delete query
@@ -254,7 +553,7 @@ class Query(BaseQuery):
         self._is_aggregation = is_agg
         return self
 
-    def paginate_query(self, *, page: int = 1, per_page: int = 20) -> 'Query':
+    def paginate_query(self, *, page: int = 1, per_page: int = 20, use_facet: bool = False) -> 'Query':
         """
         If ``page`` or ``per_page`` are ``None``, they will be retrieved from
         the request query. If ``max_per_page`` is specified, ``per_page`` will
@@ -266,6 +565,8 @@ class Query(BaseQuery):
         Args:
             page: page is less than 1, or ``per_page`` is negative.
             per_page: page or per_page are not ints.
+            use_facet: 是否使用$facet聚合一次查询出当前页的数据和总数,这样每页只需要访问一次mongo,
+                当前页数据的大小不能超过16M的文档大小限制
 
             ``page`` and ``per_page`` default to 1 and 20 respectively.
 
@@ -283,6 +584,7 @@ class Query(BaseQuery):
             per_page = 20
 
         self._page, self._per_page = page, per_page
+        self._use_facet = use_facet
 
         # 如果per_page为0,则证明要获取所有的数据，否则还是通常的逻辑
         if per_page != 0:
@@ -291,6 +593,75 @@ class Query(BaseQuery):
 
         return self
 
+    def count_strategy(self, strategy: str = COUNT_EXACT, *, cap: int = None) -> 'Query':
+        """
+        分页查询时总数的计算方式,默认使用count_documents精确计数
+
+        Args:
+            strategy: 总数的计算方式
+                exact: 使用count_documents精确计数
+                estimated: 过滤条件为空时使用estimated_document_count根据集合元数据估算总数,否则精确计数
+                capped: 最多计数到cap条,达到cap时总数为近似值
+                none: 不计算总数,多查询一条数据来判断是否有下一页,分页结果中total和pages为None
+            cap: capped方式下最大的计数值
+        Returns:
+
+        """
+        if strategy not in (COUNT_EXACT, COUNT_ESTIMATED, COUNT_CAPPED, COUNT_NONE):
+            raise FuncArgsError(f"count strategy {strategy} is not supported.")
+        if strategy == COUNT_CAPPED and (not isinstance(cap, int) or cap <= 0):
+            raise FuncArgsError("capped count strategy need a cap greater than 0.")
+        self._count_strategy, self._count_cap = strategy, cap
+        return self
+
+    def keyset_query(self, *, after: str = None, before: str = None, per_page: int = 20,
+                     with_total: bool = False) -> 'Query':
+        """
+        keyset(seek)分页,按照order_by的字段加上_id组成的游标进行范围查询,不再使用skip跳过数据,
+        这样即使翻到很深的页数查询的耗时也是固定的.
+
+        after和before都为None时查询第一页,游标从上一次分页结果的next_cursor和prev_cursor中获取,
+        排序的字段不能在exclude中被过滤掉,否则无法生成游标.
+
+        Args:
+            after: 查询该游标之后的一页数据, Pagination.next_cursor
+            before: 查询该游标之前的一页数据, Pagination.prev_cursor
+            per_page: 每页数据的数量
+            with_total: 是否计算总数,默认False,分页结果中total和pages为None,是否有上一页和下一页不依赖总数;
+                为True时按照count_strategy计算总数,每一页都会执行一次计数
+
+        Returns:
+
+        """
+        self._verify_collection()
+        if after is not None and before is not None:
+            raise FuncArgsError("after and before can not be used at the same time.")
+        if self.max_per_page is not None:
+            per_page = min(per_page, self.max_per_page)
+
+        # keyset分页必须要有每页的数量
+        if per_page <= 0:
+            per_page = 20
+
+        self._is_keyset = True
+        self._after, self._before = after, before
+        self._keyset_total = with_total
+        self._page, self._per_page = 1, per_page
+        self._limit_clause, self._offset_clause = per_page, 0
+
+        return self
+
+    def prepare(self, ) -> 'PreparedQuery':
+        """
+        把包含Param占位符的查询预编译为PreparedQuery,之后每次只需要绑定参数
+        Args:
+
+        Returns:
+            返回预编译的查询
+        """
+        self._verify_collection()
+        return PreparedQuery(self)
+
     def sql(self, ) -> Dict:
         """
         generate dict
@@ -300,19 +671,136 @@ class Query(BaseQuery):
 
         """
 
-        if self._insert_data:
+        if self._bulk_ops:
+            result_sql = {"cname": self._cname, "bulk_ops": self._bulk_ops, "bulk_ordered": self._bulk_ordered,
+                          "max_per_page": self.max_per_page}
+        elif self._insert_data:
             result_sql = {"cname": self._cname, "insert_data": self._insert_data, "max_per_page": self.max_per_page}
         elif self._update_data:
             result_sql = {"cname": self._cname, "query_key": self._query_key, "update_data": self._update_data,
-                          "upsert": self._upsert, "max_per_page": self.max_per_page}
+                          "upsert": self._upsert, "max_per_page": self.max_per_page, "normalized": self._normalized}
         elif self._is_aggregation:
             result_sql = {"cname": self._cname, "pipline": self._pipline, "page": self._page,
                           "per_page": self._per_page, "max_per_page": self.max_per_page,
-                          "limit_clause": self._limit_clause, "offset_clause": self._offset_clause}
+                          "limit_clause": self._limit_clause, "offset_clause": self._offset_clause,
+                          "raw": self._raw}
         else:
             result_sql = {"cname": self._cname, "query_key": self._query_key, "exclude_key": self._exclude_key,
                           "page": self._page, "per_page": self._per_page, "order_by": self._order_by,
                           "max_per_page": self.max_per_page, "limit_clause": self._limit_clause,
-                          "offset_clause": self._offset_clause}
+                          "offset_clause": self._offset_clause, "is_keyset": self._is_keyset,
+                          "after": self._after, "before": self._before, "keyset_total": self._keyset_total,
+                          "use_facet": self._use_facet,
+                          "count_strategy": self._count_strategy, "count_cap": self._count_cap,
+                          "cache_ttl": self._cache_ttl, "raw": self._raw, "normalized": self._normalized,
+                          "auto_project": self._auto_project}
 
         return result_sql
+
+
+class PreparedQuery(object):
+    """
+    预编译的查询
+
+    查询条件在预编译时处理一次,操作符前加上$,id转换为ObjectId类型的_id,每次调用只需要绑定参数,
+    生成的Query不再经过session中的query key处理
+    """
+
+    def __init__(self, query: Query):
+        """
+            预编译查询
+        Args:
+            query: 包含Param占位符的Query模板
+        """
+        self._query: Query = query
+        query_key = normalize_query_key(
+            query._query_key, to_object_id=self._to_object_id, to_object_ids=self._to_object_ids)
+        self._query_key: Dict = query_key
+        self._has_param, self._gen_query_key = _compile_template(query_key)
+        self._params: Tuple[str, ...] = tuple(sorted(self._param_names(query_key)))
+        self.shape_hash: str = hashlib.md5(json_util.dumps(
+            [query._cname, _template_shape(query_key), query._exclude_key, query._order_by],
+            sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _to_object_id(val: Any) -> Any:
+        """
+        预编译时转换id,参数占位符在绑定参数时再转换
+        Args:
+            val: id或者参数占位符
+        Returns:
+            返回ObjectId或者参数占位符
+        """
+        if isinstance(val, Param):
+            return Param(val.name, ObjectId)
+        return ObjectId(val)
+
+    @staticmethod
+    def _to_object_ids(vals: Any) -> Any:
+        """
+        预编译时转换id列表,参数占位符在绑定参数时再转换
+        Args:
+            vals: id列表或者参数占位符
+        Returns:
+            返回ObjectId列表或者参数占位符
+        """
+        if isinstance(vals, Param):
+            return Param(vals.name, lambda val: [ObjectId(val_) for val_ in val])
+        return [PreparedQuery._to_object_id(val) for val in vals]
+
+    @staticmethod
+    def _param_names(node: Any) -> set:
+        """
+        获取模板中所有的参数名称
+        Args:
+            node: query key中的值
+        Returns:
+            返回参数名称的集合
+        """
+        if isinstance(node, Param):
+            return {node.name}
+        if isinstance(node, dict):
+            node = list(node.values())
+        if isinstance(node, (list, tuple)):
+            return set().union(*(PreparedQuery._param_names(val) for val in node))
+        return set()
+
+    @property
+    def params(self, ) -> Tuple[str, ...]:
+        """
+        预编译查询中的参数名称
+        Args:
+
+        Returns:
+
+        """
+        return self._params
+
+    def bind(self, **params) -> Query:
+        """
+        绑定参数生成Query,返回的Query可以继续调用paginate_query等方法
+        Args:
+            params: 参数名称和参数值
+        Returns:
+            返回绑定参数后的Query
+        """
+        unknown = set(params).difference(self._params)
+        if unknown:
+            raise FuncArgsError("Unknown params {}".format(", ".join(sorted(unknown))))
+        try:
+            query_key = self._gen_query_key(params) if self._has_param else dict(self._query_key)
+        except BSONError as e:
+            raise FuncArgsError(str(e))
+
+        query = copy.copy(self._query)
+        query._query_key = query_key
+        query._normalized = True
+        # 模板中可变的部分复制一份,绑定后的Query修改时不影响模板
+        query._exclude_key = dict(self._query._exclude_key) if self._query._exclude_key else None
+        query._order_by = list(self._query._order_by) if self._query._order_by else None
+        query._pipline = list(self._query._pipline)
+        query._bulk_ops = list(self._query._bulk_ops)
+        # insert时会把_id写入document,update时会处理更新的数据,每次绑定都使用各自的副本
+        query._update_data = copy.deepcopy(self._query._update_data)
+        query._insert_data = copy.deepcopy(self._query._insert_data)
+        return query
@@ -8,18 +8,28 @@
 """
 
 import atexit
+import inspect
+import queue
+import threading
+import time
 from collections.abc import MutableMapping, MutableSequence
-from typing import Any, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import aelog
+from bson.son import SON
 from pymongo import MongoClient as MongodbClient
 from pymongo.database import Database
-from pymongo.errors import ConnectionFailure, DuplicateKeyError, InvalidName, PyMongoError
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, InvalidName, PyMongoError
 
-from . import Query
 from ._alchemy import AlchemyMixIn, BaseMongo, BasePagination, SessionMixIn
+from ._cachelru import TTLLRU
+from ._columnar import ColumnarBuilder
 from ._err_msg import mongo_msg
-from .err import HttpError, MongoDuplicateKeyError, MongoError, MongoInvalidNameError
+from ._hooks import OperationHooks, OperationSpan
+from ._monitor import OperationStats, WorkloadStats
+from .err import FuncArgsError, HttpError, MongoDuplicateKeyError, MongoError, MongoInvalidNameError
+from .query import COUNT_CAPPED, COUNT_ESTIMATED, COUNT_NONE, Query
 
 __all__ = ("SyncMongo", "SyncSession", "SyncPagination")
 
@@ -39,18 +49,42 @@ class SyncPagination(BasePagination):
     # noinspection PyProtectedMember
     def prev(self, ) -> List[Dict]:
         """Returns a :class:`Pagination` object for the previous page."""
+        if self.is_keyset:
+            query_key = self._seek_query_key(backward=True)
+            if query_key is None:
+                return []
+            items = self.session._find_many(self.cname, query_key, self.exclude_key, limit=self.per_page + 1,
+                                            sort=self._seek_sort(backward=True))
+            items = self._seek_result(items, backward=True)
+            if items:
+                self.page -= 1
+            return items
+
         self.page -= 1
         _offset_clause = (self.page - 1) * self.per_page
-        return self.session._find_many(self.cname, self.query_key, self.exclude_key, self.per_page,
-                                       _offset_clause, self.sort)
+        items = self.session._find_many(self.cname, self.query_key, self.exclude_key, skip=_offset_clause,
+                                        limit=self._offset_limit, sort=self.sort, raw=self.raw)
+        return self._offset_result(items)
 
     # noinspection PyProtectedMember
     def next(self, ) -> List[Dict]:
         """Returns a :class:`Pagination` object for the next page."""
+        if self.is_keyset:
+            query_key = self._seek_query_key(backward=False)
+            if query_key is None:
+                return []
+            items = self.session._find_many(self.cname, query_key, self.exclude_key, limit=self.per_page + 1,
+                                            sort=self._seek_sort(backward=False))
+            items = self._seek_result(items, backward=False)
+            if items:
+                self.page += 1
+            return items
+
         self.page += 1
         _offset_clause = (self.page - 1) * self.per_page
-        return self.session._find_many(self.cname, self.query_key, self.exclude_key, self.per_page,
-                                       _offset_clause, self.sort)
+        items = self.session._find_many(self.cname, self.query_key, self.exclude_key, skip=_offset_clause,
+                                        limit=self._offset_limit, sort=self.sort, raw=self.raw)
+        return self._offset_result(items)
 
 
 # noinspection PyProtectedMember
@@ -59,7 +93,11 @@ class SyncSession(SessionMixIn, object):
     query session
     """
 
-    def __init__(self, db: Database, message: Dict, msg_zh: str, max_per_page: int = None):
+    def __init__(self, db: Database, message: Dict, msg_zh: str, max_per_page: int = None, *, pool_size: int = 50,
+                 count_cache_ttl: float = 0, count_cache_size: int = 1024, result_cache_size: int = 1024,
+                 convert_id: bool = True, bind: str = None, operation_stats: OperationStats = None,
+                 slow_query_ms: float = 0, workload_stats: WorkloadStats = None,
+                 hooks: OperationHooks = None):
         """
             query session
         Args:
@@ -67,15 +105,96 @@ class SyncSession(SessionMixIn, object):
             message: 消息提示
             msg_zh: 中文提示或者而英文提示
             max_per_page: 每页最大的数量
+            pool_size: 连接池的大小
+            count_cache_ttl: 分页总数缓存的过期时间,单位秒,0表示不缓存
+            count_cache_size: 分页总数缓存的最大数量
+            result_cache_size: 查询结果缓存的最大数量
+            convert_id: 是否把查询结果中的_id转换为字符串类型的id,False时document保持mongo返回的_id
+            bind: session对应的bind,默认连接为None
+            operation_stats: 记录每个操作耗时的直方图
+            slow_query_ms: 慢查询的阈值,单位毫秒,0表示不记录慢查询
+            workload_stats: 按照查询结构汇总的负载统计
+            hooks: 操作前后调用的钩子
         """
         self.db = db
         self.message = message
         self.msg_zh = msg_zh
         self.max_per_page: Optional[int] = max_per_page
+        self.pool_size: int = pool_size
+        # collection的写入版本号,用于写入后使缓存失效
+        self._cname_version: Dict[str, int] = {}
+        # 分页总数缓存
+        self.count_cache_ttl: float = count_cache_ttl
+        self._count_cache: Optional[TTLLRU] = TTLLRU(
+            max_size=count_cache_size, default_ttl=count_cache_ttl) if count_cache_ttl > 0 else None
+        # 查询结果缓存,每个key的过期时间由Query.cache指定
+        self._result_cache: TTLLRU = TTLLRU(max_size=result_cache_size)
+        self.convert_id: bool = convert_id
+        # gather使用的线程池,第一次使用时创建
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # 操作耗时和慢查询
+        self.bind: Optional[str] = bind
+        self.operation_stats: Optional[OperationStats] = operation_stats
+        self.slow_query_ms: float = slow_query_ms
+        self.workload_stats: Optional[WorkloadStats] = workload_stats
+        self.hooks: Optional[OperationHooks] = hooks
+
+    @staticmethod
+    def _call_hook(hook: Callable, span: OperationSpan) -> None:
+        """
+        调用钩子,同步session中不能使用协程函数作为钩子,钩子中的异常只记录日志
+        Args:
+            hook: 钩子
+            span: 操作的上下文
+        Returns:
+
+        """
+        try:
+            result = hook(span)
+            if inspect.iscoroutine(result):
+                result.close()
+                aelog.error("Hook {} is a coroutine function, can not be called in SyncSession.".format(hook))
+        except Exception as e:
+            aelog.exception("Call hook {} failed, {}".format(hook, e))
+
+    def _before_operation(self, operation: str, cname: str, query_key: Any = None, sort: Any = None,
+                          exclude_key: Dict = None, enter: bool = True) -> OperationSpan:
+        """
+        操作开始前创建span并调用before钩子
+        Args:
+            operation: 操作名称, eg: find_one, update_many
+            cname: collection name
+            query_key: 处理后的查询document的过滤条件,聚合查询时为pipline
+            sort: 排序方式
+            exclude_key: 过滤返回值中字段的过滤条件
+            enter: 是否设置为当前上下文中正在执行的span,流式查询的span跨越多次yield,不能设置
+        Returns:
+            返回操作的span
+        """
+        span = OperationSpan(operation, cname, self.bind, query_key, sort, exclude_key)
+        for hook in self.hooks.before:  # type: ignore
+            self._call_hook(hook, span)
+        if enter:
+            span.enter()
+        return span
+
+    def _after_operation(self, span: OperationSpan, docs: int = 0) -> None:
+        """
+        操作结束后记录span的结果并调用after钩子,需要在操作的finally中调用
+        Args:
+            span: 操作的span
+            docs: 返回的document数量
+        Returns:
+
+        """
+        span.exit(docs)
+        for hook in self.hooks.after:  # type: ignore
+            self._call_hook(hook, span)
 
     # noinspection Mypy
     def _insert_one(self, cname: str, document: Union[List[Dict[str, Any]], Dict[str, Any]], insert_one: bool = True
-                    ) -> Union[Tuple[str], str]:
+                    ) -> Union[List[str], str]:
         """
         插入一个单独的文档
         Args:
@@ -85,6 +204,8 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回插入的Objectid
         """
+        started = time.perf_counter()
+        span = self._before_operation("insert_one" if insert_one else "insert_many", cname) if self.hooks else None
         try:
             if insert_one:
                 result = self.db.get_collection(cname).insert_one(document)  # type: ignore
@@ -98,9 +219,14 @@ class SyncSession(SessionMixIn, object):
             aelog.exception("Insert one document failed, {}".format(err))
             raise HttpError(400, message=mongo_msg[100][self.msg_zh])
         else:
-            return str(result.inserted_id) if insert_one else (str(val) for val in result.inserted_ids)  # type: ignore
+            return str(result.inserted_id) if insert_one else [str(val) for val in result.inserted_ids]  # type: ignore
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("insert_one" if insert_one else "insert_many", cname, started)
+            if span is not None:
+                self._after_operation(span)
 
-    def _insert_many(self, cname: str, document: List[Dict]) -> Tuple[str]:
+    def _insert_many(self, cname: str, document: List[Dict]) -> List[str]:
         """
         批量插入文档
         Args:
@@ -112,31 +238,40 @@ class SyncSession(SessionMixIn, object):
         return self._insert_one(cname, document, insert_one=False)  # type: ignore
 
     def _find_one(self, cname: str, query_key: Dict, exclude_key: Dict = None,
-                  sort: Union[List[Tuple[str, int]]] = None) -> Optional[Dict]:
+                  sort: Union[List[Tuple[str, int]]] = None, raw: bool = False) -> Optional[Dict]:
         """
         查询一个单独的document文档
         Args:
             cname: collection name
             query_key: 查询document的过滤条件
             exclude_key: 过滤返回值中字段的过滤条件
+            raw: 是否返回RawBSONDocument,字段在访问时才解码,并且不转换_id
         Returns:
             返回匹配的document或者None
         """
+        find_data = None
+        started = time.perf_counter()
+        span = self._before_operation("find_one", cname, query_key, sort, exclude_key) if self.hooks else None
         try:
-            find_data = self.db.get_collection(cname).find_one(query_key, projection=exclude_key, sort=sort)
+            find_data = self._get_collection(cname, raw).find_one(query_key, projection=exclude_key, sort=sort)
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find one document failed, {}".format(err))
             raise HttpError(400, message=mongo_msg[103][self.msg_zh])
         else:
-            if find_data and find_data.get("_id", None) is not None:
-                find_data["id"] = str(find_data.pop("_id"))
+            if not raw and find_data:
+                self._convert_id(find_data)
             return find_data
+        finally:
+            self._record_operation("find_one", cname, started, query_key, sort, exclude_key,
+                                   1 if find_data else 0)
+            if span is not None:
+                self._after_operation(span, 1 if find_data else 0)
 
     # noinspection PyTypeChecker,PyUnresolvedReferences
     def _find_many(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
-                   limit: int = 0, sort: Union[List[Tuple[str, int]]] = None) -> List[Dict]:
+                   limit: int = 0, sort: Union[List[Tuple[str, int]]] = None, raw: bool = False) -> List[Dict]:
         """
         批量查询document文档
         Args:
@@ -146,41 +281,205 @@ class SyncSession(SessionMixIn, object):
             skip: 从查询结果中调过指定数量的document
             limit: 限制返回的document条数
             sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            raw: 是否返回RawBSONDocument,字段在访问时才解码,并且不转换_id
         Returns:
             返回匹配的document列表
         """
+        find_data: List[Dict] = []
+        started = time.perf_counter()
+        span = self._before_operation("find_many", cname, query_key, sort, exclude_key) if self.hooks else None
         try:
-            find_data: List[Dict[str, Any]] = []
-            cursor = self.db.get_collection(cname).find(
+            cursor = self._get_collection(cname, raw).find(
                 query_key, projection=exclude_key, skip=skip, limit=limit, sort=sort)
+            find_data = list(cursor)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=mongo_msg[104][self.msg_zh])
+        else:
+            return find_data if raw else self._convert_ids(find_data, exclude_key=exclude_key)
+        finally:
+            self._record_operation("find_many", cname, started, query_key, sort, exclude_key, len(find_data))
+            if span is not None:
+                self._after_operation(span, len(find_data))
+
+    def _iter_many(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
+                   limit: int = 0, sort: Union[List[Tuple[str, int]]] = None, batch_size: int = 100,
+                   yield_batch: bool = False, raw: bool = False,
+                   operation: str = "iter_many") -> Iterator[Union[Dict, List[Dict]]]:
+        """
+        流式查询document文档,游标按批次从服务端拉取数据,不会把所有的document都加载到内存中
+        Args:
+            cname: collection name
+            query_key: 查询document的过滤条件
+            exclude_key: 过滤返回值中字段的过滤条件
+            skip: 从查询结果中调过指定数量的document
+            limit: 限制返回的document条数
+            sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            batch_size: 游标每次从服务端拉取的document数量
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+            raw: 是否返回RawBSONDocument,字段在访问时才解码,并且不转换_id
+            operation: 操作名称,用于钩子、耗时统计和负载统计, eg: iter_many, find_columns
+        Returns:
+            逐条或者按批次返回匹配的document的生成器
+        """
+        cursor = None
+        batch: List[Dict] = []
+        docs = 0
+        # 从打开游标到迭代结束或者调用方退出迭代记录为一次操作
+        started = time.perf_counter()
+        span = self._before_operation(
+            operation, cname, query_key, sort, exclude_key, enter=False) if self.hooks else None
+        try:
+            cursor = self._get_collection(cname, raw).find(
+                query_key, projection=exclude_key, skip=skip, limit=limit, sort=sort, batch_size=batch_size)
             for doc in cursor:
-                if doc.get("_id", None) is not None:
-                    doc["id"] = str(doc.pop("_id"))
-                find_data.append(doc)
+                docs += 1
+                if not yield_batch:
+                    yield doc if raw else self._convert_id(doc)
+                    continue
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    yield batch if raw else self._convert_ids(batch, exclude_key=exclude_key)
+                    batch = []
+            if batch:
+                yield batch if raw else self._convert_ids(batch, exclude_key=exclude_key)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=mongo_msg[104][self.msg_zh])
+        finally:
+            # 调用方提前退出迭代时(break或者生成器被回收)也要释放服务端的游标
+            if cursor is not None:
+                cursor.close()
+            self._record_operation(operation, cname, started, query_key, sort, exclude_key, docs)
+            if span is not None:
+                self._after_operation(span, docs)
+
+    def _find_facet(self, cname: str, query_key: Dict, exclude_key: Dict = None, skip: int = 0,
+                    limit: int = 0, sort: Union[List[Tuple[str, int]]] = None) -> Tuple[List[Dict], int]:
+        """
+        使用$facet聚合在一次查询中返回当前页的document和匹配的总数
+        Args:
+            cname: collection name
+            query_key: 查询document的过滤条件
+            exclude_key: 过滤返回值中字段的过滤条件
+            skip: 从查询结果中调过指定数量的document
+            limit: 限制返回的document条数
+            sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+        Returns:
+            返回匹配的document列表和总数
+        """
+        items_pipline: List[Dict] = [{"$skip": skip}]
+        if limit:
+            items_pipline.append({"$limit": limit})
+        if exclude_key:
+            items_pipline.append({"$project": exclude_key})
+        pipline: List[Dict] = [{"$match": query_key}]
+        if sort:
+            pipline.append({"$sort": SON(sort)})
+        pipline.append({"$facet": {"items": items_pipline, "total": [{"$count": "total"}]}})
+
+        find_data: List[Dict] = []
+        total = 0
+        started = time.perf_counter()
+        span = self._before_operation("find_facet", cname, query_key, sort, exclude_key) if self.hooks else None
+        try:
+            for result in self.db.get_collection(cname).aggregate(pipline):
+                find_data = result["items"]
+                total = result["total"][0]["total"] if result["total"] else 0
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find many document failed, {}".format(err))
             raise HttpError(400, message=mongo_msg[104][self.msg_zh])
         else:
-            return find_data
+            return self._convert_ids(find_data, exclude_key=exclude_key), total
+        finally:
+            self._record_operation("find_facet", cname, started, query_key, sort, exclude_key, len(find_data))
+            if span is not None:
+                self._after_operation(span, len(find_data))
 
-    def _find_count(self, cname: str, query_key: Dict) -> int:
+    def _find_count(self, cname: str, query_key: Dict, limit: int = 0) -> int:
         """
         查询document的数量
         Args:
             cname: collection name
             query_key: 查询document的过滤条件
+            limit: 最多计数的数量,0表示不限制
         Returns:
             返回匹配的document数量
         """
+        started = time.perf_counter()
+        span = self._before_operation("find_count", cname, query_key) if self.hooks else None
+        try:
+            if limit:
+                return self.db.get_collection(cname).count_documents(query_key, limit=limit)
+            return self.db.get_collection(cname).count_documents(query_key)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Find many document failed, {}".format(err))
+            raise HttpError(400, message=mongo_msg[104][self.msg_zh])
+        finally:
+            self._record_operation("find_count", cname, started, query_key)
+            if span is not None:
+                self._after_operation(span)
+
+    def _estimated_count(self, cname: str) -> int:
+        """
+        根据collection的元数据估算document的数量,不需要扫描数据
+        Args:
+            cname: collection name
+        Returns:
+            返回估算的document数量
+        """
+        started = time.perf_counter()
+        span = self._before_operation("estimated_count", cname) if self.hooks else None
         try:
-            return self.db.get_collection(cname).count(query_key)
+            return self.db.get_collection(cname).estimated_document_count()
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Find many document failed, {}".format(err))
             raise HttpError(400, message=mongo_msg[104][self.msg_zh])
+        finally:
+            self._record_operation("estimated_count", cname, started)
+            if span is not None:
+                self._after_operation(span)
+
+    def _count_total(self, query: Query, query_key: Dict) -> Tuple[Optional[int], bool]:
+        """
+        按照query中的计数方式计算分页的总数
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            返回总数和总数是否为近似值,不计算总数时总数为None
+        """
+        if query._count_strategy == COUNT_NONE:
+            return None, False
+
+        cache_key = None
+        if self._count_cache is not None:
+            cache_key = self._cache_key(query._cname, "count", query._count_strategy, query._count_cap, query_key)
+            cached = self._count_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if query._count_strategy == COUNT_ESTIMATED and not query_key:
+            result = self._estimated_count(query._cname), True
+        elif query._count_strategy == COUNT_CAPPED:
+            total = self._find_count(query._cname, query_key, limit=query._count_cap)  # type: ignore
+            result = total, total >= query._count_cap  # type: ignore
+        else:
+            result = self._find_count(query._cname, query_key), False
+
+        if cache_key is not None:
+            self._count_cache[cache_key] = result  # type: ignore
+        return result
 
     def _update_one(self, cname: str, query_key: Dict, update_data: Dict, upsert: bool = False,
                     update_one: bool = True) -> Dict:
@@ -195,6 +494,9 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 1, "modified_count": 1, "upserted_id":"f"}
         """
+        started = time.perf_counter()
+        span = self._before_operation(
+            "update_one" if update_one else "update_many", cname, query_key) if self.hooks else None
         try:
             if update_one:
                 result = self.db.get_collection(cname).update_one(query_key, update_data, upsert=upsert)
@@ -210,6 +512,11 @@ class SyncSession(SessionMixIn, object):
         else:
             return {"matched_count": result.matched_count, "modified_count": result.modified_count,
                     "upserted_id": str(result.upserted_id) if result.upserted_id else None}
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("update_one" if update_one else "update_many", cname, started, query_key)
+            if span is not None:
+                self._after_operation(span)
 
     def _update_many(self, cname: str, query_key: Dict, update_data: Dict, upsert: bool = False) -> Dict:
         """
@@ -234,6 +541,9 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回删除的数量
         """
+        started = time.perf_counter()
+        span = self._before_operation(
+            "delete_one" if delete_one else "delete_many", cname, query_key) if self.hooks else None
         try:
             if delete_one:
                 result = self.db.get_collection(cname).delete_one(query_key)
@@ -246,6 +556,11 @@ class SyncSession(SessionMixIn, object):
             raise HttpError(400, message=mongo_msg[102][self.msg_zh])
         else:
             return result.deleted_count
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("delete_one" if delete_one else "delete_many", cname, started, query_key)
+            if span is not None:
+                self._after_operation(span)
 
     def _delete_many(self, cname: str, query_key: Dict) -> int:
         """
@@ -258,31 +573,78 @@ class SyncSession(SessionMixIn, object):
         """
         return self._delete_one(cname, query_key, delete_one=False)
 
+    def _bulk_write(self, cname: str, chunks: List[List], ordered: bool = True) -> Dict:
+        """
+        分块执行bulk write,并汇总所有分块的结果
+        Args:
+            cname: collection name
+            chunks: 分块后的bulk write请求
+            ordered: 是否按顺序执行,顺序执行时遇到错误后不再执行后面的分块
+        Returns:
+            返回汇总的结果
+        """
+        summary: Dict = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                         "upserted_count": 0, "upserted_id": {}, "write_errors": []}
+        offset = 0
+        started = time.perf_counter()
+        span = self._before_operation("bulk_write", cname) if self.hooks else None
+        try:
+            collection = self.db.get_collection(cname)
+            for chunk in chunks:
+                try:
+                    result = collection.bulk_write(chunk, ordered=ordered)
+                except BulkWriteError as err:
+                    self._merge_bulk_result(summary, err.details, offset)
+                    if ordered:
+                        break
+                else:
+                    self._merge_bulk_result(summary, result.bulk_api_result, offset)
+                offset += len(chunk)
+        except InvalidName as e:
+            raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
+        except PyMongoError as err:
+            aelog.exception("Bulk write document failed, {}".format(err))
+            raise HttpError(400, message=mongo_msg[106][self.msg_zh], error=err)
+        finally:
+            self._invalidate_cache(cname)
+            self._record_operation("bulk_write", cname, started)
+            if span is not None:
+                self._after_operation(span)
+
+        if summary["write_errors"]:
+            aelog.error("Bulk write document failed, {}".format(summary["write_errors"][:10]))
+            raise HttpError(400, message=mongo_msg[106][self.msg_zh], error=summary)
+        return summary
+
     # noinspection PyUnresolvedReferences,PyTypeChecker
-    def _aggregate(self, cname: str, pipline: List[Dict]) -> List[Dict]:
+    def _aggregate(self, cname: str, pipline: List[Dict], raw: bool = False) -> List[Dict]:
         """
         根据pipline进行聚合查询
         Args:
             cname: collection name
             pipline: 聚合查询的pipeline,包含一个后者多个聚合命令
+            raw: 是否返回RawBSONDocument,字段在访问时才解码,并且不转换_id
         Returns:
             返回聚合后的document
         """
         result: List[Dict[str, Any]] = []
+        started = time.perf_counter()
+        span = self._before_operation("aggregate", cname, pipline) if self.hooks else None
         try:
-            for doc in self.db.get_collection(cname).aggregate(pipline):
-                if doc.get("_id", None) is not None:
-                    doc["id"] = doc.pop("_id")
-                result.append(doc)
+            result = list(self._get_collection(cname, raw).aggregate(pipline))
         except InvalidName as e:
             raise MongoInvalidNameError("Invalid collention name {} {}".format(cname, e))
         except PyMongoError as err:
             aelog.exception("Aggregate document failed, {}".format(err))
             raise HttpError(400, message=mongo_msg[105][self.msg_zh])
         else:
-            return result
+            return result if raw else self._convert_ids(result, to_str=False)
+        finally:
+            self._record_operation("aggregate", cname, started, pipline, docs=len(result))
+            if span is not None:
+                self._after_operation(span, len(result))
 
-    def insert_many(self, query: Query) -> Tuple[str]:
+    def insert_many(self, query: Query) -> List[str]:
         """
         批量插入文档
         Args:
@@ -327,8 +689,20 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document或者None
         """
-        return self._find_one(query._cname, self._update_query_key(query._query_key), exclude_key=query._exclude_key,
-                              sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None:
+            return self._find_one(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                  raw=query._raw)
+
+        cache_key = self._cache_key(query._cname, "find_one", query_key, query._exclude_key, query._order_by,
+                                    query._raw)
+        cached = self._get_result_cache(cache_key)
+        if cached is not None:
+            return cached[0]
+        find_data = self._find_one(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                   raw=query._raw)
+        self._set_result_cache(cache_key, find_data, query._cache_ttl)
+        return find_data
 
     # noinspection DuplicatedCode
     def find_many(self, query: Query) -> SyncPagination:
@@ -346,18 +720,100 @@ class SyncSession(SessionMixIn, object):
             Returns a :class:`SyncPagination` object.
         """
 
-        query_key = self._update_query_key(query._query_key)
-        items = self._find_many(query._cname, query_key, exclude_key=query._exclude_key, limit=query._limit_clause,
-                                skip=query._offset_clause, sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None:
+            return self._paginate(query, query_key)
+
+        cache_key = self._cache_key(
+            query._cname, "find_many", query_key, query._exclude_key, query._order_by, query._offset_clause,
+            query._limit_clause, query._is_keyset, query._after, query._before, query._keyset_total,
+            query._use_facet, query._count_strategy, query._count_cap, query._raw)
+        cached = self._get_result_cache(cache_key)
+        if cached is not None:
+            pagination = SyncPagination(self, query, 0, [], query_key)
+            (pagination.total, pagination.total_approximate, pagination._has_prev, pagination._has_next,
+             pagination.items) = cached[0]
+            return pagination
+
+        pagination = self._paginate(query, query_key)
+        self._set_result_cache(cache_key, (pagination.total, pagination.total_approximate, pagination._has_prev,
+                                           pagination._has_next, pagination.items), query._cache_ttl)
+        return pagination
+
+    # noinspection DuplicatedCode
+    def _paginate(self, query: Query, query_key: Dict) -> SyncPagination:
+        """
+        分页查询document文档
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            Returns a :class:`SyncPagination` object.
+        """
+        if query._is_keyset:
+            return self._find_keyset(query, query_key)
+
+        if query._use_facet:
+            items, total = self._find_facet(query._cname, query_key, exclude_key=query._exclude_key,
+                                            limit=query._limit_clause, skip=query._offset_clause,
+                                            sort=query._order_by)
+            return SyncPagination(self, query, total, items, query_key)
 
+        # 总数不是精确值时多查询一条数据用来判断是否有下一页
+        no_total = query._count_strategy == COUNT_NONE and query._per_page > 0
+        probe = query._count_strategy in (COUNT_NONE, COUNT_ESTIMATED, COUNT_CAPPED) and query._per_page > 0
+        limit = query._limit_clause + 1 if probe else query._limit_clause
+        items = self._find_many(query._cname, query_key, exclude_key=query._exclude_key, limit=limit,
+                                skip=query._offset_clause, sort=query._order_by, raw=query._raw)
+
+        has_next, total_approximate = None, False
+        if probe:
+            has_next = len(items) > query._per_page
+            del items[query._per_page:]
+        if no_total:
+            total = len(items) if query._page == 1 and not has_next else None
         # No need to count if we're on the first page and there are fewer
         # items than we expected.
-        if query._page == 1 and len(items) < query._per_page:
+        elif query._page == 1 and (len(items) < query._per_page or has_next is False):
             total = len(items)
         else:
-            total = self.find_count(query)
+            total, total_approximate = self._count_total(query, query_key)
+
+        pagination = SyncPagination(self, query, total, items, query_key)
+        pagination.total_approximate, pagination._has_next = total_approximate, has_next
+        return pagination
+
+    def _find_keyset(self, query: Query, query_key: Dict) -> SyncPagination:
+        """
+        keyset(seek)分页查询,根据游标生成范围查询条件代替skip,多查询一条数据用来判断是否还有下一页
+        Args:
+            query: Query class
+            query_key: 处理后的查询document的过滤条件
+        Returns:
+            Returns a :class:`SyncPagination` object.
+        """
+        pagination = SyncPagination(self, query, 0, [], query_key)
+        cursor = query._after if query._before is None else query._before
+        backward = query._before is not None
+        if cursor is None:
+            find_key = query_key
+        else:
+            values = self._decode_keyset_cursor(cursor)
+            find_key = self._keyset_query_key(query_key, pagination.sort, values, backward)  # type: ignore
+        items = self._find_many(query._cname, find_key, exclude_key=query._exclude_key, limit=query._per_page + 1,
+                                sort=pagination._seek_sort(backward))
+        items = pagination._seek_result(items, backward)
+        if cursor is None:
+            pagination._has_prev = False
 
-        return SyncPagination(self, query, total, items, query_key)
+        # 第一页并且没有下一页的时候不需要再查询总数,其他情况只有指定了with_total才计数,否则每一页都要全量计数
+        if cursor is None and not pagination._has_next:
+            pagination.total = len(items)
+        elif query._keyset_total:
+            pagination.total, pagination.total_approximate = self._count_total(query, query_key)
+        else:
+            pagination.total = None
+        return pagination
 
     def find_all(self, query: Query) -> List[Dict]:
         """
@@ -371,8 +827,248 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document列表
         """
-        return self._find_many(query._cname, self._update_query_key(query._query_key),
-                               exclude_key=query._exclude_key, sort=query._order_by)
+        query_key = self._gen_query_key(query)
+        if query._cache_ttl is None:
+            return self._find_many(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                   raw=query._raw)
+
+        cache_key = self._cache_key(query._cname, "find_all", query_key, query._exclude_key, query._order_by,
+                                    query._raw)
+        cached = self._get_result_cache(cache_key)
+        if cached is not None:
+            return cached[0]
+        find_data = self._find_many(query._cname, query_key, exclude_key=query._exclude_key, sort=query._order_by,
+                                    raw=query._raw)
+        self._set_result_cache(cache_key, find_data, query._cache_ttl)
+        return find_data
+
+    def iter_many(self, query: Query, batch_size: int = 100, yield_batch: bool = False
+                  ) -> Iterator[Union[Dict, List[Dict]]]:
+        """
+        流式查询document文档,适用于导出CSV等需要遍历大量数据的场景,内存占用只和batch_size有关
+
+        eg: for doc in session.iter_many(query): ...
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+                sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            batch_size: 游标每次从服务端拉取的document数量,默认100
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            逐条或者按批次返回匹配的document的生成器
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        return self._iter_many(query._cname, self._gen_query_key(query), exclude_key=query._exclude_key,
+                               sort=query._order_by, batch_size=batch_size, yield_batch=yield_batch, raw=query._raw)
+
+    def _gen_partitions(self, query: Query, partitions: int, field: str) -> List[Dict]:
+        """
+        对分区字段采样,生成每个分区的查询条件
+        Args:
+            query: Query class
+            partitions: 分区的数量
+            field: 分区的字段
+        Returns:
+            返回每个分区的查询条件
+        """
+        if partitions <= 0:
+            raise FuncArgsError("partitions must be greater than 0.")
+        query_key = self._gen_query_key(query)
+        partitions = min(partitions, self.pool_size)
+        if partitions == 1:
+            return [query_key]
+        field = "_id" if field == "id" else field
+        samples = self._partition_range_samples(query._cname, query_key, field, partitions) if query_key else None
+        if samples is None:
+            samples = self._aggregate(query._cname, self._partition_pipline(query_key, field, partitions))
+        return self._partition_query_keys(query_key, field, samples, partitions)
+
+    def _partition_range_samples(self, cname: str, query_key: Dict, field: str,
+                                  partitions: int) -> Optional[List[Dict]]:
+        """
+        有查询条件时根据分区字段的最大值和最小值插值生成分区边界,按照字段排序只读取两条document,
+        分区字段有索引时不需要像$match之后的$sample那样扫描所有匹配的document
+        Args:
+            cname: collection name
+            query_key: 处理后的查询document的过滤条件
+            field: 分区的字段
+            partitions: 分区的数量
+        Returns:
+            返回插值的结果,没有匹配的document或者字段类型不能插值时返回None
+        """
+        high_docs = self._find_many(cname, query_key, {field: 1}, limit=1, sort=[(field, -1)])
+        if not high_docs:
+            return None
+        high = self._keyset_values(high_docs[0], [(field, 1)])[0]
+        alias = self._partition_type(high)
+        if alias is None:
+            return None
+        # null和其他类型的值排在前面,最小值只在和最大值相同类型的值中查找
+        low_docs = self._find_many(cname, {"$and": [query_key, {field: {"$type": alias}}]}, {field: 1},
+                                   limit=1, sort=[(field, 1)])
+        low = self._keyset_values(low_docs[0], [(field, 1)])[0]
+        return self._interpolate_partition_samples(low, high, partitions)
+
+    def scan_partitions(self, query: Query, partitions: int = 4, *, field: str = "_id", batch_size: int = 1000,
+                        yield_batch: bool = False) -> List[Iterator[Union[Dict, List[Dict]]]]:
+        """
+        按照字段的范围把查询拆分为多个分区,返回每个分区的迭代器,由调用方自行分发处理
+
+        没有查询条件时分区的边界通过$sample采样确定,有查询条件时根据分区字段的最大值和最小值插值,
+        分区之间没有重叠,不保证document的顺序
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+            partitions: 分区的数量,不超过连接池的大小
+            field: 分区的字段,默认为_id,使用其他字段时最好是有索引的单一类型的字段
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            返回每个分区的迭代器列表
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        query_keys = self._gen_partitions(query, partitions, field)
+        return [self._iter_many(query._cname, query_key, exclude_key=query._exclude_key, batch_size=batch_size,
+                                yield_batch=yield_batch, raw=query._raw, operation="scan_partition")
+                for query_key in query_keys]
+
+    def parallel_scan(self, query: Query, partitions: int = 4, *, field: str = "_id", batch_size: int = 1000,
+                      yield_batch: bool = False) -> Iterator[Union[Dict, List[Dict]]]:
+        """
+        并行扫描collection,适用于导出等需要遍历整个collection的场景
+
+        按照字段的范围把查询拆分为多个分区,每个分区在单独的线程中使用单独的游标读取,读取的结果合并为一个迭代器返回,
+        不保证document的顺序,提前退出迭代时会停止所有分区的读取
+
+        eg: for doc in session.parallel_scan(query, partitions=8): ...
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                exclude_key: 过滤返回值中字段的过滤条件
+            partitions: 分区的数量,不超过连接池的大小
+            field: 分区的字段,默认为_id,使用其他字段时最好是有索引的单一类型的字段
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+            yield_batch: 是否按批次返回document列表,默认False逐条返回document
+        Returns:
+            逐条或者按批次返回匹配的document的生成器
+        """
+        iterators = self.scan_partitions(query, partitions, field=field, batch_size=batch_size, yield_batch=True)
+        batches: queue.Queue = queue.Queue(maxsize=len(iterators) * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item: Any) -> bool:
+            # 调用方提前退出迭代后不再阻塞在队列上
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def scan(iterator: Iterator) -> None:
+            try:
+                for batch_ in iterator:
+                    if not put(batch_):
+                        return
+                put(done)
+            except Exception as e:
+                # 分区的读取错误交给调用方处理
+                put(e)
+            finally:
+                iterator.close()  # type: ignore
+
+        executor = ThreadPoolExecutor(max_workers=len(iterators))
+        try:
+            for iterator in iterators:
+                executor.submit(scan, iterator)
+            remaining = len(iterators)
+            while remaining:
+                batch = batches.get()
+                if batch is done:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                elif yield_batch:
+                    yield batch
+                else:
+                    yield from batch
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def gather(self, *queries: Tuple[str, Query], limit: int = 0) -> List[Any]:
+        """
+        在线程池中并发执行多个相互独立的查询,总耗时取决于最慢的查询而不是所有查询的耗时之和
+
+        eg: total, page = session.gather(("find_count", query1), ("find_many", query2))
+        Args:
+            queries: (操作名称, Query), 操作名称为find_one, find_many, find_all, find_count, aggregate等session方法
+            limit: 最大并发数量,默认为连接池的大小
+        Returns:
+            按照queries的顺序返回每个查询的结果,查询失败时对应的位置为异常
+        """
+        operations = self._gather_operations(queries)
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    # 线程池的大小和连接池一致,session中所有的gather共享
+                    self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        semaphore = threading.BoundedSemaphore(limit) if 0 < limit < self.pool_size else None
+
+        def run(operation: Any, query: Query) -> Any:
+            if semaphore is None:
+                return operation(query)
+            with semaphore:
+                return operation(query)
+
+        futures = [self._executor.submit(run, operation, query) for operation, query in operations]
+        results: List[Any] = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def find_columns(self, query: Query, fields: Sequence[str], dtypes: Dict[str, Any] = None,
+                     batch_size: int = 1000) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        按列查询document文档,适用于分析计算等需要把大量数据转换为数组的场景
+
+        游标按批次拉取数据并逐列写入可增长的类型化数组,不保留每行的document,安装了numpy时返回numpy数组,
+        否则返回array.array,没有指定类型或者array.array不支持的类型返回list
+        Args:
+            query: Query class
+                cname: collection name
+                query_key: 查询document的过滤条件
+                sort: 排序方式，可以自定多种字段的排序，值为一个列表的键值对， eg:[('field1', pymongo.ASCENDING)]
+            fields: 要查询的字段名称,支持a.b的嵌套形式,只会从mongo中查询这些字段
+            dtypes: 字段的类型, eg: {"age": "int64", "score": "float64"},没有指定的字段为object
+            batch_size: 游标每次从服务端拉取的document数量,默认1000
+        Returns:
+            返回(字段名称和数组的dict, 字段名称和mask的dict), mask中为True(1)的位置表示值缺失或者为null
+        """
+        if batch_size <= 0:
+            raise FuncArgsError("batch_size must be greater than 0.")
+        builder = ColumnarBuilder(fields, dtypes)
+        batches = self._iter_many(query._cname, self._gen_query_key(query), exclude_key=builder.projection,
+                                  sort=query._order_by, batch_size=batch_size, yield_batch=True,
+                                  operation="find_columns")
+        try:
+            for batch in batches:
+                builder.extend(batch)
+        finally:
+            batches.close()  # type: ignore
+        return builder.result()
 
     def find_count(self, query: Query) -> int:
         """
@@ -384,7 +1080,7 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的document数量
         """
-        return self._find_count(query._cname, self._update_query_key(query._query_key))
+        return self._find_count(query._cname, self._gen_query_key(query))
 
     def update_many(self, query: Query) -> Dict:
         """
@@ -398,7 +1094,7 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 2, "modified_count": 2, "upserted_id":"f"}
         """
-        return self._update_many(query._cname, self._update_query_key(query._query_key),
+        return self._update_many(query._cname, self._gen_query_key(query),
                                  self._update_update_data(query._update_data), upsert=query._upsert)
 
     def update_one(self, query: Query) -> Dict:
@@ -413,7 +1109,7 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回匹配的数量和修改数量的dict, eg:{"matched_count": 1, "modified_count": 1, "upserted_id":"f"}
         """
-        return self._update_one(query._cname, self._update_query_key(query._query_key),
+        return self._update_one(query._cname, self._gen_query_key(query),
                                 self._update_update_data(query._update_data), upsert=query._upsert)
 
     def delete_many(self, query: Query) -> int:
@@ -426,7 +1122,7 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回删除的数量
         """
-        return self._delete_many(query._cname, self._update_query_key(query._query_key))
+        return self._delete_many(query._cname, self._gen_query_key(query))
 
     def delete_one(self, query: Query) -> int:
         """
@@ -438,7 +1134,25 @@ class SyncSession(SessionMixIn, object):
         Returns:
             返回删除的数量
         """
-        return self._delete_one(query._cname, self._update_query_key(query._query_key))
+        return self._delete_one(query._cname, self._gen_query_key(query))
+
+    def bulk_write(self, query: Query, *, chunk_size: int = 1000) -> Dict:
+        """
+        批量执行混合的插入,更新,替换和删除操作,操作会按照数量分块发送
+        Args:
+            query: Query class
+                cname: collection name
+                bulk_ops: 通过bulk_insert,bulk_update,bulk_replace,bulk_delete添加的操作
+                bulk_ordered: 是否按顺序执行
+            chunk_size: 每块最多的操作数量,每块的消息大小超过服务端的限制时由pymongo继续拆分
+        Returns:
+            返回汇总的结果, eg:{"inserted_count": 1, "matched_count": 1, "modified_count": 1, "deleted_count": 1,
+                              "upserted_count": 1, "upserted_id": {2: "f"}, "write_errors": []}
+        """
+        if chunk_size <= 0:
+            raise FuncArgsError("chunk_size must be greater than 0.")
+        chunks = self._gen_bulk_requests(query._bulk_ops, chunk_size=chunk_size)
+        return self._bulk_write(query._cname, chunks, ordered=query._bulk_ordered)
 
     # noinspection DuplicatedCode
     def aggregate(self, query: Query) -> List[Dict]:
@@ -458,7 +1172,7 @@ class SyncSession(SessionMixIn, object):
             raise MongoError("Aggregate query failed, pipline arg is not a iterable type.")
         if query._limit_clause and query._offset_clause:
             pipline.extend([{'$limit': query._limit_clause}, {'$skip': query._offset_clause}])
-        return self._aggregate(query._cname, pipline)
+        return self._aggregate(query._cname, pipline, raw=query._raw)
 
 
 class SyncMongo(AlchemyMixIn, BaseMongo):
@@ -503,6 +1217,9 @@ class SyncMongo(AlchemyMixIn, BaseMongo):
             Returns:
 
             """
+            for _, session in self.session_pool.items():
+                if session._executor is not None:
+                    session._executor.shutdown(wait=False)
             for _, engine in self.engine_pool.items():
                 if engine:
                     engine.close()
@@ -514,7 +1231,8 @@ class SyncMongo(AlchemyMixIn, BaseMongo):
         try:
             if engine_name not in self.engine_pool:
                 self.engine_pool[engine_name] = MongodbClient(
-                    host, port, username=username, password=passwd, maxPoolSize=pool_size)
+                    host, port, username=username, password=passwd, maxPoolSize=pool_size,
+                    event_listeners=self._engine_listeners(engine_name))
             db = self.engine_pool[engine_name].get_database(name=dbname)
         except ConnectionFailure as e:
             aelog.exception(f"Mongo connection failed host={host} port={port} error:{str(e)}")
@@ -551,7 +1269,8 @@ class SyncMongo(AlchemyMixIn, BaseMongo):
         if None not in self.bind_pool:
             raise ValueError("Default bind is not exist.")
         if None not in self.session_pool:
-            self.session_pool[None] = SyncSession(self.bind_pool[None], self.message, self.msg_zh)
+            self.session_pool[None] = SyncSession(self.bind_pool[None], self.message, self.msg_zh,
+                                                  **self._session_options())
         return self.session_pool[None]
 
     def gen_session(self, bind: str) -> SyncSession:
@@ -564,5 +1283,6 @@ class SyncMongo(AlchemyMixIn, BaseMongo):
         """
         self._get_engine(bind)
         if bind not in self.session_pool:
-            self.session_pool[bind] = SyncSession(self.bind_pool[bind], self.message, self.msg_zh)
+            self.session_pool[bind] = SyncSession(self.bind_pool[bind], self.message, self.msg_zh,
+                                                  **self._session_options(bind))
         return self.session_pool[bind]
@@ -7,7 +7,7 @@
 @time: 18-12-26 下午3:32
 """
 
-from collections import MutableMapping, MutableSequence
+from collections.abc import MutableMapping, MutableSequence
 from typing import Dict, List, Union
 
 __all__ = ("_verify_message", "under2camel")
@@ -42,6 +42,7 @@ setup(name='fesdql',
                         'motor>=1.2.2',
                         'pymongo>=3.8.0',
                         'marshmallow>=3.0.0'],
+      extras_require={'numpy': ['numpy']},
       python_requires=">=3.6",
       keywords="mongo, asyncio,sync, crud, session",
       license='MIT',
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 上午10:12
+
+单元测试的公共工具,session使用benchmarks中的进程内mongo替身,不需要mongod
+"""
+import asyncio
+import inspect
+import sys
+from typing import Any, Awaitable
+
+import aelog.aelog
+
+from benchmarks.standin import AsyncMemoryDatabase, MemoryDatabase
+from fesdql._err_msg import mongo_msg
+from fesdql.async_mongo import AsyncSession
+from fesdql.sync_mongo import SyncSession
+
+__all__ = ("AELOG_COMPATIBLE", "make_async_session", "make_sync_session", "run")
+
+# aelog 1.0.9替换的findCaller不接受python3.8之后logging传入的stacklevel参数,记录日志时会抛出TypeError,
+# 会记录日志的异常路径在这种环境中跳过
+AELOG_COMPATIBLE = sys.version_info < (3, 8) or len(inspect.signature(aelog.aelog.find_caller).parameters) > 2
+
+
+def make_async_session(**kwargs) -> AsyncSession:
+    """
+    创建使用进程内mongo替身的异步session
+    Args:
+        kwargs: session的其他参数
+    Returns:
+
+    """
+    return AsyncSession(AsyncMemoryDatabase(), mongo_msg, "msg_zh", **kwargs)
+
+
+def make_sync_session(**kwargs) -> SyncSession:
+    """
+    创建使用进程内mongo替身的同步session
+    Args:
+        kwargs: session的其他参数
+    Returns:
+
+    """
+    return SyncSession(MemoryDatabase(), mongo_msg, "msg_zh", **kwargs)
+
+
+def run(coro: Awaitable, timeout: float = 5) -> Any:
+    """
+    在新的事件循环中执行协程,超时后抛出asyncio.TimeoutError,用于发现一直不返回的future
+    Args:
+        coro: 协程
+        timeout: 超时时间,单位秒
+    Returns:
+        返回协程的结果
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(asyncio.wait_for(coro, timeout))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午2:10
+"""
+import asyncio
+import unittest
+
+from bson.errors import InvalidDocument
+
+from fesdql import Query
+from fesdql.err import MongoDuplicateKeyError
+
+from .helpers import AELOG_COMPATIBLE, make_async_session, run
+
+
+def insert_query(document):
+    return Query().collection("docs").insert_query(document)
+
+
+class BufferedInsertTestCase(unittest.TestCase):
+
+    @unittest.skipUnless(AELOG_COMPATIBLE, "aelog can not log exceptions on this python version")
+    def test_results_and_duplicate_key(self, ):
+        async def insert():
+            session = make_async_session(buffer_max_size=10)
+            await session.insert_one(insert_query({"_id": "dup"}))
+            futures = [session.buffered_insert_one(insert_query({"index": i})) for i in range(3)]
+            futures.insert(1, session.buffered_insert_one(insert_query({"_id": "dup"})))
+            await session.flush()
+            return session, await asyncio.gather(*futures, return_exceptions=True)
+
+        session, results = run(insert())
+        self.assertIsInstance(results[1], MongoDuplicateKeyError)
+        self.assertEqual(len([result for result in results if isinstance(result, str)]), 3)
+        self.assertEqual(session.db.get_collection("docs").collection.estimated_document_count(), 4)
+
+    def test_encode_error_does_not_hang(self, ):
+        async def insert():
+            session = make_async_session(buffer_flush_interval=0.01)
+            futures = [session.buffered_insert_one(insert_query({"index": 1})),
+                       session.buffered_insert_one(insert_query({"bad": object()}))]
+            return await asyncio.gather(*futures, return_exceptions=True)
+
+        results = run(insert(), timeout=2)
+        self.assertTrue(all(isinstance(result, InvalidDocument) for result in results))
+
+    def test_cancelled_write_does_not_hang(self, ):
+        async def insert():
+            session = make_async_session()
+
+            async def never_finish(*args, **kwargs):
+                await asyncio.sleep(3600)
+
+            session._insert_many = never_finish
+            future = session.buffered_insert_one(insert_query({"index": 1}))
+            session._flush_buffer("docs")
+            await asyncio.sleep(0)
+            for task in list(session._flush_tasks):
+                task.cancel()
+            await asyncio.gather(future, return_exceptions=True)
+            return future
+
+        future = run(insert(), timeout=2)
+        self.assertTrue(future.cancelled())
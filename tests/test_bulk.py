@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 上午9:40
+"""
+import unittest
+
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+from fesdql import Query
+
+from .helpers import make_sync_session
+
+
+class BulkRequestsTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+
+    def test_chunks_by_count(self, ):
+        query = Query().collection("docs")
+        for index in range(5):
+            query.bulk_insert({"index": index})
+        query.bulk_update({"index": 1}, {"$set": {"age": 1}}, upsert=True).bulk_delete({"index": 2})
+        chunks = self.session._gen_bulk_requests(query.bulk_query()._bulk_ops, chunk_size=3)
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertIsInstance(chunks[0][0], InsertOne)
+        self.assertIsInstance(chunks[1][2], UpdateOne)
+        self.assertIsInstance(chunks[2][0], DeleteOne)
+
+    def test_merge_uses_upserted_id(self, ):
+        summary = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0,
+                   "upserted_count": 0, "upserted_id": {}, "write_errors": []}
+        self.session._merge_bulk_result(summary, {"nUpserted": 1, "upserted": [{"index": 1, "_id": "f"}]}, 0)
+        self.session._merge_bulk_result(summary, {"nInserted": 1, "writeErrors": [
+            {"index": 0, "code": 11000, "errmsg": "dup"}]}, 3)
+        self.assertEqual(summary["upserted_id"], {1: "f"})
+        self.assertEqual(summary["write_errors"], [{"index": 3, "code": 11000, "errmsg": "dup"}])
+        self.assertEqual(summary["upserted_count"], 1)
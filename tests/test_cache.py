@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/29 上午10:20
+"""
+import unittest
+from unittest import mock
+
+from fesdql import Query, _cachelru
+from fesdql.query import COUNT_CAPPED
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def count_calls(session, name: str):
+    """
+    统计session中某个方法的调用次数
+    Args:
+        session: session
+        name: 方法名称
+    Returns:
+        返回调用参数的列表
+    """
+    calls = []
+    method = getattr(session, name)
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return method(*args, **kwargs)
+
+    setattr(session, name, counted)
+    return calls
+
+
+class FakeClock(object):
+    """
+    替换_cachelru中的time模块,手动推进时间
+    """
+
+    def __init__(self, ):
+        self.now = 1000.0
+
+    def monotonic(self, ):
+        return self.now
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "group": i % 2} for i in range(10)]))
+        self.calls = count_calls(self.session, "_find_many")
+
+    def test_same_query_hits_cache(self, ):
+        first = self.session.find_all(Query().collection("docs").where(group=0).cache(30))
+        second = self.session.find_all(Query().collection("docs").where(group=0).cache(30))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(first, second)
+        # 缓存中的document和返回的document互不影响
+        second[0]["index"] = -1
+        third = self.session.find_all(Query().collection("docs").where(group=0).cache(30))
+        self.assertEqual(third[0]["index"], 0)
+
+    def test_different_query_has_different_key(self, ):
+        self.session.find_all(Query().collection("docs").where(group=0).cache(30))
+        self.session.find_all(Query().collection("docs").where(group=1).cache(30))
+        self.session.find_all(Query().collection("docs").where(group=0).exclude(index=0).cache(30))
+        self.session.find_all(Query().collection("docs").where(group=0).order_by(("index", -1)).cache(30))
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(len({self.session._cache_key("docs", "find_all", {"group": 0}),
+                              self.session._cache_key("docs", "find_all", {"group": 1}),
+                              self.session._cache_key("other", "find_all", {"group": 0})}), 3)
+
+    def test_query_without_cache_always_hits_mongo(self, ):
+        self.session.find_all(Query().collection("docs"))
+        self.session.find_all(Query().collection("docs"))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_ttl_expiry(self, ):
+        clock = FakeClock()
+        with mock.patch.object(_cachelru, "time", clock):
+            self.session.find_all(Query().collection("docs").cache(30))
+            clock.now += 29
+            self.session.find_all(Query().collection("docs").cache(30))
+            self.assertEqual(len(self.calls), 1)
+            clock.now += 2
+            self.session.find_all(Query().collection("docs").cache(30))
+            self.assertEqual(len(self.calls), 2)
+
+    def test_insert_invalidates(self, ):
+        query = Query().collection("docs").where(group=0).cache(30)
+        self.assertEqual(len(self.session.find_all(query)), 5)
+        self.session.insert_one(Query().collection("docs").insert_query({"index": 10, "group": 0}))
+        self.assertEqual(len(self.session.find_all(query)), 6)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_update_invalidates(self, ):
+        query = Query().collection("docs").where(index=1).cache(30)
+        self.assertEqual(self.session.find_one(query)["group"], 1)
+        self.session.update_many(Query().collection("docs").where(index=1).update_query({"group": 0}))
+        self.assertEqual(self.session.find_one(query)["group"], 0)
+
+    def test_delete_invalidates(self, ):
+        query = Query().collection("docs").paginate_query(page=1, per_page=3).cache(30)
+        self.assertEqual(self.session.find_many(query).total, 10)
+        self.session.delete_many(Query().collection("docs").where(group=1))
+        pagination = self.session.find_many(query)
+        self.assertEqual(pagination.total, 5)
+        self.assertEqual([doc["index"] for doc in pagination.items], [0, 2, 4])
+
+    def test_write_to_other_collection_keeps_cache(self, ):
+        self.session.find_all(Query().collection("docs").cache(30))
+        self.session.insert_one(Query().collection("others").insert_query({"index": 0}))
+        self.session.find_all(Query().collection("docs").cache(30))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_async_insert_invalidates(self, ):
+        async def find():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(3)]))
+            query = Query().collection("docs").cache(30)
+            before = await session.find_all(query)
+            cached = await session.find_all(query)
+            await session.insert_one(Query().collection("docs").insert_query({"index": 3}))
+            after = await session.find_all(query)
+            return before, cached, after
+
+        before, cached, after = run(find())
+        self.assertEqual((len(before), len(cached), len(after)), (3, 3, 4))
+
+
+class CountCacheTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session(count_cache_ttl=30)
+        self.session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "group": i % 2} for i in range(30)]))
+        self.calls = count_calls(self.session, "_find_count")
+
+    def test_pages_share_count(self, ):
+        for page in (1, 2, 3):
+            pagination = self.session.find_many(Query().collection("docs").paginate_query(page=page, per_page=5))
+            self.assertEqual(pagination.total, 30)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_different_filter_has_different_key(self, ):
+        self.session.find_many(Query().collection("docs").where(group=0).paginate_query(page=1, per_page=5))
+        self.session.find_many(Query().collection("docs").where(group=1).paginate_query(page=1, per_page=5))
+        self.session.find_many(Query().collection("docs").where(group=0).paginate_query(
+            page=1, per_page=5).count_strategy(COUNT_CAPPED, cap=10))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_ttl_expiry(self, ):
+        clock = FakeClock()
+        with mock.patch.object(_cachelru, "time", clock):
+            session = make_sync_session(count_cache_ttl=30)
+            session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(30)]))
+            calls = count_calls(session, "_find_count")
+            session.find_many(Query().collection("docs").paginate_query(page=1, per_page=5))
+            clock.now += 29
+            session.find_many(Query().collection("docs").paginate_query(page=2, per_page=5))
+            self.assertEqual(len(calls), 1)
+            clock.now += 2
+            session.find_many(Query().collection("docs").paginate_query(page=3, per_page=5))
+            self.assertEqual(len(calls), 2)
+
+    def test_write_invalidates(self, ):
+        query = Query().collection("docs").paginate_query(page=1, per_page=5)
+        self.assertEqual(self.session.find_many(query).total, 30)
+        self.session.insert_one(Query().collection("docs").insert_query({"index": 30, "group": 0}))
+        self.assertEqual(self.session.find_many(query).total, 31)
+        self.session.update_many(Query().collection("docs").where(group=1).update_query({"group": 0}))
+        self.session.delete_many(Query().collection("docs").where(index={"lt": 10}))
+        self.assertEqual(self.session.find_many(query).total, 21)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_disabled_by_default(self, ):
+        session = make_sync_session()
+        session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(30)]))
+        calls = count_calls(session, "_find_count")
+        session.find_many(Query().collection("docs").paginate_query(page=1, per_page=5))
+        session.find_many(Query().collection("docs").paginate_query(page=2, per_page=5))
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
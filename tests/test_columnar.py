@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午3:20
+"""
+import unittest
+
+from fesdql import Query
+from fesdql._columnar import ColumnarBuilder
+
+from .helpers import make_sync_session
+
+
+class ColumnarBuilderTestCase(unittest.TestCase):
+
+    def test_object_column_keeps_list_values(self, ):
+        builder = ColumnarBuilder(["tags", "age"], {"age": "int64"})
+        builder.extend([{"tags": ["a", "b"], "age": 1}, {"tags": ["c", "d"]}, {"tags": None, "age": 3}])
+        columns, masks = builder.result()
+        self.assertEqual(list(columns["tags"]), [["a", "b"], ["c", "d"], None])
+        self.assertEqual(list(columns["age"]), [1, 0, 3])
+        self.assertEqual([bool(val) for val in masks["age"]], [False, True, False])
+
+    def test_id_column_with_and_without_convert_id(self, ):
+        for convert_id in (True, False):
+            session = make_sync_session(convert_id=convert_id)
+            ids = session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(3)]))
+            columns, masks = session.find_columns(Query().collection("docs"), ["id", "index"])
+            self.assertEqual([str(val) for val in columns["id"]], ids)
+            self.assertFalse(any(masks["id"]))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 上午11:20
+"""
+import unittest
+from unittest import mock
+
+from fesdql._alchemy import BaseMongo
+
+
+class App(object):
+
+    def __init__(self, config):
+        self.config = config
+
+
+class InitAppConfigTestCase(unittest.TestCase):
+
+    def test_count_cache_from_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_COUNT_CACHE_TTL": 30, "FESDQL_MONGO_COUNT_CACHE_SIZE": 16}))
+        self.assertEqual((mongo.count_cache_ttl, mongo.count_cache_size), (30, 16))
+
+    def test_kwargs_over_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_COUNT_CACHE_SIZE": 16}), count_cache_size=64)
+        self.assertEqual(mongo.count_cache_size, 64)
+
+    def test_defaults_without_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_HOST": "127.0.0.1"}))
+        self.assertEqual((mongo.count_cache_ttl, mongo.count_cache_size), (0, 1024))
+
+    def test_result_cache_size_from_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_RESULT_CACHE_SIZE": 32}))
+        self.assertEqual(mongo.result_cache_size, 32)
+        mongo.init_app(App({"FESDQL_MONGO_RESULT_CACHE_SIZE": 32}), result_cache_size=64)
+        self.assertEqual(mongo.result_cache_size, 64)
+
+    def test_buffer_options_from_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_BUFFER_MAX_SIZE": 64, "FESDQL_MONGO_BUFFER_FLUSH_INTERVAL": 0.5}))
+        self.assertEqual((mongo.buffer_max_size, mongo.buffer_flush_interval), (64, 0.5))
+
+    def test_single_flight_false_from_config(self, ):
+        mongo = BaseMongo(single_flight=True)
+        mongo.init_app(App({"FESDQL_MONGO_SINGLE_FLIGHT": False}))
+        self.assertIs(mongo.single_flight, False)
+        mongo.init_app(App({"FESDQL_MONGO_SINGLE_FLIGHT": False}), single_flight=True)
+        self.assertIs(mongo.single_flight, True)
+
+    def test_init_engine_single_flight_false(self, ):
+        mongo = BaseMongo(single_flight=True)
+        with mock.patch.object(BaseMongo, "_create_engine"):
+            mongo.init_engine(single_flight=False)
+        self.assertIs(mongo.single_flight, False)
+
+    def test_convert_id_false_from_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_CONVERT_ID": False}))
+        self.assertIs(mongo.convert_id, False)
+        mongo.init_app(App({"FESDQL_MONGO_CONVERT_ID": False}), convert_id=True)
+        self.assertIs(mongo.convert_id, True)
+
+    def test_slow_query_ms_zero_from_config(self, ):
+        mongo = BaseMongo(slow_query_ms=100)
+        mongo.init_app(App({"FESDQL_MONGO_SLOW_QUERY_MS": 0}))
+        self.assertEqual(mongo.slow_query_ms, 0)
+        mongo.init_app(App({"FESDQL_MONGO_SLOW_QUERY_MS": 50}))
+        self.assertEqual(mongo.slow_query_ms, 50)
+
+    def test_init_engine_slow_query_ms_zero(self, ):
+        mongo = BaseMongo(slow_query_ms=100)
+        with mock.patch.object(BaseMongo, "_create_engine"):
+            mongo.init_engine(slow_query_ms=0)
+        self.assertEqual(mongo.slow_query_ms, 0)
+
+    def test_workload_size_from_config(self, ):
+        mongo = BaseMongo()
+        mongo.init_app(App({"FESDQL_MONGO_WORKLOAD_SIZE": 8}))
+        self.assertEqual(mongo.workload_size, 8)
+        self.assertIsNotNone(mongo.workload_stats)
+        mongo.init_app(App({"FESDQL_MONGO_WORKLOAD_SIZE": 0}))
+        self.assertEqual(mongo.workload_size, 0)
+        self.assertIsNone(mongo.workload_stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 上午10:05
+"""
+import unittest
+
+from fesdql import Query
+
+from .helpers import make_sync_session
+
+
+class ConvertIdsTestCase(unittest.TestCase):
+
+    def test_convert_ids(self, ):
+        session = make_sync_session()
+        docs = session._convert_ids([{"_id": 1, "a": 1}, {"a": 2}])
+        self.assertEqual(docs, [{"id": "1", "a": 1}, {"a": 2}])
+        self.assertEqual(session._convert_ids([{"_id": 1}], to_str=False), [{"id": 1}])
+
+    def test_skip_when_id_not_projected(self, ):
+        session = make_sync_session()
+        docs = [{"_id": 1, "a": 1}]
+        # 投影排除了_id时直接返回,不再逐条处理
+        self.assertIs(session._convert_ids(docs, exclude_key={"_id": 0}), docs)
+        self.assertEqual(docs, [{"_id": 1, "a": 1}])
+        self.assertEqual(session._convert_ids([{"_id": 1}], exclude_key={"a": 1}), [{"id": "1"}])
+
+    def test_find_many_without_id(self, ):
+        session = make_sync_session()
+        session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(3)]))
+        docs = session.find_all(Query().collection("docs").exclude(_id=0).order_by(("index", 1)))
+        self.assertEqual(docs, [{"index": i} for i in range(3)])
+
+    def test_convert_id_disabled(self, ):
+        session = make_sync_session(convert_id=False)
+        session.insert_many(Query().collection("docs").insert_query([{"index": 1}]))
+        doc, = session.find_all(Query().collection("docs"))
+        self.assertIn("_id", doc)
+        self.assertNotIn("id", doc)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/29 上午11:05
+"""
+import unittest
+
+from fesdql import Query
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def facet_query(page: int, per_page: int = 10, use_facet: bool = True) -> Query:
+    return Query().collection("docs").where(age={"gte": 2}).order_by(("index", -1)).exclude(
+        name=0).paginate_query(page=page, per_page=per_page, use_facet=use_facet)
+
+
+class FacetPaginationTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "age": i % 5, "name": "name{}".format(i)} for i in range(50)]))
+
+    def test_same_result_as_offset_pagination(self, ):
+        # 匹配30条,最后一页不满
+        for page, per_page in ((1, 10), (3, 10), (4, 8), (5, 10)):
+            facet = self.session.find_many(facet_query(page, per_page))
+            offset = self.session.find_many(facet_query(page, per_page, use_facet=False))
+            self.assertEqual(facet.items, offset.items)
+            self.assertEqual((facet.total, facet.pages, facet.has_next, facet.has_prev),
+                             (offset.total, offset.pages, offset.has_next, offset.has_prev))
+        self.assertEqual(self.session.find_many(facet_query(4, 8)).total, 30)
+
+    def test_items_are_converted(self, ):
+        items = self.session.find_many(facet_query(1, 3)).items
+        self.assertEqual([doc["index"] for doc in items], [49, 48, 47])
+        for doc in items:
+            self.assertIn("id", doc)
+            self.assertNotIn("_id", doc)
+            self.assertNotIn("name", doc)
+
+    def test_one_aggregate_per_page(self, ):
+        calls = []
+        find_count, find_many = self.session._find_count, self.session._find_many
+        self.session._find_count = lambda *args, **kwargs: calls.append("count") or find_count(*args, **kwargs)
+        self.session._find_many = lambda *args, **kwargs: calls.append("find") or find_many(*args, **kwargs)
+        self.session.find_many(facet_query(2))
+        self.assertEqual(calls, [])
+
+    def test_no_match(self, ):
+        pagination = self.session.find_many(Query().collection("docs").where(age=9).paginate_query(
+            page=1, per_page=10, use_facet=True))
+        self.assertEqual((pagination.items, pagination.total, pagination.has_next), ([], 0, False))
+
+    def test_async_same_result_as_offset_pagination(self, ):
+        async def find():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query(
+                [{"index": i, "age": i % 5, "name": "name{}".format(i)} for i in range(50)]))
+            return await session.find_many(facet_query(2)), await session.find_many(facet_query(2, use_facet=False))
+
+        facet, offset = run(find())
+        self.assertEqual(facet.items, offset.items)
+        self.assertEqual((facet.total, facet.has_next), (offset.total, offset.has_next))
+        self.assertEqual([doc["index"] for doc in facet.items][:3], [33, 32, 29])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/29 下午3:30
+"""
+import asyncio
+import threading
+import time
+import unittest
+
+from fesdql import Query
+from fesdql.err import FuncArgsError
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def gather_queries():
+    return (("find_count", Query().collection("docs").where(group=0)),
+            ("find_many", Query().collection("docs").paginate_query(page=2, per_page=3)),
+            ("find_all", Query().collection("docs").where(index={"lt": 2})),
+            ("find_one", Query().collection("docs").where(index=7)))
+
+
+class ConcurrencyProbe(object):
+    """
+    记录同时执行的查询数量
+    """
+
+    def __init__(self, ):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def enter(self, ):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def exit(self, ):
+        with self.lock:
+            self.active -= 1
+
+
+class SyncGatherTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session(pool_size=3)
+        self.session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "group": i % 2} for i in range(10)]))
+
+    def slow_find_count(self, probe: ConcurrencyProbe):
+        find_count = self.session.find_count
+
+        def counted(query):
+            probe.enter()
+            try:
+                time.sleep(0.05)
+                return find_count(query)
+            finally:
+                probe.exit()
+
+        self.session.find_count = counted
+
+    def test_results_in_order(self, ):
+        count, pagination, docs, doc = self.session.gather(*gather_queries())
+        self.assertEqual(count, 5)
+        self.assertEqual([val["index"] for val in pagination.items], [3, 4, 5])
+        self.assertEqual([val["index"] for val in docs], [0, 1])
+        self.assertEqual(doc["index"], 7)
+
+    def test_error_in_its_slot(self, ):
+        results = self.session.gather(("find_count", Query().collection("docs")),
+                                      ("find_many", Query().collection("docs").keyset_query(after="bad")),
+                                      ("find_count", Query().collection("docs").where(group=1)))
+        self.assertEqual(results[0], 10)
+        self.assertIsInstance(results[1], FuncArgsError)
+        self.assertEqual(results[2], 5)
+
+    def test_unknown_operation(self, ):
+        with self.assertRaises(FuncArgsError):
+            self.session.gather(("find_count", Query().collection("docs")), ("drop", Query().collection("docs")))
+
+    def test_limit(self, ):
+        probe = ConcurrencyProbe()
+        self.slow_find_count(probe)
+        results = self.session.gather(*[("find_count", Query().collection("docs")) for _ in range(6)], limit=2)
+        self.assertEqual(results, [10] * 6)
+        self.assertEqual(probe.max_active, 2)
+
+    def test_default_limit_is_pool_size(self, ):
+        probe = ConcurrencyProbe()
+        self.slow_find_count(probe)
+        self.session.gather(*[("find_count", Query().collection("docs")) for _ in range(6)])
+        self.assertEqual(probe.max_active, 3)
+
+
+class AsyncGatherTestCase(unittest.TestCase):
+
+    def gather(self, *queries, limit: int = 0, probe: ConcurrencyProbe = None):
+        async def find():
+            session = make_async_session(pool_size=3)
+            await session.insert_many(Query().collection("docs").insert_query(
+                [{"index": i, "group": i % 2} for i in range(10)]))
+            if probe is not None:
+                find_count = session.find_count
+
+                async def counted(query):
+                    probe.enter()
+                    try:
+                        await asyncio.sleep(0.02)
+                        return await find_count(query)
+                    finally:
+                        probe.exit()
+
+                session.find_count = counted
+            return await session.gather(*queries, limit=limit)
+
+        return run(find())
+
+    def test_results_in_order(self, ):
+        count, pagination, docs, doc = self.gather(*gather_queries())
+        self.assertEqual(count, 5)
+        self.assertEqual([val["index"] for val in pagination.items], [3, 4, 5])
+        self.assertEqual([val["index"] for val in docs], [0, 1])
+        self.assertEqual(doc["index"], 7)
+
+    def test_error_in_its_slot(self, ):
+        results = self.gather(("find_count", Query().collection("docs")),
+                              ("find_many", Query().collection("docs").keyset_query(after="bad")),
+                              ("find_count", Query().collection("docs").where(group=1)))
+        self.assertEqual(results[0], 10)
+        self.assertIsInstance(results[1], FuncArgsError)
+        self.assertEqual(results[2], 5)
+
+    def test_unknown_operation(self, ):
+        with self.assertRaises(FuncArgsError):
+            self.gather(("find_columns", Query().collection("docs")))
+
+    def test_limit(self, ):
+        probe = ConcurrencyProbe()
+        results = self.gather(*[("find_count", Query().collection("docs")) for _ in range(6)], limit=2, probe=probe)
+        self.assertEqual(results, [10] * 6)
+        self.assertEqual(probe.max_active, 2)
+
+    def test_default_limit_is_pool_size(self, ):
+        probe = ConcurrencyProbe()
+        self.gather(*[("find_count", Query().collection("docs")) for _ in range(6)], probe=probe)
+        self.assertEqual(probe.max_active, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 下午3:30
+"""
+import unittest
+from unittest import mock
+
+from pymongo.errors import InvalidName
+
+from benchmarks.standin import MemoryCollection
+from fesdql import Query
+from fesdql._hooks import OperationHooks, current_span
+from fesdql.err import MongoInvalidNameError
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+class StreamingHooksTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.spans = []
+        self.hooks = OperationHooks()
+        self.hooks.add(after=self.spans.append)
+        self.documents = [{"index": i} for i in range(5)]
+
+    def test_iter_span_covers_cursor_lifetime(self, ):
+        session = make_sync_session(hooks=self.hooks)
+        session.insert_many(Query().collection("docs").insert_query(self.documents))
+        del self.spans[:]
+        docs = list(session.iter_many(Query().collection("docs"), batch_size=2))
+        self.assertEqual(len(docs), 5)
+        span, = self.spans
+        self.assertEqual((span.operation, span.cname, span.docs, span.error), ("iter_many", "docs", 5, None))
+
+    def test_early_exit_is_not_an_error(self, ):
+        session = make_sync_session(hooks=self.hooks)
+        session.insert_many(Query().collection("docs").insert_query(self.documents))
+        del self.spans[:]
+        iterator = session.iter_many(Query().collection("docs"))
+        next(iterator)
+        # 流式查询的span不会成为调用方上下文中的span
+        self.assertIsNone(current_span())
+        iterator.close()
+        span, = self.spans
+        self.assertEqual((span.docs, span.error), (1, None))
+
+    def test_error_reaches_after_hook(self, ):
+        session = make_sync_session(hooks=self.hooks)
+        with mock.patch.object(MemoryCollection, "find", side_effect=InvalidName("bad name")):
+            with self.assertRaises(MongoInvalidNameError):
+                list(session.iter_many(Query().collection("docs")))
+        span, = self.spans
+        self.assertIsInstance(span.error, MongoInvalidNameError)
+
+    def test_find_columns_span(self, ):
+        session = make_sync_session(hooks=self.hooks)
+        session.insert_many(Query().collection("docs").insert_query(self.documents))
+        del self.spans[:]
+        session.find_columns(Query().collection("docs"), ["index"])
+        self.assertEqual([(span.operation, span.docs) for span in self.spans], [("find_columns", 5)])
+
+    def test_async_parallel_scan_spans(self, ):
+        async def scan():
+            session = make_async_session(hooks=self.hooks)
+            await session.insert_many(Query().collection("docs").insert_query(self.documents))
+            del self.spans[:]
+            return [doc async for doc in session.parallel_scan(Query().collection("docs"), partitions=2)]
+
+        docs = run(scan())
+        spans = [span for span in self.spans if span.operation == "scan_partition"]
+        self.assertTrue(spans)
+        self.assertEqual(sum(span.docs for span in spans), len(docs))
+        self.assertTrue(all(span.error is None for span in spans))
+
+
+if __name__ == '__main__':
+    unittest.main()
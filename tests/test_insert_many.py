@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午4:30
+"""
+import unittest
+
+from bson.errors import InvalidDocument
+
+from fesdql import Query
+from fesdql.err import HttpError
+
+from .helpers import AELOG_COMPATIBLE, make_async_session, run
+
+
+def insert_query(documents):
+    return Query().collection("docs").insert_query(documents)
+
+
+class ChunkedInsertManyTestCase(unittest.TestCase):
+
+    def test_unordered_chunks(self, ):
+        async def insert():
+            session = make_async_session()
+            return await session.insert_many(insert_query([{"index": i} for i in range(25)]), chunk_size=10,
+                                             ordered=False, concurrency=2)
+
+        self.assertEqual(len(set(run(insert()))), 25)
+
+    def test_unordered_failed_chunk_keeps_other_ids(self, ):
+        documents = [{"index": i} for i in range(30)]
+        documents[10] = {"index": 10, "bad": object()}
+
+        async def insert():
+            session = make_async_session()
+            with self.assertRaises(InvalidDocument) as ctx:
+                await session.insert_many(insert_query(documents), chunk_size=10, ordered=False)
+            return ctx.exception
+
+        error = run(insert())
+        expected = [str(document["_id"]) for document in documents[:10] + documents[20:]]
+        self.assertEqual(error.inserted_ids, expected)
+
+    @unittest.skipUnless(AELOG_COMPATIBLE, "aelog can not log exceptions on this python version")
+    def test_duplicate_key_in_chunks(self, ):
+        async def insert(ordered):
+            session = make_async_session()
+            await session.insert_one(insert_query({"_id": "dup"}))
+            documents = [{"index": i} for i in range(30)]
+            documents[12] = {"_id": "dup"}
+            with self.assertRaises(HttpError) as ctx:
+                await session.insert_many(insert_query(documents), chunk_size=10, ordered=ordered)
+            return documents, ctx.exception
+
+        documents, error = run(insert(False))
+        self.assertEqual(error.inserted_ids, [str(document["_id"]) for document in documents if
+                                              document["_id"] != "dup"])
+        documents, error = run(insert(True))
+        self.assertEqual(error.inserted_ids, [str(document["_id"]) for document in documents[:12]])
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午4:02
+"""
+import unittest
+
+from fesdql import Query
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+class KeysetTotalTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(25)]))
+        self.counts = []
+        find_count = self.session._find_count
+
+        def counted_find_count(*args, **kwargs):
+            self.counts.append(args)
+            return find_count(*args, **kwargs)
+
+        self.session._find_count = counted_find_count
+
+    def test_keyset_pages_skip_count_by_default(self, ):
+        first = self.session.find_many(Query().collection("docs").keyset_query(per_page=10))
+        second = self.session.find_many(Query().collection("docs").keyset_query(after=first.next_cursor,
+                                                                                 per_page=10))
+        self.assertEqual(self.counts, [])
+        self.assertIsNone(first.total)
+        self.assertIsNone(second.pages)
+        self.assertTrue(second.has_next)
+        self.assertTrue(second.has_prev)
+        self.assertEqual([doc["index"] for doc in second.items], list(range(10, 20)))
+
+    def test_keyset_with_total(self, ):
+        first = self.session.find_many(Query().collection("docs").keyset_query(per_page=10, with_total=True))
+        self.assertEqual(first.total, 25)
+        self.assertEqual(first.pages, 3)
+        self.assertEqual(len(self.counts), 1)
+
+    def test_async_keyset_pages_skip_count_by_default(self, ):
+        async def paginate():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(25)]))
+            first = await session.find_many(Query().collection("docs").keyset_query(per_page=10))
+            last = await session.find_many(Query().collection("docs").keyset_query(after=first.next_cursor,
+                                                                                    per_page=20))
+            return first, last
+
+        first, last = run(paginate())
+        self.assertIsNone(first.total)
+        self.assertFalse(last.has_next)
+        self.assertEqual([doc["index"] for doc in last.items], list(range(10, 25)))
+
+
+class KeysetNullTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        # 5个document的rank为null或者不存在,其他的rank有重复
+        documents = [{"index": i, "rank": [3, 1, None, 2, 1, None, 5, None, 4, 2][i]} for i in range(10)]
+        documents.extend({"index": i} for i in range(10, 12))
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query(documents))
+
+    def walk(self, direction, backward=False):
+        def query(**kwargs):
+            return Query().collection("docs").order_by(("rank", direction)).keyset_query(per_page=3, **kwargs)
+
+        pagination = self.session.find_many(query())
+        pages = [pagination.items]
+        while pagination.has_next and len(pages) < 10:
+            pagination = self.session.find_many(query(after=pagination.next_cursor))
+            pages.append(pagination.items)
+        if backward:
+            pages = [pagination.items]
+            while pagination.has_prev and len(pages) < 10:
+                pagination = self.session.find_many(query(before=pagination.prev_cursor))
+                pages.insert(0, pagination.items)
+        return [doc["index"] for page in pages for doc in page]
+
+    def expected(self, direction):
+        docs = self.session.find_all(Query().collection("docs").order_by(("rank", direction), ("_id", 1)))
+        return [doc["index"] for doc in docs]
+
+    def test_forward_pages_include_null_values(self, ):
+        for direction in (1, -1):
+            indexes = self.walk(direction)
+            self.assertEqual(sorted(indexes), list(range(12)))
+            self.assertEqual(indexes, self.expected(direction))
+
+    def test_backward_pages_include_null_values(self, ):
+        for direction in (1, -1):
+            self.assertEqual(self.walk(direction, backward=True), self.expected(direction))
+
+    def test_pagination_next_across_null_values(self, ):
+        pagination = self.session.find_many(Query().collection("docs").order_by(("rank", 1)).keyset_query(
+            per_page=4))
+        indexes = [doc["index"] for doc in pagination.items]
+        while pagination.has_next:
+            indexes.extend(doc["index"] for doc in pagination.next())
+        self.assertEqual(indexes, self.expected(1))
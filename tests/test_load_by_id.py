@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午2:45
+"""
+import asyncio
+import unittest
+
+from bson import ObjectId
+from bson.errors import InvalidBSON
+
+from fesdql import Query
+
+from .helpers import make_async_session, run
+
+asyncio_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+
+
+class LoadByIdTestCase(unittest.TestCase):
+
+    def test_batched_into_one_query(self, ):
+        async def load():
+            session = make_async_session()
+            ids = await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(5)]))
+            calls = []
+            find_many = session._find_many
+
+            async def counted_find_many(*args, **kwargs):
+                calls.append(args)
+                return await find_many(*args, **kwargs)
+
+            session._find_many = counted_find_many
+            docs = await asyncio.gather(session.load_by_id("docs", ids[3]), session.load_by_id("docs", ids[0]),
+                                        session.load_by_id("docs", ids[3]), session.load_by_id("docs", str(ObjectId())))
+            return calls, docs
+
+        calls, docs = run(load())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([doc["index"] if doc else None for doc in docs], [3, 0, 3, None])
+        self.assertIsNot(docs[0], docs[2])
+
+    def test_bson_error_does_not_hang(self, ):
+        async def load():
+            session = make_async_session()
+
+            async def broken_find_many(*args, **kwargs):
+                raise InvalidBSON("bad document")
+
+            session._find_many = broken_find_many
+            return await asyncio.gather(session.load_by_id("docs", str(ObjectId())),
+                                        session.load_by_id("docs", str(ObjectId())), return_exceptions=True)
+
+        results = run(load(), timeout=2)
+        self.assertTrue(all(isinstance(result, InvalidBSON) for result in results))
+
+    def test_cancelled_load_does_not_hang(self, ):
+        async def load():
+            session = make_async_session()
+            loaders = []
+
+            async def never_finish(*args, **kwargs):
+                loaders.append(asyncio_current_task())
+                await asyncio.sleep(3600)
+
+            session._find_many = never_finish
+            waiter = asyncio.ensure_future(session.load_by_id("docs", str(ObjectId())))
+            while not loaders:
+                await asyncio.sleep(0)
+            loaders[0].cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            return waiter
+
+        waiter = run(load(), timeout=2)
+        self.assertTrue(waiter.cancelled())
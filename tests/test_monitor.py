@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 下午5:05
+"""
+import unittest
+
+from fesdql import Query, SyncMongo
+from fesdql._monitor import OperationStats, WorkloadStats, query_shape
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+class QueryShapeTestCase(unittest.TestCase):
+
+    def test_dollar_string_values_in_filter(self, ):
+        self.assertEqual(query_shape({"price": "$100", "tag": {"$in": ["$a", "$b"]}}),
+                         {"price": "?", "tag": {"$in": "?"}})
+        self.assertEqual(WorkloadStats.fingerprint("docs", "find_many", {"price": "$100"})[0],
+                         WorkloadStats.fingerprint("docs", "find_many", {"price": "$200"})[0])
+
+    def test_field_references_in_pipeline(self, ):
+        pipeline = [{"$match": {"price": "$100"}}, {"$group": {"_id": "$city", "total": {"$sum": "$price"}}},
+                    {"$limit": 10}]
+        self.assertEqual(query_shape(pipeline, True),
+                         [{"$match": {"price": "?"}}, {"$group": {"_id": "$city", "total": {"$sum": "$price"}}},
+                          {"$limit": "?"}])
+        self.assertEqual(query_shape({"$expr": {"$gt": ["$spent", "$budget"]}, "name": "$x"}),
+                         {"$expr": {"$gt": "?"}, "name": "?"})
+
+
+class WorkloadTestCase(unittest.TestCase):
+
+    def test_disabled_by_default(self, ):
+        self.assertIsNone(SyncMongo().workload_stats)
+        self.assertEqual(SyncMongo().workload_report(), [])
+
+    def test_report_groups_by_shape(self, ):
+        session = make_sync_session(workload_stats=WorkloadStats(16))
+        session.insert_many(Query().collection("docs").insert_query([{"age": i} for i in range(5)]))
+        for age in range(3):
+            session.find_one(Query().collection("docs").where(age=age))
+        report = session.workload_stats.report(order_by="count")
+        self.assertEqual(report[0]["count"], 3)
+        self.assertEqual(report[0]["filter"], {"age": "?"})
+
+    def test_streaming_reads_in_report(self, ):
+        session = make_sync_session(workload_stats=WorkloadStats(16))
+        session.insert_many(Query().collection("docs").insert_query([{"age": i} for i in range(20)]))
+        for age in (1, 2):
+            list(session.iter_many(Query().collection("docs").where(age={"gte": age})))
+        session.find_columns(Query().collection("docs").where(age={"lt": 5}), ["age"])
+        list(session.parallel_scan(Query().collection("docs"), partitions=2))
+        report = {item["operation"]: item for item in session.workload_stats.report(order_by="count")}
+        self.assertEqual(report["iter_many"]["count"], 2)
+        self.assertEqual(report["iter_many"]["filter"], {"age": {"$gte": "?"}})
+        self.assertEqual(report["iter_many"]["docs"], 19 + 18)
+        self.assertEqual(report["find_columns"]["docs"], 5)
+        self.assertIn("scan_partition", report)
+
+
+class StreamingLatencyTestCase(unittest.TestCase):
+
+    @staticmethod
+    def operations(stats):
+        return {item["operation"]: item["count"] for item in stats.snapshot()}
+
+    def test_one_record_per_cursor(self, ):
+        stats = OperationStats()
+        session = make_sync_session(operation_stats=stats)
+        session.insert_many(Query().collection("docs").insert_query([{"age": i} for i in range(5)]))
+        list(session.iter_many(Query().collection("docs"), batch_size=2))
+        session.find_columns(Query().collection("docs"), ["age"])
+        iterator = session.iter_many(Query().collection("docs"))
+        next(iterator)
+        iterator.close()
+        operations = self.operations(stats)
+        self.assertEqual((operations["iter_many"], operations["find_columns"]), (2, 1))
+
+    def test_async_parallel_scan_records_partitions(self, ):
+        stats = OperationStats()
+
+        async def scan():
+            session = make_async_session(operation_stats=stats)
+            await session.insert_many(Query().collection("docs").insert_query([{"age": i} for i in range(50)]))
+            return [doc async for doc in session.parallel_scan(Query().collection("docs"), partitions=2)]
+
+        run(scan())
+        self.assertGreaterEqual(self.operations(stats)["scan_partition"], 1)
+
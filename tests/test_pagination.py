@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 上午10:15
+"""
+import unittest
+from unittest import mock
+
+from benchmarks.standin import MemoryCollection
+from fesdql import Query
+from fesdql.query import COUNT_CAPPED, COUNT_ESTIMATED, COUNT_NONE
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def paginate_query(count_strategy, **kwargs):
+    return Query().collection("docs").paginate_query(page=1, per_page=10).count_strategy(count_strategy, **kwargs)
+
+
+def walk_pages(pagination):
+    """从第一页开始一直翻到has_next为False,返回每一页的index"""
+    pages = [[doc["index"] for doc in pagination.items]]
+    while pagination.has_next and len(pages) < 10:
+        pages.append([doc["index"] for doc in pagination.next()])
+    return pages
+
+
+class OffsetPaginationTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(25)]))
+
+    def test_has_next_follows_next_and_prev_with_exact_total(self, ):
+        pagination = self.session.find_many(paginate_query("exact"))
+        self.assertEqual(pagination.total, 25)
+        self.assertTrue(pagination.has_next)
+        pagination.next()
+        self.assertTrue(pagination.has_next)
+        self.assertEqual([doc["index"] for doc in pagination.next()], list(range(20, 25)))
+        self.assertFalse(pagination.has_next)
+        pagination.prev()
+        self.assertTrue(pagination.has_next)
+        self.assertTrue(pagination.has_prev)
+
+    def test_has_next_refreshed_without_total(self, ):
+        pagination = self.session.find_many(paginate_query(COUNT_NONE))
+        self.assertIsNone(pagination.total)
+        self.assertTrue(pagination.has_next)
+        self.assertEqual(len(pagination.next()), 10)
+        self.assertTrue(pagination.has_next)
+        self.assertEqual([doc["index"] for doc in pagination.next()], list(range(20, 25)))
+        self.assertFalse(pagination.has_next)
+        self.assertEqual(len(pagination.prev()), 10)
+        self.assertTrue(pagination.has_next)
+
+    def test_walk_every_page_with_approximate_total(self, ):
+        expected = [list(range(0, 10)), list(range(10, 20)), list(range(20, 25))]
+        # 估算的总数比实际的多
+        with mock.patch.object(MemoryCollection, "estimated_document_count", return_value=100):
+            pagination = self.session.find_many(paginate_query(COUNT_ESTIMATED))
+            self.assertTrue(pagination.total_approximate)
+            self.assertEqual(walk_pages(pagination), expected)
+        pagination = self.session.find_many(paginate_query(COUNT_CAPPED, cap=15))
+        self.assertTrue(pagination.total_approximate)
+        self.assertEqual(walk_pages(pagination), expected)
+
+    def test_walk_every_page_when_last_page_is_full(self, ):
+        self.session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(25, 30)]))
+        pagination = self.session.find_many(paginate_query(COUNT_CAPPED, cap=15))
+        self.assertEqual(walk_pages(pagination), [list(range(0, 10)), list(range(10, 20)), list(range(20, 30))])
+
+    def test_async_walk_every_page_with_approximate_total(self, ):
+        async def paginate():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(25)]))
+            pagination = await session.find_many(paginate_query(COUNT_CAPPED, cap=15))
+            pages = [[doc["index"] for doc in pagination.items]]
+            while pagination.has_next and len(pages) < 10:
+                pages.append([doc["index"] for doc in await pagination.next()])
+            return pages
+
+        self.assertEqual(run(paginate()), [list(range(0, 10)), list(range(10, 20)), list(range(20, 25))])
+
+    def test_async_has_next_refreshed_without_total(self, ):
+        async def paginate():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(15)]))
+            pagination = await session.find_many(paginate_query(COUNT_NONE))
+            first = pagination.has_next
+            items = await pagination.next()
+            return first, items, pagination.has_next
+
+        first, items, has_next = run(paginate())
+        self.assertTrue(first)
+        self.assertEqual(len(items), 5)
+        self.assertFalse(has_next)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 上午11:05
+"""
+import datetime
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+
+from benchmarks.standin import match
+from fesdql import Query
+from fesdql._alchemy import SessionMixIn
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def mixed_documents():
+    # _id中大部分是ObjectId,另外还有字符串和整数
+    documents = [{"_id": ObjectId(), "index": i} for i in range(200)]
+    documents.extend({"_id": "legacy-{}".format(i), "index": 200 + i} for i in range(5))
+    documents.extend({"_id": 1000 + i, "index": 205 + i} for i in range(3))
+    return documents
+
+
+class PartitionQueryKeysTestCase(unittest.TestCase):
+
+    def test_every_document_in_exactly_one_partition(self, ):
+        documents = mixed_documents() + [{"_id": ObjectId(), "index": -1, "value": None}]
+        for doc in documents:
+            doc.setdefault("value", doc["_id"])
+        samples = [{"value": doc["_id"]} for doc in documents[::3]]
+        query_keys = SessionMixIn._partition_query_keys({}, "value", samples, 4)
+        self.assertEqual(len(query_keys), 4)
+        for doc in documents:
+            self.assertEqual(sum(match(doc, query_key) for query_key in query_keys), 1, doc)
+
+    def test_no_partition_without_comparable_samples(self, ):
+        query_key = {"age": {"$gt": 1}}
+        self.assertEqual(SessionMixIn._partition_query_keys(query_key, "tags", [{"value": [1]}, {}], 4),
+                         [query_key])
+
+
+class PartitionBoundsTestCase(unittest.TestCase):
+
+    def test_sample_is_first_stage_without_filter(self, ):
+        self.assertIn("$sample", SessionMixIn._partition_pipline({}, "_id", 4)[0])
+        self.assertEqual(SessionMixIn._partition_pipline({"age": 1}, "_id", 4)[0], {"$match": {"age": 1}})
+
+    def test_interpolate_partition_samples(self, ):
+        self.assertEqual(SessionMixIn._interpolate_partition_samples(0, 100, 4),
+                         [{"value": 0}, {"value": 25}, {"value": 50}, {"value": 75}])
+        start = datetime.datetime(2024, 1, 1)
+        samples = SessionMixIn._interpolate_partition_samples(start, start + datetime.timedelta(days=4), 2)
+        self.assertEqual(samples[1]["value"], start + datetime.timedelta(days=2))
+        low, high = ObjectId.from_datetime(start), ObjectId.from_datetime(start + datetime.timedelta(days=4))
+        samples = SessionMixIn._interpolate_partition_samples(low, high, 2)
+        self.assertEqual(samples[1]["value"].generation_time.day, 3)
+        self.assertIsNone(SessionMixIn._interpolate_partition_samples("a", "z", 2))
+        self.assertIsNone(SessionMixIn._interpolate_partition_samples(1, "z", 2))
+
+    def test_filtered_scan_uses_min_and_max(self, ):
+        session = make_sync_session()
+        documents = [{"index": i, "age": i % 50} for i in range(200)] + [{"index": 200 + i} for i in range(5)]
+        session.insert_many(Query().collection("docs").insert_query(documents))
+        query = Query().collection("docs").where(index={"gte": 20})
+        with mock.patch.object(session, "_aggregate", side_effect=AssertionError("should not sample")):
+            query_keys = session._gen_partitions(query, 4, "age")
+            docs = list(session.parallel_scan(query, partitions=4, field="age"))
+        self.assertEqual(len(query_keys), 4)
+        self.assertEqual(sorted(doc["index"] for doc in docs), list(range(20, 205)))
+
+    def test_async_filtered_scan_uses_min_and_max(self, ):
+        async def scan():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query(
+                [{"index": i, "age": i % 50} for i in range(200)]))
+            query = Query().collection("docs").where(index={"lt": 150})
+            with mock.patch.object(session, "_aggregate", side_effect=AssertionError("should not sample")):
+                return [doc async for doc in session.parallel_scan(query, partitions=4, field="age")]
+
+        self.assertEqual(sorted(doc["index"] for doc in run(scan())), list(range(150)))
+
+    def test_filtered_scan_falls_back_to_sample(self, ):
+        session = make_sync_session()
+        session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "name": "name{:03d}".format(i)} for i in range(100)]))
+        query = Query().collection("docs").where(index={"lt": 90})
+        docs = list(session.parallel_scan(query, partitions=4, field="name"))
+        self.assertEqual(sorted(doc["index"] for doc in docs), list(range(90)))
+
+
+class ParallelScanTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.documents = mixed_documents()
+        self.expected = sorted(str(doc["_id"]) for doc in self.documents)
+
+    def test_sync_scan_mixed_type_ids(self, ):
+        session = make_sync_session()
+        session.insert_many(Query().collection("docs").insert_query(self.documents))
+        docs = list(session.parallel_scan(Query().collection("docs"), partitions=4, batch_size=16))
+        self.assertEqual(sorted(doc["id"] for doc in docs), self.expected)
+
+    def test_async_scan_mixed_type_ids(self, ):
+        async def scan():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query(self.documents))
+            return [doc async for doc in session.parallel_scan(Query().collection("docs"), partitions=4,
+                                                                batch_size=16)]
+
+        docs = run(scan())
+        self.assertEqual(sorted(doc["id"] for doc in docs), self.expected)
+
+    def test_async_scan_closes_cursors_on_early_exit(self, ):
+        cursors = []
+
+        async def scan():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query(self.documents))
+            collection = session._get_collection("docs")
+            find = collection.find
+
+            def tracked_find(*args, **kwargs):
+                cursor = find(*args, **kwargs)
+                cursors.append(cursor)
+                return cursor
+
+            with mock.patch.object(type(collection), "find", side_effect=tracked_find):
+                scanner = session.parallel_scan(Query().collection("docs"), partitions=4, batch_size=4)
+                async for _ in scanner:
+                    break
+                await scanner.aclose()
+            # 在事件循环关闭前检查,不依赖事件循环关闭时对异步生成器的清理
+            return [cursor.closed for cursor in cursors]
+
+        closed = run(scan())
+        self.assertTrue(closed)
+        self.assertTrue(all(closed))
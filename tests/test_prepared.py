@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 下午2:10
+"""
+import unittest
+
+from fesdql import Param, Query
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+class PreparedQueryBindTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.session.insert_many(Query().collection("docs").insert_query(
+            [{"index": i, "name": "doc{}".format(i)} for i in range(5)]))
+
+    def test_bind_find_many_times(self, ):
+        template = Query().collection("docs").where(index=Param("index")).prepare()
+        for index in (1, 3, 1):
+            doc = self.session.find_one(template.bind(index=index))
+            self.assertEqual(doc["name"], "doc{}".format(index))
+
+    def test_bind_update_many_times(self, ):
+        template = Query().collection("docs").where(index=Param("index")).update_query({"name": "updated"}).prepare()
+        for index in (0, 2, 4):
+            result = self.session.update_one(template.bind(index=index))
+            self.assertEqual(result["matched_count"], 1)
+        # 模板中的update data不会被修改
+        self.assertEqual(template._query._update_data, {"name": "updated"})
+        docs = self.session.find_all(Query().collection("docs").where(name="updated"))
+        self.assertEqual(sorted(doc["index"] for doc in docs), [0, 2, 4])
+
+    def test_bind_update_operator_many_times(self, ):
+        template = Query().collection("docs").where(index=Param("index")).update_query(
+            {"$inc": {"index": 10}}).prepare()
+        for index in (0, 1):
+            self.assertEqual(self.session.update_one(template.bind(index=index))["modified_count"], 1)
+        self.assertEqual(self.session.find_count(Query().collection("docs").where(index={"gte": 10})), 2)
+
+    def test_bind_delete_many_times(self, ):
+        template = Query().collection("docs").where(index=Param("index")).delete_query().prepare()
+        for index in (1, 2):
+            self.assertEqual(self.session.delete_one(template.bind(index=index)), 1)
+        self.assertEqual(self.session.delete_one(template.bind(index=1)), 0)
+        self.assertEqual(self.session.find_count(Query().collection("docs")), 3)
+
+    def test_bind_insert_many_times(self, ):
+        template = Query().collection("docs").insert_query({"name": "new"}).prepare()
+        ids = [self.session.insert_one(template.bind()) for _ in range(2)]
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual(template._query._insert_data, {"name": "new"})
+
+    def test_async_bind_update_many_times(self, ):
+        async def update():
+            session = make_async_session()
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(3)]))
+            template = Query().collection("docs").where(index=Param("index")).update_query({"name": "x"}).prepare()
+            return [(await session.update_one(template.bind(index=index)))["matched_count"] for index in range(3)]
+
+        self.assertEqual(run(update()), [1, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
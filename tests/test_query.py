@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/28 上午11:02
+"""
+import unittest
+
+from marshmallow import Schema, fields
+
+from fesdql import Query
+
+
+class UserSchema(Schema):
+    __tablename__ = "users"
+
+    id = fields.String()
+    name = fields.String()
+    age = fields.Integer()
+    email = fields.String()
+
+
+class AutoProjectTestCase(unittest.TestCase):
+
+    def test_exclude_before_auto_project(self, ):
+        query = Query().exclude(email=0, _id=0).collection(UserSchema, auto_project=True)
+        self.assertEqual(query._exclude_key, {"_id": 0, "name": 1, "age": 1})
+
+    def test_exclude_after_auto_project(self, ):
+        query = Query().collection(UserSchema, auto_project=True).exclude(email=0)
+        self.assertEqual(query._exclude_key, {"_id": 1, "name": 1, "age": 1})
+
+    def test_order_by_before_auto_project(self, ):
+        query = Query().order_by(("created", 1)).collection(UserSchema, auto_project=True)
+        self.assertEqual(query._exclude_key["created"], 1)
+        self.assertTrue(all(val for key, val in query._exclude_key.items() if key != "_id"))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/29 下午2:10
+"""
+import unittest
+
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from fesdql import Query
+
+from .helpers import make_async_session, make_sync_session, run
+
+
+def insert_docs(session):
+    return session.insert_many(Query().collection("docs").insert_query(
+        [{"index": i, "name": "name{}".format(i), "tags": ["a", "b"]} for i in range(10)]))
+
+
+class RawModeTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.session = make_sync_session()
+        self.ids = insert_docs(self.session)
+
+    def assert_raw(self, doc, index: int):
+        self.assertIsInstance(doc, RawBSONDocument)
+        # 不转换_id,原始的BSON字节可以直接转发
+        self.assertEqual(doc["_id"], ObjectId(self.ids[index]))
+        self.assertNotIn("id", doc)
+        self.assertEqual(BSON(doc.raw).decode()["index"], index)
+
+    def test_find_one(self, ):
+        doc = self.session.find_one(Query().collection("docs").where(index=3).raw())
+        self.assert_raw(doc, 3)
+        self.assertEqual(doc["tags"], ["a", "b"])
+
+    def test_find_all_with_projection(self, ):
+        docs = self.session.find_all(Query().collection("docs").where(index={"lt": 3}).exclude(name=0).raw())
+        self.assertEqual(len(docs), 3)
+        for index, doc in enumerate(docs):
+            self.assert_raw(doc, index)
+            self.assertNotIn("name", doc)
+
+    def test_find_many(self, ):
+        pagination = self.session.find_many(Query().collection("docs").paginate_query(page=2, per_page=4).raw())
+        self.assertEqual(pagination.total, 10)
+        for index, doc in enumerate(pagination.items, 4):
+            self.assert_raw(doc, index)
+        for index, doc in enumerate(pagination.next(), 8):
+            self.assert_raw(doc, index)
+
+    def test_iter_many(self, ):
+        docs = list(self.session.iter_many(Query().collection("docs").raw(), batch_size=3))
+        self.assertEqual(len(docs), 10)
+        for index, doc in enumerate(docs):
+            self.assert_raw(doc, index)
+
+    def test_aggregate(self, ):
+        docs = self.session.aggregate(Query().collection("docs").raw().aggregation(
+            [{"$match": {"index": {"$gte": 8}}}]))
+        self.assertEqual(len(docs), 2)
+        for index, doc in enumerate(docs, 8):
+            self.assert_raw(doc, index)
+
+    def test_default_is_decoded(self, ):
+        doc = self.session.find_one(Query().collection("docs").where(index=3))
+        self.assertIsInstance(doc, dict)
+        self.assertEqual(doc["id"], self.ids[3])
+        # raw(False)关闭raw模式
+        doc = self.session.find_one(Query().collection("docs").where(index=3).raw().raw(False))
+        self.assertEqual(doc["id"], self.ids[3])
+
+    def test_keyset_and_facet_ignore_raw(self, ):
+        keyset = self.session.find_many(Query().collection("docs").keyset_query(per_page=3).raw())
+        facet = self.session.find_many(Query().collection("docs").paginate_query(
+            page=1, per_page=3, use_facet=True).raw())
+        for doc in keyset.items + facet.items:
+            self.assertNotIsInstance(doc, RawBSONDocument)
+            self.assertIn("id", doc)
+
+    def test_raw_result_is_cached_separately(self, ):
+        raw = self.session.find_one(Query().collection("docs").where(index=3).raw().cache(30))
+        decoded = self.session.find_one(Query().collection("docs").where(index=3).cache(30))
+        self.assertIsInstance(raw, RawBSONDocument)
+        self.assertEqual(decoded["id"], self.ids[3])
+
+    def test_async_raw(self, ):
+        async def find():
+            session = make_async_session()
+            ids = await session.insert_many(Query().collection("docs").insert_query(
+                [{"index": i} for i in range(5)]))
+            one = await session.find_one(Query().collection("docs").where(index=1).raw())
+            all_ = await session.find_all(Query().collection("docs").raw())
+            streamed = [doc async for doc in session.iter_many(Query().collection("docs").raw())]
+            return ids, one, all_, streamed
+
+        ids, one, all_, streamed = run(find())
+        self.assertIsInstance(one, RawBSONDocument)
+        self.assertEqual(one["_id"], ObjectId(ids[1]))
+        for docs in (all_, streamed):
+            self.assertEqual([doc["_id"] for doc in docs], [ObjectId(val) for val in ids])
+            self.assertTrue(all(isinstance(doc, RawBSONDocument) for doc in docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 上午11:40
+"""
+import asyncio
+import unittest
+
+from fesdql import Query
+
+from .helpers import make_async_session, run
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def test_concurrent_find_many_share_one_query(self, ):
+        async def find():
+            session = make_async_session(single_flight=True)
+            await session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(30)]))
+            calls = []
+            find_many = session._find_many
+
+            async def counted_find_many(*args, **kwargs):
+                calls.append(args)
+                await asyncio.sleep(0.01)
+                return await find_many(*args, **kwargs)
+
+            session._find_many = counted_find_many
+            paginations = await asyncio.gather(*[session.find_many(
+                Query().collection("docs").paginate_query(page=2, per_page=10)) for _ in range(5)])
+            return calls, paginations
+
+        calls, paginations = run(find())
+        self.assertEqual(len(calls), 1)
+        for pagination in paginations:
+            self.assertEqual(pagination.total, 30)
+            self.assertEqual([doc["index"] for doc in pagination.items], list(range(10, 20)))
+        # 每个调用者拿到的是各自的副本
+        self.assertIsNot(paginations[0].items, paginations[1].items)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+@author: guoyanfeng
+@software: PyCharm
+@time: 2024/3/27 上午10:12
+"""
+import unittest
+
+from bson import ObjectId
+
+from benchmarks.standin import MemoryCollection
+from fesdql import Query
+
+from .helpers import make_sync_session
+
+
+class MemoryCollectionTestCase(unittest.TestCase):
+
+    def setUp(self, ):
+        self.collection = MemoryCollection("docs")
+        self.ids = [ObjectId() for _ in range(50)]
+        # 乱序插入,索引仍然按照_id的顺序
+        for id_ in reversed(self.ids):
+            self.collection.insert_one({"_id": id_, "age": self.ids.index(id_) % 5})
+        self.collection.insert_one({"_id": "string-id", "age": 1})
+
+    def test_natural_order_is_id_order(self, ):
+        docs = list(self.collection.find({"_id": {"$type": "objectId"}}))
+        self.assertEqual([doc["_id"] for doc in docs], self.ids)
+
+    def test_id_range_seek(self, ):
+        docs = list(self.collection.find({"$or": [{"_id": {"$gt": self.ids[9]}}]}, limit=5))
+        self.assertEqual([doc["_id"] for doc in docs], self.ids[10:15])
+        docs = list(self.collection.find({"_id": {"$lt": self.ids[5]}}, sort=[("_id", -1)]))
+        self.assertEqual([doc["_id"] for doc in docs], self.ids[4::-1])
+
+    def test_comparison_is_type_bracketed(self, ):
+        self.assertEqual(self.collection.count_documents({"_id": {"$gte": self.ids[0]}}), 50)
+        self.assertEqual(self.collection.count_documents({"_id": {"$gte": ""}}), 1)
+        self.assertEqual(self.collection.count_documents({"_id": {"$not": {"$type": "objectId"}}}), 1)
+
+    def test_id_in(self, ):
+        docs = list(self.collection.find({"_id": {"$in": [self.ids[3], self.ids[1], ObjectId()]}}))
+        self.assertEqual([doc["_id"] for doc in docs], [self.ids[1], self.ids[3]])
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+
+    def test_keyset_pages_match_offset_pages(self, ):
+        session = make_sync_session()
+        session.insert_many(Query().collection("docs").insert_query([{"index": i} for i in range(45)]))
+        offset_pages = [session.find_many(Query().collection("docs").paginate_query(page=page, per_page=10)).items
+                        for page in range(1, 6)]
+
+        keyset_pages = []
+        cursor = None
+        for _ in range(5):
+            pagination = session.find_many(Query().collection("docs").keyset_query(after=cursor, per_page=10))
+            keyset_pages.append(pagination.items)
+            cursor = pagination.next_cursor
+        self.assertEqual(keyset_pages, offset_pages)
+        self.assertFalse(pagination.has_next)